@@ -0,0 +1,431 @@
+import copy
+import datetime
+import hashlib
+import math
+import struct
+from collections import defaultdict
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BUCKETS = {'hour': 3600, 'day': 86400, 'week': 7 * 86400, 'month': 86400}
+# 1970-01-01 was a Thursday, so weeks starting on Monday begin 3 days before multiples of 7 days
+_WEEK_SHIFT = 3 * 86400
+
+
+def bucket_starts(times, bucket, timezone_offset=0):
+    """
+    Start of the `bucket` (hour, day, week or month) of each epoch time in local time `timezone_offset` hours from
+    UTC, as local epoch seconds. Months are returned as the start of their day and labelled by bucket_label.
+    """
+    size = BUCKETS[bucket]
+    shift = _WEEK_SHIFT if bucket == 'week' else 0
+    offset = int(timezone_offset * 3600) + shift
+    if numpy is not None:
+        local = numpy.asarray(times, dtype=numpy.int64) + offset
+        return (local // size * size - shift).tolist()
+    return [(int(t) + offset) // size * size - shift for t in times]
+
+
+def bucket_label(start, bucket):
+    moment = datetime.datetime.utcfromtimestamp(start)
+    if bucket == 'hour':
+        return moment.strftime('%Y-%m-%d %H:00')
+    if bucket == 'month':
+        return moment.strftime('%Y-%m')
+    return moment.strftime('%Y-%m-%d')
+
+
+def hash64(value):
+    return struct.unpack_from('<Q', hashlib.md5(unicode(value).encode('utf-8')).digest())[0]
+
+
+def hash64_array(values):
+    """
+    hash64 of each value, hashing each distinct value once, as a uint64 array if NumPy is installed
+    """
+    codes = {}
+    indexes = [codes.setdefault(value, len(codes)) for value in values]
+    hashes = [0] * len(codes)
+    for value, code in codes.iteritems():
+        hashes[code] = hash64(value)
+    if numpy is None:
+        return [hashes[i] for i in indexes]
+    return numpy.asarray(hashes, dtype=numpy.uint64)[numpy.asarray(indexes, dtype=numpy.int64)]
+
+
+def _bit_lengths(values):
+    # int.bit_length of each value of a uint64 array, exact because each 32 bit half converts to float64 exactly
+    high = (values >> numpy.uint64(32)).astype(numpy.float64)
+    low = (values & numpy.uint64(0xffffffff)).astype(numpy.float64)
+    return numpy.where(high > 0, 32 + numpy.frexp(high)[1], numpy.frexp(low)[1])
+
+
+def _groups(codes, count):
+    # Positions of the items of each of `count` codes: order[bounds[k]:bounds[k + 1]] are those with code k
+    order = numpy.argsort(codes, kind='mergesort')
+    return order, numpy.searchsorted(codes[order], numpy.arange(count + 1))
+
+
+class _Aggregation(object):
+    # Shared by the aggregations: bucketing and property lookup for one chunk of events
+
+    def __init__(self, by=('event',), bucket=None, timezone_offset=0):
+        self.by = tuple(by)
+        self.bucket = bucket
+        self.timezone_offset = timezone_offset
+        self._labels = {}
+
+    def empty(self):
+        """
+        Return a new, empty aggregation with the same settings, e.g. to aggregate a shard
+        """
+        result = copy.copy(self)
+        result._reset()
+        return result
+
+    def _keys(self, events):
+        columns = [[_lookup(event, name) for event in events] for name in self.by]
+        if self.bucket is not None:
+            starts = bucket_starts([event['properties'].get('time', 0) for event in events], self.bucket,
+                                   self.timezone_offset)
+            columns.insert(0, [self._label(start) for start in starts])
+        return zip(*columns) if columns else [()] * len(events)
+
+    def _key_codes(self, events):
+        # NumPy version of _keys: a code for each event's key (0 to the number of keys - 1) and the key of each code.
+        # Only reading the properties is done per event, bucketing and combining the columns are array operations.
+        columns = [[_lookup(event, name) for event in events] for name in self.by]
+        codes = numpy.zeros(len(events), dtype=numpy.int64)
+        if self.bucket is not None:
+            starts = numpy.asarray(bucket_starts([event['properties'].get('time', 0) for event in events],
+                                                 self.bucket, self.timezone_offset), dtype=numpy.int64)
+            codes = numpy.unique(starts, return_inverse=True)[1]
+        for column in columns:
+            values = {}
+            column_codes = numpy.fromiter((values.setdefault(value, len(values)) for value in column),
+                                          dtype=numpy.int64, count=len(column))
+            # Renumber after each column, so combined codes stay below the number of events
+            codes = numpy.unique(codes * len(values) + column_codes, return_inverse=True)[1]
+        first = numpy.unique(codes, return_index=True)[1].tolist()
+        keys = [tuple(column[i] for column in columns) for i in first]
+        if self.bucket is not None:
+            keys = [(self._label(int(starts[i])),) + key for i, key in zip(first, keys)]
+        return codes, keys
+
+    def _label(self, start):
+        label = self._labels.get(start)
+        if label is None:
+            label = self._labels[start] = bucket_label(start, self.bucket)
+        return label
+
+
+class GroupedCounts(_Aggregation):
+    """
+    Event counts grouped by time bucket and by `by`, a list of property names ('event' is the event name).
+
+    Keys of `result()` are tuples of the bucket label (if `bucket` is set)
+    followed by the values of `by`, e.g. ('2016-07-21', 'Signup', 'US').
+    """
+
+    def __init__(self, by=('event',), bucket='day', timezone_offset=0):
+        super(GroupedCounts, self).__init__(by, bucket, timezone_offset)
+        self._reset()
+
+    def _reset(self):
+        self.counts = defaultdict(int)
+
+    def update(self, events):
+        if numpy is not None and events:
+            codes, keys = self._key_codes(events)
+            for key, count in zip(keys, numpy.bincount(codes, minlength=len(keys)).tolist()):
+                self.counts[key] += count
+        else:
+            for key in self._keys(events):
+                self.counts[key] += 1
+
+    def merge(self, other):
+        for key, count in other.counts.iteritems():
+            self.counts[key] += count
+        return self
+
+    def result(self):
+        return dict(self.counts)
+
+
+class HyperLogLog(object):
+    """
+    Approximate distinct count in 2 ** precision one byte registers, with a standard error of about
+    1.04 / sqrt(2 ** precision) (1.6% at the default precision of 12). Sketches of the same precision merge
+    exactly.
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.size = 1 << precision
+        if numpy is not None:
+            self.registers = numpy.zeros(self.size, dtype=numpy.uint8)
+        else:
+            self.registers = bytearray(self.size)
+
+    def add(self, value):
+        self.add_hashes([hash64(value)])
+
+    def add_hashes(self, hashes):
+        """
+        Add 64 bit hashes (a list, or a uint64 array like hash64_array's)
+        """
+        width = 64 - self.precision
+        mask = (1 << width) - 1
+        if not isinstance(self.registers, bytearray):
+            hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+            indexes = (hashes >> numpy.uint64(width)).astype(numpy.int64)
+            ranks = width + 1 - _bit_lengths(hashes & numpy.uint64(mask))
+            numpy.maximum.at(self.registers, indexes, ranks.astype(numpy.uint8))
+            return
+        registers = self.registers
+        for h in hashes:
+            index = h >> width
+            rank = width - (h & mask).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge HyperLogLogs of different precision')
+        if not isinstance(self.registers, bytearray):
+            numpy.maximum(self.registers, numpy.asarray(other.registers, dtype=numpy.uint8), out=self.registers)
+        else:
+            self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def count(self):
+        size = self.size
+        alpha = 0.7213 / (1 + 1.079 / size)
+        if not isinstance(self.registers, bytearray):
+            total = float(numpy.sum(numpy.ldexp(1.0, -self.registers.astype(numpy.int64))))
+            zeros = int(numpy.count_nonzero(self.registers == 0))
+        else:
+            total = sum(math.ldexp(1.0, -register) for register in self.registers)
+            zeros = self.registers.count('\x00')
+        estimate = alpha * size * size / total
+        if estimate <= 2.5 * size and zeros:
+            # Linear counting is more accurate while many registers are still empty
+            estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
+
+
+class Uniques(_Aggregation):
+    """
+    Number of unique distinct_ids grouped like GroupedCounts, exactly (a set per key) or, with
+    `exact=False`, approximately with a HyperLogLog per key.
+    """
+
+    def __init__(self, by=('event',), bucket=None, timezone_offset=0, exact=True, precision=12):
+        super(Uniques, self).__init__(by, bucket, timezone_offset)
+        self.exact = exact
+        self.precision = precision
+        self._reset()
+
+    def _reset(self):
+        self.sets = defaultdict(set)
+        self.sketches = {}
+
+    def update(self, events):
+        ids = [event['properties'].get('distinct_id') for event in events]
+        if numpy is not None and events:
+            codes, keys = self._key_codes(events)
+            order, bounds = _groups(codes, len(keys))
+            if self.exact:
+                for k, key in enumerate(keys):
+                    self.sets[key].update(ids[i] for i in order[bounds[k]:bounds[k + 1]].tolist())
+                return
+            hashes = hash64_array(ids)[order]
+            for k, key in enumerate(keys):
+                self._sketch(key).add_hashes(hashes[bounds[k]:bounds[k + 1]])
+            return
+        if self.exact:
+            for key, distinct_id in zip(self._keys(events), ids):
+                self.sets[key].add(distinct_id)
+            return
+        hashes = defaultdict(list)
+        for key, distinct_id_hash in zip(self._keys(events), hash64_array(ids)):
+            hashes[key].append(distinct_id_hash)
+        for key, key_hashes in hashes.iteritems():
+            self._sketch(key).add_hashes(key_hashes)
+
+    def _sketch(self, key):
+        sketch = self.sketches.get(key)
+        if sketch is None:
+            sketch = self.sketches[key] = HyperLogLog(self.precision)
+        return sketch
+
+    def merge(self, other):
+        for key, distinct_ids in other.sets.iteritems():
+            self.sets[key].update(distinct_ids)
+        for key, sketch in other.sketches.iteritems():
+            if key in self.sketches:
+                self.sketches[key].merge(sketch)
+            else:
+                self.sketches[key] = copy.deepcopy(sketch)
+        return self
+
+    def result(self):
+        if self.exact:
+            return dict((key, len(distinct_ids)) for key, distinct_ids in self.sets.iteritems())
+        return dict((key, sketch.count()) for key, sketch in self.sketches.iteritems())
+
+
+class Funnel(_Aggregation):
+    """
+    Ordered funnel of event names: a user converts through step k if they did steps 0 to k in order, with every
+    step within `window` seconds (30 days by default) of step 0.
+
+    Each user's events are expected in time order across updates, as
+    /export returns them (events within one update are sorted). Only a
+    fixed amount of state per user is kept, not their events, so shards
+    merge exactly as long as `merge` is passed the shards in time order.
+    `result()` is the number of users who reached each step.
+    """
+
+    def __init__(self, steps, window=30 * 86400):
+        super(Funnel, self).__init__(by=())
+        self.steps = list(steps)
+        self.window = window
+        # Step indexes of each event name, last first, so one event never completes two steps in a row
+        self._positions = defaultdict(list)
+        for i, step in reversed(list(enumerate(self.steps))):
+            self._positions[step].append(i)
+        self._reset()
+
+    def _reset(self):
+        # Per user, starts[k] is the latest step 0 time from which steps 0 to k were done in order (which leaves the
+        # most of the window for the steps after k), and chains[j] the earliest times at which steps j, j + 1, ...
+        # were done in order, which is what a merge needs to continue the funnels started in an earlier shard
+        self.users = {}
+
+    def update(self, events):
+        positions = self._positions
+        chunk = defaultdict(list)
+        for event in events:
+            name = event['event']
+            if name in positions:
+                properties = event['properties']
+                chunk[properties.get('distinct_id')].append((properties.get('time', 0), name))
+        for distinct_id, steps in chunk.iteritems():
+            state = self.users.get(distinct_id)
+            if state is None:
+                state = self.users[distinct_id] = ([None] * len(self.steps), [[] for step in self.steps])
+            for time, name in sorted(steps):
+                self._advance(state, time, name)
+
+    def merge(self, other):
+        """
+        Merge a Funnel of events that all come after this one's, e.g. the next day of an export
+        """
+        for distinct_id, state in other.users.iteritems():
+            if distinct_id in self.users:
+                self.users[distinct_id] = self._merge_states(self.users[distinct_id], state)
+            else:
+                self.users[distinct_id] = copy.deepcopy(state)
+        return self
+
+    def result(self):
+        reached = [0] * len(self.steps)
+        for starts, chains in self.users.itervalues():
+            for i in xrange(sum(1 for start in starts if start is not None)):
+                reached[i] += 1
+        return reached
+
+    def _advance(self, state, time, name):
+        starts, chains = state
+        for k in self._positions[name]:
+            if k == 0:
+                starts[0] = time
+            elif starts[k - 1] is not None and time - starts[k - 1] <= self.window:
+                if starts[k] is None or starts[k - 1] > starts[k]:
+                    starts[k] = starts[k - 1]
+        for j in xrange(1, len(self.steps)):
+            chain = chains[j]
+            following = j + len(chain)
+            if following < len(self.steps) and self.steps[following] == name:
+                chain.append(time)
+
+    def _merge_states(self, earlier, later):
+        starts, chains = earlier
+        later_starts, later_chains = later
+        merged_starts = list(later_starts)
+        for k, start in enumerate(starts):
+            if start is None:
+                continue
+            # A funnel at step k continues with the earliest times of steps k + 1, k + 2, ... of the later shard
+            following = later_chains[k + 1] if k + 1 < len(self.steps) else []
+            for m in xrange(k, len(self.steps)):
+                if m > k and (m - k > len(following) or following[m - k - 1] - start > self.window):
+                    break
+                if merged_starts[m] is None or start > merged_starts[m]:
+                    merged_starts[m] = start
+        merged_chains = []
+        for j, chain in enumerate(chains):
+            chain = list(chain)
+            following = j + len(chain)
+            if j > 0 and following < len(self.steps):
+                chain.extend(later_chains[following])
+            merged_chains.append(chain)
+        return merged_starts, merged_chains
+
+
+def aggregate(events, aggregations, chunk_size=10000):
+    """
+    Feed an iterable of events to every aggregation in chunks of `chunk_size`, and return the aggregations
+    """
+    events = iter(events)
+    while True:
+        chunk = list(islice(events, chunk_size))
+        if not chunk:
+            return aggregations
+        for aggregation in aggregations:
+            aggregation.update(chunk)
+
+
+def aggregate_file(filename, aggregations, chunk_size=10000, parse_processes=None):
+    """
+    Aggregate the events in a file written by Mixpanel.export_events (JSON, NDJSON or CSV, optionally compressed)
+    """
+    from mixpanelapi import Mixpanel
+    return aggregate(Mixpanel.iter_from_argument(filename, parse_processes), aggregations, chunk_size)
+
+
+def aggregate_export(client, params, aggregations, processes=4, chunk_size=10000):
+    """
+    Aggregate the events of a raw data export, streaming each day of params' from_date to to_date on its own
+    thread and merging the partial results
+    """
+    from_date = datetime.datetime.strptime(params['from_date'], '%Y-%m-%d').date()
+    to_date = datetime.datetime.strptime(params['to_date'], '%Y-%m-%d').date()
+    days = [(from_date + datetime.timedelta(days=i)).isoformat() for i in xrange((to_date - from_date).days + 1)]
+
+    def aggregate_day(day):
+        day_params = dict(params, from_date=day, to_date=day)
+        return aggregate(client.iter_export(day_params), [aggregation.empty() for aggregation in aggregations],
+                         chunk_size)
+
+    pool = ThreadPool(processes=processes)
+    try:
+        # Merged in day order, which Funnel needs
+        for partials in pool.imap(aggregate_day, days):
+            for aggregation, partial in zip(aggregations, partials):
+                aggregation.merge(partial)
+    finally:
+        pool.terminate()
+    return aggregations
+
+
+def _lookup(event, name):
+    if name == 'event':
+        return event['event']
+    return event['properties'].get(name)
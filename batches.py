@@ -0,0 +1,44 @@
+import base64
+import json
+import urllib
+
+from records import to_builtin
+
+
+class EncodedBatch(object):
+    """
+    Immutable batch of prepared items with its request body encoded once.
+
+    Each item is serialized to JSON once, the JSON array is base64 encoded
+    and percent-escaped once, and the resulting `body` is sent as it is by
+    every retry. The per-item encodings are kept so that `split` and the
+    dead-letter sinks reuse them instead of serializing items again.
+    """
+
+    __slots__ = ('items', 'encoded_items', 'json', 'body')
+
+    def __init__(self, items, encoded_items=None):
+        self.items = tuple(items)
+        if encoded_items is None:
+            encoded_items = [json.dumps(item, default=to_builtin, separators=(',', ':')) for item in self.items]
+        self.encoded_items = tuple(encoded_items)
+        self.json = '[' + ','.join(self.encoded_items) + ']'
+        self.body = 'data=' + urllib.quote_plus(base64.b64encode(self.json)) + '&verbose=1'
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def split(self, max_bytes):
+        """
+        Return a list of batches whose JSON is at most `max_bytes` long (or which hold a single item), halving
+        this batch as often as needed
+        """
+        if len(self.json) <= max_bytes or len(self.items) == 1:
+            return [self]
+        middle = len(self.items) // 2
+        first = EncodedBatch(self.items[:middle], self.encoded_items[:middle])
+        second = EncodedBatch(self.items[middle:], self.encoded_items[middle:])
+        return first.split(max_bytes) + second.split(max_bytes)
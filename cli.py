@@ -0,0 +1,224 @@
+"""
+Streaming command line interface for exports, imports and People updates.
+
+Items are read and written as NDJSON, one event or profile per line, so
+commands can be chained with zcat, jq and split without intermediate files:
+
+    python mixpanelapi.py export-events --from-date 2016-07-01 --to-date 2016-07-31 \\
+        | jq -c 'select(.event == "Signup")' \\
+        | MIXPANEL_API_SECRET=... MIXPANEL_TOKEN=... python mixpanelapi.py import-events
+
+The API secret and token are read from --api-secret and --token, or from the
+MIXPANEL_API_SECRET and MIXPANEL_TOKEN environment variables.
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+
+from mixpanelapi import Mixpanel
+from paginator import range_selectors
+from projects import FairScheduler
+from records import to_builtin
+from sqlite_store import SQLiteStore
+from timestamps import parse_timezone
+from writers import COMPRESSION_EXTENSIONS, open_input, open_output
+
+
+def main(argv=None, stdin=None, stdout=None, stderr=None):
+    """
+    Run a command and return its exit status: 0 on success, 1 if any item failed to import
+    """
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    args = _parser().parse_args(argv)
+    scheduler = None
+    worker_pool = None
+    if args.rate_limit:
+        # A rate limit needs the FairScheduler's token bucket, so batches are sent on its workers
+        scheduler = FairScheduler(args.concurrency)
+        worker_pool = scheduler.project('cli', rate_limit=args.rate_limit)
+    client = Mixpanel(args.api_secret or os.environ.get('MIXPANEL_API_SECRET'),
+                      args.token or os.environ.get('MIXPANEL_TOKEN'), timeout=args.timeout,
+                      pool_size=args.concurrency or (scheduler.workers if scheduler else None),
+                      max_retries=args.max_retries, debug=args.debug, worker_pool=worker_pool,
+                      adaptive_concurrency=args.adaptive, batch_size=args.batch_size)
+    try:
+        return args.command(client, args, stdin, stdout, stderr)
+    finally:
+        if scheduler is not None:
+            scheduler.close()
+
+
+def export_events(client, args, stdin, stdout, stderr):
+    params = {'from_date': args.from_date, 'to_date': args.to_date}
+    if args.event:
+        params['event'] = args.event
+    if args.where:
+        params['where'] = args.where
+    _write_items(client.iter_export(params), args, stdout)
+    return 0
+
+
+def export_people(client, args, stdin, stdout, stderr):
+    params = {'where': args.where} if args.where else {}
+    partitions = range_selectors(args.partition_by, args.boundary or []) if args.partition_by else None
+    if args.snapshot is None:
+        _write_items(client.iter_engage(params, output_properties=args.output_properties, partitions=partitions),
+                     args, stdout)
+        return 0
+    with SQLiteStore(args.snapshot) as snapshot:
+        changed = client.update_people_snapshot(snapshot, params, full_refresh=args.full_refresh,
+                                                partitions=partitions)
+        _write_items(changed if args.delta else snapshot.iter_profiles(), args, stdout)
+    return 0
+
+
+def import_events(client, args, stdin, stdout, stderr):
+    return _report(client.import_events(_read_items(args, stdin), timezone_offset=args.timezone_offset), stderr)
+
+
+def import_people(client, args, stdin, stdout, stderr):
+    return _report(client.import_people(_read_items(args, stdin), ignore_alias=args.ignore_alias), stderr)
+
+
+def people_operation(operation):
+    def run(client, args, stdin, stdout, stderr):
+        if operation == '$delete':
+            value = ''
+        elif operation == '$unset':
+            value = args.value
+        else:
+            value = json.loads(args.value)
+        if args.where is not None:
+            profiles, query_params = None, {'where': args.where}
+        else:
+            profiles, query_params = _read_items(args, stdin), None
+        job = client.people_operation(operation, value, profiles=profiles, query_params=query_params,
+                                      ignore_alias=args.ignore_alias, backup=not args.no_backup,
+                                      backup_file=args.backup_file)
+        return _report(job, stderr)
+    return run
+
+
+def _read_items(args, stdin):
+    item_file = stdin if args.input == '-' else open_input(args.input)
+    try:
+        for line in item_file:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        if item_file is not stdin:
+            item_file.close()
+
+
+def _write_items(items, args, stdout):
+    if args.output == '-':
+        if args.compress not in (None, 'gzip'):
+            raise SystemExit('Only gzip compression is supported when writing to stdout')
+        output = gzip.GzipFile(fileobj=stdout, mode='wb') if args.compress else stdout
+    else:
+        filename = args.output
+        if args.compress and not filename.endswith(COMPRESSION_EXTENSIONS[args.compress]):
+            filename += COMPRESSION_EXTENSIONS[args.compress]
+        output = open_output(filename, args.compress, args.compress_level, args.compress_threads)
+    try:
+        for item in items:
+            output.write(json.dumps(item, default=to_builtin) + '\n')
+    finally:
+        if output is stdout:
+            output.flush()
+        else:
+            output.close()
+
+
+def _report(job, stderr):
+    summary = job.summary()
+    stderr.write(json.dumps(summary, default=repr, sort_keys=True) + '\n')
+    return 1 if summary['failed'] or summary['error'] is not None else 0
+
+
+def _timezone(value):
+    try:
+        return parse_timezone(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog='mixpanelapi.py', description='Stream data in and out of Mixpanel as NDJSON')
+    parser.add_argument('--api-secret', help='project API secret, defaults to $MIXPANEL_API_SECRET')
+    parser.add_argument('--token', help='project token, defaults to $MIXPANEL_TOKEN')
+    parser.add_argument('--concurrency', type=int, help='number of requests in flight (the pool size)')
+    parser.add_argument('--adaptive', action='store_true', help='adjust concurrency to the API\'s responses')
+    parser.add_argument('--rate-limit', type=float, help='maximum import or People requests per second')
+    parser.add_argument('--batch-size', type=int, default=50, help='items per import or People request')
+    parser.add_argument('--timeout', type=int, default=120, help='request timeout in seconds')
+    parser.add_argument('--max-retries', type=int, default=10, help='retries of batches that get a 429 or 503')
+    parser.add_argument('--debug', action='store_true')
+    commands = parser.add_subparsers()
+
+    def output_arguments(command):
+        command.add_argument('--output', default='-', help='file to write NDJSON to, defaults to stdout')
+        command.add_argument('--compress', choices=sorted(COMPRESSION_EXTENSIONS))
+        command.add_argument('--compress-level', type=int)
+        command.add_argument('--compress-threads', type=int, default=1)
+
+    def input_arguments(command):
+        command.add_argument('--input', default='-',
+                             help='NDJSON file to read, optionally .gz, .bz2 or .xz compressed, defaults to stdin')
+
+    command = commands.add_parser('export-events', help='stream raw events from /export')
+    command.add_argument('--from-date', required=True)
+    command.add_argument('--to-date', required=True)
+    command.add_argument('--event', action='append', help='event name to export, can be repeated')
+    command.add_argument('--where')
+    output_arguments(command)
+    command.set_defaults(command=export_events)
+
+    command = commands.add_parser('export-people', help='stream profiles from /engage')
+    command.add_argument('--where')
+    command.add_argument('--output-properties', nargs='+', help='only fetch these profile properties')
+    command.add_argument('--partition-by', help='property to split the scan into concurrent partitions on')
+    command.add_argument('--boundary', action='append',
+                         help='value of --partition-by where a partition starts, can be repeated')
+    command.add_argument('--snapshot', help='SQLite snapshot of profiles to update with only the changed profiles')
+    command.add_argument('--delta', action='store_true', help='with --snapshot, write only the changed profiles')
+    command.add_argument('--full-refresh', action='store_true', help='with --snapshot, fetch every profile')
+    output_arguments(command)
+    command.set_defaults(command=export_people)
+
+    command = commands.add_parser('import-events', help='import events')
+    command.add_argument('--timezone-offset', type=_timezone, default=0,
+                         help='hours from UTC (like -7 or 5.5) or timezone name (like America/New_York) of the '
+                              'project the events were exported from')
+    input_arguments(command)
+    command.set_defaults(command=import_events)
+
+    command = commands.add_parser('import-people', help='$set the properties of profiles')
+    command.add_argument('--ignore-alias', action='store_true')
+    input_arguments(command)
+    command.set_defaults(command=import_people)
+
+    for name, operation, value_help in [('people-set', '$set', 'JSON object of properties to set'),
+                                        ('people-set-once', '$set_once', 'JSON object of properties to set once'),
+                                        ('people-add', '$add', 'JSON object of properties to increment'),
+                                        ('people-append', '$append', 'JSON object of list properties to append to'),
+                                        ('people-unset', '$unset', 'names of properties to remove'),
+                                        ('people-delete', '$delete', None)]:
+        command = commands.add_parser(name, help=operation + ' profiles read as NDJSON or matching --where')
+        if operation == '$unset':
+            command.add_argument('value', nargs='+', help=value_help)
+        elif value_help is not None:
+            command.add_argument('value', help=value_help)
+        command.add_argument('--where', help='update the profiles matching this selector instead of reading them')
+        command.add_argument('--ignore-alias', action='store_true')
+        command.add_argument('--backup-file', help='NDJSON file to back profiles up to before updating them, '
+                                                   'gzip compressed if it ends in .gz, '
+                                                   'defaults to backup_<timestamp>.json.gz')
+        command.add_argument('--no-backup', action='store_true', help='update profiles without backing them up')
+        input_arguments(command)
+        command.set_defaults(command=people_operation(operation))
+    return parser
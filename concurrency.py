@@ -0,0 +1,130 @@
+import threading
+import time
+
+
+class AIMDController(object):
+    """
+    Adaptive limit on the number of in-flight requests (additive increase, multiplicative decrease).
+
+    Every healthy response raises the limit by `increase / limit`, i.e. by
+    `increase` per full window of requests. An overloaded request (429, a 5xx
+    error or a failed connection) or a latency above `latency_factor` times
+    the smoothed latency (and at least `min_spike` seconds above it)
+    multiplies the limit by `decrease`. Only requests started after the last decrease can trigger
+    another one, so a burst of 503s from one window cuts the limit once
+    rather than once per request.
+
+    Latency is smoothed separately for each endpoint passed to `release`, so
+    slow but healthy /export or /engage responses don't look like spikes to
+    /import, and requests released with `measure_latency=False` (streamed
+    responses, whose duration depends on their size) only decrease the
+    limit when overloaded.
+
+    `limit` is the current number of requests allowed in flight and can be
+    read at any time for monitoring.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=64, increase=1.0, decrease=0.5, latency_factor=3.0,
+                 min_spike=0.1, smoothing=0.1):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.min_spike = min_spike
+        self.smoothing = smoothing
+        self.in_flight = 0
+        # Smoothed latency of each endpoint
+        self.latencies = {}
+        self._limit = float(max(min_limit, min(initial, max_limit)))
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def acquire(self):
+        """
+        Block until a request may be sent, and return the start time to pass to `release`.
+        """
+        with self._condition:
+            while self.in_flight >= int(self._limit):
+                self._condition.wait(1)
+            self.in_flight += 1
+            return time.time()
+
+    def release(self, started, overloaded=False, endpoint=None, measure_latency=True):
+        """
+        Record the outcome of a request that was started at `started`.
+
+        :param overloaded: True if the API responded with 429 or a 5xx error, or the connection failed
+        :param endpoint: name of the endpoint the request was sent to, whose latencies it is compared with
+        :param measure_latency: False if the request's duration isn't a latency, like a streamed export's
+        """
+        now = time.time()
+        latency = now - started
+        with self._condition:
+            self.in_flight -= 1
+            baseline = self.latencies.get(endpoint) if measure_latency else None
+            spike = baseline is not None and latency > max(baseline * self.latency_factor,
+                                                           baseline + self.min_spike)
+            if overloaded or spike:
+                if started >= self._last_decrease:
+                    self._limit = max(self.min_limit, self._limit * self.decrease)
+                    self._last_decrease = now
+            else:
+                self._limit = min(self.max_limit, self._limit + self.increase / self._limit)
+            if measure_latency and not overloaded:
+                if baseline is None:
+                    self.latencies[endpoint] = latency
+                else:
+                    self.latencies[endpoint] = baseline + self.smoothing * (latency - baseline)
+            self._condition.notify_all()
+
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+
+class PriorityLimiter(object):
+    """
+    Limit of `capacity` requests in flight shared by interactive and bulk requests.
+
+    Bulk requests (import and People batches) may only use `capacity -
+    reserved` slots, so `reserved` slots are always free for interactive
+    requests (queries, exports and lookups), and while an interactive
+    request is waiting no bulk request takes a slot that frees up. A
+    backfill therefore never queues lookups behind thousands of batches.
+    """
+
+    def __init__(self, capacity, reserved=1):
+        if not 0 <= reserved < capacity:
+            raise ValueError('reserved must be at least 0 and less than capacity')
+        self.capacity = capacity
+        self.reserved = reserved
+        self.in_flight = {INTERACTIVE: 0, BULK: 0}
+        self.waiting = {INTERACTIVE: 0, BULK: 0}
+        self._condition = threading.Condition()
+
+    def acquire(self, priority=INTERACTIVE):
+        with self._condition:
+            self.waiting[priority] += 1
+            try:
+                while not self._available(priority):
+                    self._condition.wait(1)
+            finally:
+                self.waiting[priority] -= 1
+            self.in_flight[priority] += 1
+
+    def release(self, priority=INTERACTIVE):
+        with self._condition:
+            self.in_flight[priority] -= 1
+            self._condition.notify_all()
+
+    def _available(self, priority):
+        if self.in_flight[INTERACTIVE] + self.in_flight[BULK] >= self.capacity:
+            return False
+        if priority == BULK:
+            return self.in_flight[BULK] < self.capacity - self.reserved and not self.waiting[INTERACTIVE]
+        return True
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import math
+import os
+import struct
+import threading
+
+from records import to_builtin
+
+_MAGIC = 'MPBLOOM2'
+_HEADER = struct.Struct('<8sdQI')
+_LAYER_HEADER = struct.Struct('<QIQQ')
+_MAGIC_V1 = 'MPBLOOM1'
+_HEADER_V1 = struct.Struct('<8sQII')
+
+
+def event_fingerprint(event):
+    """
+    Fingerprint of a prepared event from its name, distinct_id, time and a hash of its other properties. The token
+    is left out so the fingerprint doesn't depend on which import prepared the event.
+    """
+    properties = event['properties']
+    other = dict((key, value) for key, value in properties.iteritems()
+                 if key not in ('distinct_id', 'time', 'token'))
+    properties_hash = hashlib.sha1(json.dumps(other, sort_keys=True, default=to_builtin)).hexdigest()
+    key = json.dumps([event['event'], properties.get('distinct_id'), properties.get('time'), properties_hash],
+                     default=to_builtin)
+    return hashlib.sha1(key).digest()
+
+
+class BloomFilter(object):
+    """
+    Persistent, scalable Bloom filter of fingerprints of events that have already been imported.
+
+    The filter holds `capacity` fingerprints at a false positive rate below
+    `error_rate` in a fixed size bit array (about 1.3 MB per million
+    fingerprints at the default rate). Once that is full it adds a layer
+    twice as large with half the false positive rate, and so on (Almeida et
+    al.'s scalable Bloom filter), so the combined rate stays below
+    `error_rate` however many fingerprints are added. A false positive makes
+    an import skip an event that was never sent, so pick a rate to match how
+    costly that is.
+
+    If `filename` exists the filter is loaded from it, and `save` writes it
+    back, so fingerprints carry over between runs. Pass an instance to
+    Mixpanel(dedupe_filter=...) to skip events imported by earlier runs,
+    retries of crashed runs or overlapping backfill files.
+    """
+
+    def __init__(self, filename=None, capacity=1000000, error_rate=0.001):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self.layers = []
+        if filename is not None and os.path.exists(filename):
+            self._load(filename)
+        else:
+            self.capacity = capacity
+            self.error_rate = error_rate
+            self._grow()
+        # Fingerprints added since the filter was last saved
+        self.unsaved = 0
+
+    @property
+    def count(self):
+        return sum(layer.count for layer in self.layers)
+
+    def __contains__(self, fingerprint):
+        hashes = _hashes(fingerprint)
+        return any(layer.contains(*hashes) for layer in self.layers)
+
+    def add(self, fingerprint):
+        hashes = _hashes(fingerprint)
+        with self._lock:
+            layer = self.layers[-1]
+            if layer.count >= layer.capacity:
+                layer = self._grow()
+            layer.add(*hashes)
+            self.unsaved += 1
+
+    def update(self, fingerprints):
+        for fingerprint in fingerprints:
+            self.add(fingerprint)
+
+    def empty(self):
+        """
+        Return a new, empty in-memory filter with the same capacity and error rate, e.g. for the events seen by one
+        import
+        """
+        return BloomFilter(capacity=self.capacity, error_rate=self.error_rate)
+
+    def save(self, filename=None):
+        """
+        Write the filter to `filename` (by default the file it was loaded from), replacing the file atomically
+        """
+        filename = filename or self.filename
+        temp_filename = filename + '.tmp'
+        # Hold the lock until the rename, so saves from several threads don't share the temporary file
+        with self._lock:
+            with open(temp_filename, 'wb') as output:
+                output.write(_HEADER.pack(_MAGIC, self.error_rate, self.capacity, len(self.layers)))
+                for layer in self.layers:
+                    output.write(_LAYER_HEADER.pack(layer.num_bits, layer.num_hashes, layer.capacity, layer.count))
+                    output.write(layer.bits)
+            os.rename(temp_filename, filename)
+            if filename == self.filename:
+                self.unsaved = 0
+
+    def _grow(self):
+        # Layer i holds capacity * 2 ** i fingerprints at error_rate / 2 ** (i + 1), so the rates sum to error_rate
+        i = len(self.layers)
+        layer = _Layer(self.capacity << i, self.error_rate / 2 ** (i + 1))
+        self.layers.append(layer)
+        return layer
+
+    def _load(self, filename):
+        with open(filename, 'rb') as f:
+            magic = f.read(len(_MAGIC))
+            f.seek(0)
+            if magic == _MAGIC_V1:
+                # A single layer filter from before filters could grow
+                magic, num_bits, num_hashes, count = _HEADER_V1.unpack(f.read(_HEADER_V1.size))
+                self.capacity = max(1, int(num_bits * math.log(2) / num_hashes))
+                self.error_rate = math.exp(-float(num_bits) / self.capacity * math.log(2) ** 2)
+                self.layers.append(_Layer(self.capacity, None, num_bits, num_hashes, count, bytearray(f.read())))
+                return
+            if magic != _MAGIC:
+                raise ValueError('Not a Bloom filter file: ' + filename)
+            magic, self.error_rate, self.capacity, num_layers = _HEADER.unpack(f.read(_HEADER.size))
+            for _ in xrange(num_layers):
+                num_bits, num_hashes, capacity, count = _LAYER_HEADER.unpack(f.read(_LAYER_HEADER.size))
+                self.layers.append(_Layer(capacity, None, num_bits, num_hashes, count,
+                                          bytearray(f.read((num_bits + 7) // 8))))
+
+
+class _Layer(object):
+    # One fixed size Bloom filter of a BloomFilter
+
+    def __init__(self, capacity, error_rate, num_bits=None, num_hashes=None, count=0, bits=None):
+        self.capacity = capacity
+        if num_bits is None:
+            num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+            num_hashes = max(1, int(round(num_bits / float(capacity) * math.log(2))))
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.count = count
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+
+    def contains(self, first, second):
+        bits = self.bits
+        for index in self._indexes(first, second):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+    def add(self, first, second):
+        for index in self._indexes(first, second):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def _indexes(self, first, second):
+        # Double hashing (Kirsch and Mitzenmacher): k indexes from the two halves of one digest
+        return [(first + i * second) % self.num_bits for i in xrange(self.num_hashes)]
+
+
+def _hashes(fingerprint):
+    first, second = struct.unpack_from('<QQ', hashlib.md5(fingerprint).digest())
+    return first, second | 1
@@ -0,0 +1,101 @@
+import threading
+import time
+
+
+class ImportJob(object):
+    """
+    Progress and outcome of an import or People operation.
+
+    Counters are in items: `prepared` items have been turned into API
+    params, `sent` items are in batches whose request has started, and those
+    end up `acknowledged` (the API returned status 1) or `failed` (a bad
+    response, an HTTP error, or dead-lettered after max_retries).
+    `duplicates` are events skipped because the client's dedupe filter
+    showed them as already imported, and `unchanged` are profiles that
+    sync_people skipped because they already matched.
+
+    Jobs returned by the *_async methods of Mixpanel run on a background
+    thread; use `wait` to block until they finish and `summary` for the
+    final counts.
+    """
+
+    def __init__(self):
+        self.prepared = 0
+        self.sent = 0
+        self.acknowledged = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.unchanged = 0
+        self.errors = []
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    @classmethod
+    def start(cls, func, *args, **kwargs):
+        """
+        Run `func(*args, job=<new job>, **kwargs)` on a background thread and return the job.
+        """
+        job = cls()
+        kwargs['job'] = job
+
+        def run():
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                job.error = e
+            finally:
+                job.finish()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def record(self, counter, count, error=None):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + count)
+            if error is not None:
+                self.errors.append(error)
+
+    def finish(self):
+        self.finished = time.time()
+        self._done.set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def items_per_second(self):
+        elapsed = self.elapsed
+        return self.acknowledged / elapsed if elapsed > 0 else 0.0
+
+    def wait(self, timeout=None):
+        """
+        Block until the job finishes or `timeout` seconds pass. Returns True if the job has finished.
+        """
+        self._done.wait(timeout)
+        return self.done
+
+    def summary(self):
+        with self._lock:
+            return {
+                'prepared': self.prepared,
+                'sent': self.sent,
+                'acknowledged': self.acknowledged,
+                'failed': self.failed,
+                'duplicates': self.duplicates,
+                'unchanged': self.unchanged,
+                'errors': list(self.errors),
+                'error': self.error,
+                'done': self.done,
+                'elapsed': self.elapsed,
+                'items_per_second': self.items_per_second,
+            }
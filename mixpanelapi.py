@@ -1,45 +1,117 @@
+#!/usr/bin/env python
 import base64
 import urllib  # for url encoding
 import urllib2  # for sending requests
 import cStringIO
 import logging
 import gzip
+import httplib
+import random
+import socket
 import shutil
+import threading
 import time
 import os
 import datetime
+import glob
 from inspect import isfunction
-from itertools import chain
+from itertools import islice
 from multiprocessing import cpu_count
 from multiprocessing.pool import ThreadPool
-from paginator import ConcurrentPaginator
+from batches import EncodedBatch
+from concurrency import AIMDController, BULK, INTERACTIVE, PriorityLimiter
+from dedupe import event_fingerprint
+from jobs import ImportJob
+from paginator import ConcurrentPaginator, PartitionedPaginator
+from parallel_reader import iter_items_from_file
+from profiling import NullProfiler
+from records import CompactMapping, Event, Profile, to_builtin
+from spill import SpillList
+from sqlite_store import SQLiteStore
+from timestamps import MILLISECONDS_THRESHOLD, normalize_event_times, normalize_times, parse_iso
+from writers import BackupWriter, DeadLetterSink, COMPRESSION_EXTENSIONS, compression_codec, open_input, open_output
 from ast import literal_eval
 from copy import deepcopy
+from contextlib import closing, contextmanager
 import csv
 import json
 
-try:
-    import ciso8601
-except ImportError:
-    pass
-
 
 class Mixpanel(object):
     API_URL = 'https://mixpanel.com/api'
     DATA_URL = 'https://data.mixpanel.com/api'
     IMPORT_URL = 'https://api.mixpanel.com'
     VERSION = '2.0'
+    ADAPTIVE_MAX_POOL_SIZE = 64
+    PENDING_BATCHES_PER_WORKER = 4
+    # Batches whose JSON is longer than this are split in halves before they are sent
+    MAX_BATCH_BYTES = 2 * 1024 * 1024
+    # Imports save their dedupe_filter each time this many batches' worth of events have been acknowledged
+    DEDUPE_SAVE_INTERVAL = 100
+    # Batches rejected with 429 or 503 are retried after a random delay of up to RETRY_BACKOFF * 2 ** retries seconds,
+    # capped at RETRY_BACKOFF_MAX, unless the response says how long to wait in Retry-After
+    RETRY_BACKOFF = 1
+    RETRY_BACKOFF_MAX = 60
+    # Engage projection for operations that only need each profile's $distinct_id, which every result includes. An
+    # empty output_properties returns every property, so one small property is requested instead.
+    MINIMAL_OUTPUT_PROPERTIES = ['$last_seen']
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.WARNING)
 
-    def __init__(self, api_secret, token=None, timeout=120, pool_size=None, max_retries=10, debug=False):
+    def __init__(self, api_secret, token=None, timeout=120, pool_size=None, max_retries=10, debug=False,
+                 worker_pool=None, adaptive_concurrency=False, invalid_events_sink=None, failed_batches_sink=None,
+                 profiler=None, dedupe_filter=None, batch_size=50, memory_budget=None, max_in_flight=None,
+                 reserved_interactive=1):
+        """
+        :param pool_size: number of threads used to send batches and fetch pages. With adaptive_concurrency this is
+        the upper bound on requests in flight and defaults to ADAPTIVE_MAX_POOL_SIZE.
+        :param worker_pool: object with ThreadPool's apply_async/close/join methods that import and People batches are
+        sent and People pages fetched on, such as a projects.ProjectQueue shared with other clients. By default each
+        import, People operation or query creates its own ThreadPool of pool_size threads.
+        :param adaptive_concurrency: True to adjust the number of requests in flight with an AIMDController, raising it
+        while responses are healthy and cutting it on 429s, 5xx errors, failed connections or latency spikes. See
+        concurrency_limit.
+        :param invalid_events_sink: writers.DeadLetterSink for events missing time or distinct_id, defaults to
+        invalid_events.txt
+        :param failed_batches_sink: writers.DeadLetterSink for batches that still failed after max_retries, defaults
+        to import_backup.txt with one batch per line
+        :param profiler: profiling.StageProfiler that records the time spent in each stage of imports and exports
+        :param dedupe_filter: dedupe.BloomFilter of events already imported. Imports skip events found in it or
+        already queued by the same import, add events to it once the API acknowledges them and save it every
+        DEDUPE_SAVE_INTERVAL batches and at the end of every import, even one that fails.
+        :param batch_size: number of events or profile updates sent per request
+        :param memory_budget: default for query_engage's memory_budget, so export_people and deduplicate_people
+        spill large People tables to disk too
+        :param max_in_flight: limit on requests in flight across every thread using this client, shared by priority
+        class with a concurrency.PriorityLimiter. Import and People batches are bulk requests, everything else is
+        interactive unless run in a `priority(BULK)` block.
+        :param reserved_interactive: slots of max_in_flight that bulk requests can never use
+        """
         self.api_secret = api_secret
         self.token = token
         self.timeout = timeout
         if pool_size is None:
-            pool_size = cpu_count() * 2
+            pool_size = Mixpanel.ADAPTIVE_MAX_POOL_SIZE if adaptive_concurrency else cpu_count() * 2
         self.pool_size = pool_size
+        self.concurrency = None
+        if adaptive_concurrency:
+            self.concurrency = AIMDController(initial=min(cpu_count() * 2, pool_size), max_limit=pool_size)
         self.max_retries = max_retries
+        self.worker_pool = worker_pool
+        if invalid_events_sink is None:
+            invalid_events_sink = DeadLetterSink('invalid_events.txt')
+        if failed_batches_sink is None:
+            failed_batches_sink = DeadLetterSink('import_backup.txt', format='batches')
+        self.invalid_events_sink = invalid_events_sink
+        self.failed_batches_sink = failed_batches_sink
+        self.profiler = profiler if profiler is not None else NullProfiler()
+        self.dedupe_filter = dedupe_filter
+        self.batch_size = batch_size
+        self.memory_budget = memory_budget
+        self.priorities = None
+        if max_in_flight is not None:
+            self.priorities = PriorityLimiter(max_in_flight, reserved_interactive)
+        self._local = threading.local()
         log_level = Mixpanel.logger.getEffectiveLevel()
         ch = logging.StreamHandler()
         formatter = logging.Formatter('%(levelname)s: %(message)s')
@@ -50,6 +122,35 @@ class Mixpanel(object):
         else:
             Mixpanel.logger.setLevel(logging.WARNING)
 
+    @property
+    def current_priority(self):
+        """
+        Priority class of requests sent from the current thread, concurrency.INTERACTIVE unless set by `priority`
+        """
+        return getattr(self._local, 'priority', INTERACTIVE)
+
+    @contextmanager
+    def priority(self, priority):
+        """
+        Send the requests made by the current thread inside the block with the given priority class, e.g.
+        `with client.priority(BULK): client.export_events(...)` for a backfill export
+        """
+        previous = self.current_priority
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    @property
+    def concurrency_limit(self):
+        """
+        The number of requests currently allowed in flight.
+        """
+        if self.concurrency is not None:
+            return self.concurrency.limit
+        return self.pool_size
+
     @staticmethod
     def unicode_urlencode(params):
         if isinstance(params, dict):
@@ -63,6 +164,9 @@ class Mixpanel(object):
 
     @staticmethod
     def response_handler_callback(response):
+        if response is None:
+            # The batch failed and was written to the failed batches sink
+            return
         if json.loads(response)['status'] != 1:
             Mixpanel.logger.warning("Bad API response: " + response)
             raise RuntimeError('import failed')
@@ -70,6 +174,8 @@ class Mixpanel(object):
 
     @staticmethod
     def write_items_to_csv(items, output_file):
+        if not len(items):
+            return
         if '$distinct_id' in items[0]:
             props_key = '$properties'
             initial_header_value = '$distinct_id'
@@ -78,11 +184,8 @@ class Mixpanel(object):
             initial_header_value = 'event'
 
         subkeys = set()
-        # returns a list of lists of property names from each item
-        columns = [item[props_key].keys() for item in items]
-        # flattens to a list of property names
-        columns = list(chain.from_iterable(columns))
-        subkeys.update(columns)
+        for item in items:
+            subkeys.update(item[props_key].keys())
         subkeys = sorted(subkeys)
 
         # Create the header
@@ -162,10 +265,19 @@ class Mixpanel(object):
     def list_from_items_filename(filename):
         item_list = []
         try:
-            with open(filename, 'rbU') as item_file:
+            with open_input(filename) as item_file:
                 item_list = json.load(item_file)
+            if isinstance(item_list, dict):
+                # NDJSON with a single item
+                item_list = [item_list]
         except ValueError:
-            with open(filename, 'rbU') as item_file:
+            try:
+                # NDJSON, as written by people_operation backups
+                with open_input(filename) as item_file:
+                    return [json.loads(line) for line in item_file if line.strip()]
+            except ValueError:
+                pass
+            with open_input(filename) as item_file:
                 reader = csv.reader(item_file, )
                 header = reader.next()
                 if 'event' in header:
@@ -193,36 +305,66 @@ class Mixpanel(object):
             shutil.copyfileobj(f_in, f_out)
 
     @staticmethod
-    def _export_data(data, output_file, format='json', compress=False):
-        with open(output_file, 'w+') as output:
+    def _export_data(data, output_file, format='json', compress=False, compress_level=None, compress_threads=1):
+        codec = compression_codec(compress)
+        if codec is not None:
+            output_file += COMPRESSION_EXTENSIONS[codec]
+        with closing(open_output(output_file, codec, compress_level, compress_threads)) as output:
             if format == 'json':
-                json.dump(data, output)
+                Mixpanel._dump_json(data, output)
             elif format == 'csv':
                 Mixpanel.write_items_to_csv(data, output)
             else:
                 msg = "Invalid format - must be 'json' or 'csv': format = " + str(format) + '\n' \
                       + "Dumping json to " + output_file
                 Mixpanel.logger.warning(msg)
-                json.dump(data, output)
+                Mixpanel._dump_json(data, output)
 
-        if compress:
-            Mixpanel.gzip_file(output_file)
-            os.remove(output_file)
+    @staticmethod
+    def _dump_json(data, output):
+        if isinstance(data, list):
+            json.dump(data, output, default=to_builtin)
+            return
+        # Write lazy sequences like spill.SpillList item by item rather than building the whole document in memory
+        output.write('[')
+        for i, item in enumerate(data):
+            output.write((', ' if i else '') + json.dumps(item, default=to_builtin))
+        output.write(']')
 
     @staticmethod
-    def _prep_event_for_import(event, token, timezone_offset):
+    def _prep_event_for_import(event, token, timezone_offset, invalid_events_sink=None):
         if ('time' not in event['properties']) or ('distinct_id' not in event['properties']):
-            Mixpanel.logger.warning('Event missing time or distinct_id property, dumping to invalid_events.txt')
-            with open('invalid_events.txt', 'a') as invalid:
-                json.dump(event, invalid)
-                invalid.write('\n')
-                return
-        event_copy = deepcopy(event)
-        event_copy['properties']['time'] = int(event['properties']['time']) - (
-            timezone_offset * 3600)  # transforms timestamp to UTC
+            Mixpanel._dump_invalid_event(event, 'Event missing time or distinct_id property', invalid_events_sink)
+            return
+        # transforms timestamp to UTC
+        utc_time = event['properties']['time']
+        if timezone_offset or not isinstance(utc_time, (int, long)) or isinstance(utc_time, bool) or \
+                utc_time > MILLISECONDS_THRESHOLD:
+            # Times from _import_data are already normalized UTC seconds, only other callers get here
+            utc_time = normalize_times([utc_time], timezone_offset)[0]
+        if utc_time is None:
+            Mixpanel._dump_invalid_event(event, 'Event time ' + repr(event['properties']['time']) +
+                                         " can't be parsed", invalid_events_sink)
+            return
+        if isinstance(event, CompactMapping):
+            event_copy = event.to_dict()
+        else:
+            event_copy = deepcopy(event)
+        event_copy['properties']['time'] = utc_time
         event_copy['properties']['token'] = token
         return event_copy
 
+    @staticmethod
+    def _dump_invalid_event(event, reason, invalid_events_sink=None):
+        if invalid_events_sink is not None:
+            Mixpanel.logger.warning(reason + ', dumping to ' + invalid_events_sink.filename)
+            invalid_events_sink.write([event])
+            return
+        Mixpanel.logger.warning(reason + ', dumping to invalid_events.txt')
+        with open('invalid_events.txt', 'a') as invalid:
+            json.dump(event, invalid, default=to_builtin)
+            invalid.write('\n')
+
     @staticmethod
     def _prep_params_for_profile(profile, token, operation, value, ignore_alias, dynamic):
         if dynamic:
@@ -245,9 +387,10 @@ class Mixpanel(object):
         dt = datetime.datetime.min
         try:
             last_seen = profile["$properties"]["$last_seen"]
-            try:
-                dt = ciso8601.parse_datetime_unaware(last_seen)
-            except NameError:
+            parsed = parse_iso(last_seen)
+            if parsed is not None:
+                dt = datetime.datetime.utcfromtimestamp(parsed[0])
+            else:
                 dt = datetime.datetime.strptime(last_seen, "%Y-%m-%dT%H:%M:%S")
         except KeyError:
             return dt
@@ -266,14 +409,26 @@ class Mixpanel(object):
 
     def _get_engage_page(self, params):
         response = self.request(Mixpanel.API_URL, ['engage'], params)
-        data = json.loads(response)
+        with self.profiler.stage('decode'):
+            data = json.loads(response)
         if 'results' in data:
             return data
         else:
             Mixpanel.logger.warning("Invalid response from /engage: " + response)
 
-    def _dispatch_batches(self, endpoint, item_list, prep_args):
-        pool = ThreadPool(processes=self.pool_size)
+    def _get_compact_engage_page(self, params):
+        data = self._get_engage_page(params)
+        if data is not None:
+            data['results'] = [Profile(profile) for profile in data['results']]
+        return data
+
+    def _dispatch_batches(self, endpoint, item_list, prep_args, backup=None, job=None):
+        if job is None:
+            job = ImportJob()
+        if self.worker_pool is not None:
+            pool = self.worker_pool
+        else:
+            pool = ThreadPool(processes=self.pool_size)
         batch = []
 
         if endpoint == 'import':
@@ -284,39 +439,141 @@ class Mixpanel(object):
             Mixpanel.logger.warning('endpoint must be "import" or "engage", found: ' + str(endpoint))
             return
 
-        for item in item_list:
-            prep_args[0] = item
-            params = prep_function(*prep_args)
-            if params:
-                batch.append(params)
-            if len(batch) == 50:
-                pool.apply_async(self._send_batch, args=(endpoint, batch), callback=Mixpanel.response_handler_callback)
-                batch = []
-        if len(batch):
-            pool.apply_async(self._send_batch, args=(endpoint, batch), callback=Mixpanel.response_handler_callback)
-        pool.close()
-        pool.join()
+        if prep_args is None:
+            # Items are already prepared, as when replaying failed batches from a dead-letter sink
+            prep_function, prep_args = (lambda item: item), [{}]
+
+        dedupe_filter = self.dedupe_filter if endpoint == 'import' else None
+        fingerprints = [] if dedupe_filter is not None else None
+        if dedupe_filter is not None:
+            # Events are only added to dedupe_filter once acknowledged, so failed batches can be replayed. Duplicates
+            # within this run are caught when they are queued, by a filter of the events queued so far.
+            queued = dedupe_filter.empty()
+
+        # Bound the batches waiting for a worker, so items are read from item_list only as fast as they are sent
+        slots = threading.BoundedSemaphore(self.pool_size * Mixpanel.PENDING_BATCHES_PER_WORKER)
+
+        try:
+            for item in item_list:
+                if backup is not None:
+                    backup.write(item)
+                prep_args[0] = item
+                with self.profiler.stage('prep'):
+                    params = prep_function(*prep_args)
+                    if params and dedupe_filter is not None:
+                        fingerprint = event_fingerprint(params)
+                        if fingerprint in dedupe_filter or fingerprint in queued:
+                            job.record('duplicates', 1)
+                            params = None
+                        else:
+                            queued.add(fingerprint)
+                            fingerprints.append(fingerprint)
+                if params:
+                    batch.append(params)
+                if len(batch) == self.batch_size:
+                    if backup is not None:
+                        # Don't send any update until its profile is safely in the backup file
+                        backup.wait()
+                    job.record('prepared', len(batch))
+                    slots.acquire()
+                    pool.apply_async(self._send_tracked_batch, args=(endpoint, batch, job, time.time(), slots,
+                                                                     fingerprints))
+                    batch = []
+                    fingerprints = [] if dedupe_filter is not None else None
+            if len(batch):
+                if backup is not None:
+                    backup.wait()
+                job.record('prepared', len(batch))
+                slots.acquire()
+                pool.apply_async(self._send_tracked_batch, args=(endpoint, batch, job, time.time(), slots,
+                                                                 fingerprints))
+        finally:
+            pool.close()
+            pool.join()
+            # Saved even if reading items failed, so a rerun skips every batch that was acknowledged
+            if dedupe_filter is not None and dedupe_filter.filename is not None:
+                dedupe_filter.save()
+            # Closed rather than flushed, so compressed sinks are complete files until the next write reopens them
+            self.invalid_events_sink.close()
+            self.failed_batches_sink.close()
+        self.profiler.finish_run()
+        return job
+
+    def _send_tracked_batch(self, endpoint, batch, job, submitted=None, slots=None, fingerprints=None):
+        # Runs on the worker pool, so every outcome is recorded on the job rather than raised where apply_async
+        # would swallow it
+        if submitted is not None:
+            self.profiler.record('queue', time.time() - submitted)
+        try:
+            with self.priority(BULK):
+                self._send_encoded_parts(endpoint, batch, job, fingerprints)
+        finally:
+            if slots is not None:
+                slots.release()
+
+    def _send_encoded_parts(self, endpoint, batch, job, fingerprints):
+        try:
+            with self.profiler.stage('encode'):
+                parts = EncodedBatch(batch).split(Mixpanel.MAX_BATCH_BYTES)
+        except Exception as e:
+            Mixpanel.logger.warning("Failed to encode batch of " + str(len(batch)) + " items: " + repr(e))
+            job.record('failed', len(batch), error=e)
+            return
+        start = 0
+        for part in parts:
+            self._send_tracked_part(endpoint, part, job, fingerprints[start:start + len(part)]
+                                    if fingerprints else None)
+            start += len(part)
+
+    def _send_tracked_part(self, endpoint, batch, job, fingerprints):
+        job.record('sent', len(batch))
+        try:
+            response = self._send_batch(endpoint, batch)
+            if response is None:
+                job.record('failed', len(batch))
+                return
+            Mixpanel.response_handler_callback(response)
+            job.record('acknowledged', len(batch))
+            if fingerprints:
+                # Only acknowledged events count as imported, so failed batches can still be replayed
+                self.dedupe_filter.update(fingerprints)
+                if self.dedupe_filter.filename is not None and \
+                        self.dedupe_filter.unsaved >= Mixpanel.DEDUPE_SAVE_INTERVAL * self.batch_size:
+                    # Save as the import goes, so a crashed run doesn't lose what was acknowledged
+                    self.dedupe_filter.save()
+        except Exception as e:
+            Mixpanel.logger.warning("Failed to send batch of " + str(len(batch)) + " items: " + repr(e))
+            job.record('failed', len(batch), error=e)
 
     def _send_batch(self, endpoint, batch, retries=0):
-        payload = {"data": base64.b64encode(json.dumps(batch)), "verbose": 1}
+        if not isinstance(batch, EncodedBatch):
+            with self.profiler.stage('encode'):
+                batch = EncodedBatch(batch)
         try:
-            response = self.request(Mixpanel.IMPORT_URL, [endpoint], payload, 'POST')
+            # Retries and the dead-letter dump reuse the body encoded above
+            response = self.request(Mixpanel.IMPORT_URL, [endpoint], batch.body, 'POST')
             msg = "Sent " + str(len(batch)) + " items on " + time.strftime("%Y-%m-%d %H:%M:%S") + "!"
             Mixpanel.logger.debug(msg)
             return response
         except urllib2.HTTPError as err:
-            if err.code == 503:
+            if err.code in (429, 503):
                 if retries < self.max_retries:
-                    Mixpanel.logger.warning("HTTP Error 503: Retry #" + str(retries + 1))
-                    self._send_batch(endpoint, batch, retries + 1)
+                    Mixpanel.logger.warning("HTTP Error " + str(err.code) + ": Retry #" + str(retries + 1))
+                    time.sleep(self._retry_delay(err, retries))
+                    return self._send_batch(endpoint, batch, retries + 1)
                 else:
-                    Mixpanel.logger.warning("Failed to import batch, dumping to file import_backup.txt")
-                    with open('import_backup.txt', 'a') as backup:
-                        json.dump(batch, backup)
-                        backup.write('\n')
+                    Mixpanel.logger.warning("Failed to import batch, dumping to file " +
+                                            self.failed_batches_sink.filename)
+                    self.failed_batches_sink.write(batch)
             else:
                 raise
 
+    def _retry_delay(self, err, retries):
+        retry_after = (err.hdrs or {}).get('Retry-After')
+        if retry_after is not None and retry_after.strip().isdigit():
+            return min(int(retry_after), self.RETRY_BACKOFF_MAX)
+        return random.uniform(0, min(self.RETRY_BACKOFF * 2 ** retries, self.RETRY_BACKOFF_MAX))
+
     def request(self, base_url, path_components, params, method='GET'):
         """
         Base method for sending HTTP requests to the various Mixpanel APIs
@@ -325,28 +582,70 @@ class Mixpanel(object):
         :type base_url: str
         :param path_components: endpoint path as list of strings
         :type path_components: list
-        :param params: dictionary containing the Mixpanel parameters for the API request
-        :type params: dict
+        :param params: dictionary containing the Mixpanel parameters for the API request, or for POST requests a
+        body that is already urlencoded
+        :type params: dict | str
         :param method: GET or POST
         :type method: str
         :return: JSON data returned from API
         """
-        if method == 'POST':
-            data = Mixpanel.unicode_urlencode(params)
-            request_url = '/'.join([base_url] + path_components) + '/'
-        else:
-            data = None
-            request_url = '/'.join(
-                [base_url, str(Mixpanel.VERSION)] + path_components) + '/?' + Mixpanel.unicode_urlencode(params)
+        request = self._build_request(base_url, path_components, params, method)
+        with self._request_slot('/'.join(path_components)):
+            return self._urlopen(request)
+
+    @contextmanager
+    def _request_slot(self, endpoint=None, stream=False):
+        # Holds a request's place in the priority limiter and the AIMD window, both released when the block ends, so
+        # a streamed response keeps its slot until it is read to the end or closed. A stream's duration depends on
+        # its size, so it isn't counted as a latency. Server errors and failed connections cut the window like a 429
+        # does, so it never grows while the API is failing.
+        priority = self.current_priority
+        if self.priorities is not None:
+            self.priorities.acquire(priority)
+        try:
+            if self.concurrency is None:
+                yield
+                return
+            started = self.concurrency.acquire()
+            overloaded = False
+            try:
+                yield
+            except urllib2.HTTPError as err:
+                overloaded = err.code == 429 or err.code >= 500
+                raise
+            except (urllib2.URLError, socket.error, httplib.HTTPException):
+                overloaded = True
+                raise
+            finally:
+                self.concurrency.release(started, overloaded, endpoint, measure_latency=not stream)
+        finally:
+            if self.priorities is not None:
+                self.priorities.release(priority)
+
+    def _build_request(self, base_url, path_components, params, method='GET'):
+        with self.profiler.stage('encode'):
+            if method == 'POST':
+                data = params if isinstance(params, str) else Mixpanel.unicode_urlencode(params)
+                request_url = '/'.join([base_url] + path_components) + '/'
+            else:
+                data = None
+                request_url = '/'.join(
+                    [base_url, str(Mixpanel.VERSION)] + path_components) + '/?' + Mixpanel.unicode_urlencode(params)
         Mixpanel.logger.debug("Request URL: " + request_url)
         headers = {'Authorization': 'Basic {encoded_secret}'.format(encoded_secret=base64.b64encode(self.api_secret))}
-        request = urllib2.Request(request_url, data, headers)
-        response = urllib2.urlopen(request, timeout=self.timeout)
-        response_data = response.read()
+        return urllib2.Request(request_url, data, headers)
+
+    def _urlopen(self, request, timeout=None, stream=False):
+        with self.profiler.stage('network'):
+            response = urllib2.urlopen(request, timeout=timeout or self.timeout)
+            if stream:
+                # The caller reads and closes the response
+                return response
+            response_data = response.read()
         return response_data
 
     def people_operation(self, operation, value, profiles=None, query_params=None, ignore_alias=False, backup=False,
-                         backup_file=None):
+                         backup_file=None, job=None, output_properties=None):
         """
         Base method for performing any of the People analytics operations
 
@@ -354,34 +653,58 @@ class Mixpanel(object):
         :type operation: str
         :param value: can be a static value applied to all profiles or a user-defined function (or lambda) that takes a
         profile as its only parameter and returns the value to use for the operation on the given profile
-        :param profiles: can be a Python list of profiles or the name of a file containing a json array dump of profiles
+        :param profiles: can be a Python list of profiles, the name of a file containing a json array dump of profiles
+        or an iterator of profiles, which is consumed as updates are sent
         :param query_params: params to query engage with (alternative to supplying the profiles param)
         :param ignore_alias: True or False
         :type ignore_alias: bool
         :param backup: True to create backup file otherwise False (default)
         :type backup: bool
+        :param backup_file: name of the NDJSON backup file, written in the background as profiles are fetched and
+        gzip compressed if it ends in .gz. Each update is only sent once its profile has been flushed to this file.
+        :param output_properties: list of the profile properties `value` needs, so profiles queried from engage only
+        include those. Ignored when backup is True, because backups need complete profiles. With a static value and no
+        backup, profiles are fetched with MINIMAL_OUTPUT_PROPERTIES.
+        :type output_properties: list
         """
         assert self.token, "Project token required for People operation!"
         if profiles is not None and query_params is not None:
             Mixpanel.logger.warning("profiles and query_params both provided, please use one or the other")
             return
 
+        dynamic = isfunction(value)
+        if backup:
+            output_properties = None
+        elif output_properties is None and not dynamic:
+            output_properties = Mixpanel.MINIMAL_OUTPUT_PROPERTIES
+
         if profiles:
-            profiles_list = Mixpanel.list_from_argument(profiles)
-        elif query_params is not None:
-            profiles_list = self.query_engage(query_params)
+            profiles_list = Mixpanel.iter_from_argument(profiles)
         else:
-            profiles_list = self.query_engage()
+            with self.priority(BULK):
+                profiles_list = self.iter_engage(query_params or {}, output_properties=output_properties)
 
+        backup_writer = None
         if backup:
             if backup_file is None:
-                backup_file = "backup_" + str(int(time.time())) + ".json"
-            self._export_data(profiles_list, backup_file)
+                backup_file = "backup_" + str(int(time.time())) + ".json.gz"
+            backup_writer = BackupWriter(backup_file)
 
-        dynamic = isfunction(value)
-        self._dispatch_batches('engage', profiles_list, [{}, self.token, operation, value, ignore_alias, dynamic])
+        try:
+            return self._dispatch_batches('engage', profiles_list,
+                                          [{}, self.token, operation, value, ignore_alias, dynamic],
+                                          backup=backup_writer, job=job)
+        finally:
+            if backup_writer is not None:
+                backup_writer.close()
 
     def people_delete(self, profiles=None, query_params=None, backup=True, backup_file=None):
+        """
+        Delete the profiles, or those matching query_params
+
+        With backup=True (the default) complete profiles are fetched from engage, so the backup file can restore them.
+        Pass backup=False to only fetch the MINIMAL_OUTPUT_PROPERTIES needed to delete each profile.
+        """
         self.people_operation('$delete', '', profiles=profiles, query_params=query_params, ignore_alias=True,
                               backup=backup, backup_file=backup_file)
 
@@ -420,7 +743,8 @@ class Mixpanel(object):
         if profiles is None and query_params is None:
             query_params = {'selector': '(defined (properties["' + old_name + '"]))'}
         self.people_operation('$set', lambda p: {new_name: p['$properties'][old_name]}, query_params=query_params,
-                              ignore_alias=ignore_alias, backup=backup, backup_file=backup_file)
+                              ignore_alias=ignore_alias, backup=backup, backup_file=backup_file,
+                              output_properties=[old_name])
         if unset:
             self.people_operation('$unset', [old_name], profiles=profiles, query_params=query_params, backup=False)
 
@@ -430,20 +754,28 @@ class Mixpanel(object):
             query_params = {'selector': '(defined (properties["$transactions"]))'}
 
         self.people_operation('$set', Mixpanel.sum_transactions, profiles=profiles, query_params=query_params,
-                              ignore_alias=ignore_alias, backup=backup, backup_file=backup_file)
+                              ignore_alias=ignore_alias, backup=backup, backup_file=backup_file,
+                              output_properties=['$transactions'])
 
     def deduplicate_people(self, profiles=None, prop_to_match='$email', merge_props=False, case_sensitive=False):
         main_reference = {}
         update_profiles = []
         delete_profiles = []
 
-        if profiles is not None:
+        if isinstance(profiles, SQLiteStore):
+            # Let the database's GROUP BY find the duplicates rather than loading every profile
+            profiles_list = profiles.duplicate_profiles(prop_to_match, case_sensitive)
+        elif profiles is not None:
             profiles_list = Mixpanel.list_from_argument(profiles)
         else:
             selector = '(boolean(properties["' + prop_to_match + '"]) == true)'
-            profiles_list = self.query_engage({'where': selector})
+            # Merging needs every property of the duplicates, otherwise only the match and sort keys are used
+            output_properties = None if merge_props else [prop_to_match, '$last_seen']
+            profiles_list = self.query_engage({'where': selector}, output_properties=output_properties)
 
-        for profile in profiles_list:
+        # Only the position, $distinct_id and $last_seen of each profile are kept, so profiles spilled to disk by
+        # query_engage stay there
+        for index, profile in enumerate(profiles_list):
             try:
                 if case_sensitive:
                     match_prop = str(profile["$properties"][prop_to_match])
@@ -455,67 +787,428 @@ class Mixpanel(object):
             if not main_reference.get(match_prop):
                 main_reference[match_prop] = []
 
-            main_reference[match_prop].append(profile)
+            last_seen = profile['$properties'].get('$last_seen')
+            main_reference[match_prop].append((index, profile['$distinct_id'], last_seen))
 
+        groups = []
         for matching_prop, matching_profiles in main_reference.iteritems():
             if len(matching_profiles) > 1:
-                matching_profiles.sort(key=lambda dupe: Mixpanel.dt_from_iso(dupe))
-                # We create a $delete update for each duplicate profile and at the same time create a
-                # $set_once update for the keeper profile by working through duplicates oldest to newest
-                if merge_props:
-                    prop_update = {"$distinct_id": matching_profiles[-1]["$distinct_id"], "$properties": {}}
-                for x in xrange(len(matching_profiles) - 1):
-                    delete_profiles.append({'$distinct_id': matching_profiles[x]['$distinct_id']})
-                    if merge_props:
-                        prop_update["$properties"].update(matching_profiles[x]["$properties"])
-                if merge_props and "$last_seen" in prop_update["$properties"]:
-                    del prop_update["$properties"]["$last_seen"]
-                if merge_props:
-                    update_profiles.append(prop_update)
+                # Parse every $last_seen of the group in one batch, once per profile, rather than once per comparison
+                last_seen = normalize_times([dupe[2] for dupe in matching_profiles])
+                order = sorted(range(len(matching_profiles)),
+                               key=lambda i: last_seen[i] if last_seen[i] is not None else float('-inf'))
+                groups.append([matching_profiles[i] for i in order])
+        main_reference.clear()
+
+        # We create a $delete update for each duplicate profile and, when merging, a $set_once update for the keeper
+        # profile by working through duplicates oldest to newest
+        for group in groups:
+            for index, distinct_id, last_seen in group[:-1]:
+                delete_profiles.append({'$distinct_id': distinct_id})
+        if merge_props:
+            # Read the properties of only the duplicates in a second pass
+            duplicates = set(index for group in groups for index, distinct_id, last_seen in group[:-1])
+            duplicate_properties = dict((index, profile['$properties']) for index, profile in enumerate(profiles_list)
+                                        if index in duplicates)
+            for group in groups:
+                prop_update = {"$distinct_id": group[-1][1], "$properties": {}}
+                for index, distinct_id, last_seen in group[:-1]:
+                    prop_update["$properties"].update(duplicate_properties[index])
+                prop_update["$properties"].pop("$last_seen", None)
+                update_profiles.append(prop_update)
+        if profiles is None and isinstance(profiles_list, SpillList):
+            profiles_list.close()
 
         if merge_props:
             self.people_operation('$set_once', lambda p: p['$properties'], profiles=update_profiles, ignore_alias=True)
 
         self.people_operation('$delete', '', profiles=delete_profiles, ignore_alias=True)
 
-    def query_export(self, params):
+    def sync_people(self, profiles, snapshot=None, unset_removed=True, ignore_alias=False, job=None):
+        """
+        Make People profiles match `profiles`, sending only what differs from their current state: changed and new
+        properties are $set and, with unset_removed, custom properties missing from the desired profile are $unset.
+        Profiles that already match are skipped (counted in the job's `unchanged`).
+
+        :param profiles: the desired profiles, as accepted by people_operation
+        :param snapshot: current state of the profiles: a sqlite_store.SQLiteStore (e.g. from export_people with
+        format='sqlite'), which is brought up to date when every update is acknowledged, or a list or file of
+        profiles. By default every profile is fetched from engage.
+        :param unset_removed: True to $unset properties that are not in the desired profile. Properties starting with
+        $ are never unset, because Mixpanel sets many of them itself.
+        :return: jobs.ImportJob
+        """
+        assert self.token, "Project token required for People operation!"
+        if job is None:
+            job = ImportJob()
+        if isinstance(snapshot, SQLiteStore):
+            current_properties = snapshot.get_properties
+        else:
+            if snapshot is None:
+                with self.priority(BULK):
+                    snapshot = self.iter_engage(compact=True)
+            else:
+                snapshot = Mixpanel.iter_from_argument(snapshot)
+            current = dict((profile['$distinct_id'], profile['$properties']) for profile in snapshot)
+            current_properties = current.get
+        synced = []
+
+        def updates():
+            for profile in Mixpanel.iter_from_argument(profiles):
+                distinct_id = profile['$distinct_id']
+                desired = profile['$properties']
+                existing = current_properties(distinct_id) or {}
+                changed, removed = Mixpanel._diff_properties(desired, existing, unset_removed)
+                if not changed and not removed:
+                    job.record('unchanged', 1)
+                    continue
+                if changed:
+                    yield Mixpanel._prep_params_for_profile(profile, self.token, '$set', changed, ignore_alias, False)
+                if removed:
+                    yield Mixpanel._prep_params_for_profile(profile, self.token, '$unset', removed, ignore_alias,
+                                                            False)
+                if isinstance(snapshot, SQLiteStore):
+                    properties = dict(existing.items())
+                    properties.update(changed)
+                    for name in removed:
+                        del properties[name]
+                    synced.append({'$distinct_id': distinct_id, '$properties': properties})
+
+        self._dispatch_batches('engage', updates(), None, job=job)
+        if synced and not job.failed:
+            snapshot.insert_profiles(synced)
+        return job
+
+    @staticmethod
+    def _diff_properties(desired, existing, unset_removed=True):
+        changed = dict((name, value) for name, value in desired.items()
+                       if name not in existing or existing.get(name) != value)
+        removed = []
+        if unset_removed:
+            removed = [name for name in existing if name not in desired and not name.startswith('$')]
+        return changed, removed
+
+    def query_export(self, params, compact=False):
+        """
+        Query the raw data export API
+
+        :param params: dictionary containing the /export parameters
+        :type params: dict
+        :param compact: True to return read-only records.Event objects, which share property names and common values
+        between events, instead of dicts
+        :type compact: bool
+        :return: list of events
+        """
         response = self.request(Mixpanel.DATA_URL, ['export'], params)
         file_like_object = cStringIO.StringIO(response)
         raw_data = file_like_object.getvalue().split('\n')
         raw_data.pop()
         events = []
-        for line in raw_data:
-            events.append(json.loads(line))
+        with self.profiler.stage('decode'):
+            for line in raw_data:
+                event = json.loads(line)
+                events.append(Event(event) if compact else event)
         return events
 
-    def query_engage(self, params={}):
-        paginator = ConcurrentPaginator(self._get_engage_page, concurrency=self.pool_size)
-        return paginator.fetch_all(params)
+    def iter_export(self, params, compact=False):
+        """
+        Stream events from the raw data export API, parsing each line as it arrives instead of reading the whole
+        response into memory. Takes the same arguments as query_export.
+        """
+        # Like export_events, allow 15 minutes unless the timeout was changed from the default
+        timeout = 900 if self.timeout == 120 else self.timeout
+        request = self._build_request(Mixpanel.DATA_URL, ['export'], params)
+        with self._request_slot('export', stream=True):
+            response = self._urlopen(request, timeout=timeout, stream=True)
+            try:
+                for line in self.profiler.iter_stage('network', response):
+                    if line.strip():
+                        event = json.loads(line)
+                        yield Event(event) if compact else event
+            finally:
+                response.close()
+
+    def query_engage(self, params={}, compact=False, output_properties=None, memory_budget=None, partitions=None):
+        """
+        Query the People API for every profile matching `params`
+
+        :param params: dictionary containing the /engage parameters
+        :type params: dict
+        :param compact: True to return read-only records.Profile objects instead of dicts
+        :type compact: bool
+        :param output_properties: list of property names to fetch for each profile instead of every property. Sent
+        as engage's output_properties parameter unless params already has one.
+        :type output_properties: list
+        :param memory_budget: approximate number of bytes of profiles to hold in memory. Beyond it, profiles are
+        spilled to compressed files on disk and a spill.SpillList is returned instead of a list. Defaults to the
+        client's memory_budget.
+        :type memory_budget: int
+        :param partitions: list of disjoint selectors covering the People table, e.g.
+        paginator.range_selectors('$last_seen', ['2016-01-01', '2016-04-01']). Each partition is fetched as its own
+        engage session, several at a time, and a partition that fails is restarted on its own. Profiles are returned
+        partition by partition rather than in engage's order.
+        :type partitions: list
+        :return: list of profiles
+        """
+        if memory_budget is None:
+            memory_budget = self.memory_budget
+        if memory_budget is not None:
+            profiles = SpillList(memory_budget, wrap=Profile if compact else None)
+            profiles.extend(self.iter_engage(params, compact=compact, output_properties=output_properties,
+                                             partitions=partitions))
+            return profiles
+        paginator = self._engage_paginator(compact, partitions)
+        return paginator.fetch_all(Mixpanel._project_engage_params(params, output_properties))
+
+    def iter_engage(self, params={}, compact=False, output_properties=None, partitions=None):
+        paginator = self._engage_paginator(compact, partitions)
+        return paginator.iter_all(Mixpanel._project_engage_params(params, output_properties))
+
+    def _engage_paginator(self, compact, partitions):
+        # Pages are fetched on the worker pool if there is one, so they count against its (e.g. a FairScheduler's)
+        # budget like import batches
+        if partitions is None:
+            return ConcurrentPaginator(self._engage_page_func(compact), concurrency=self.pool_size,
+                                       pool=self.worker_pool)
+        return PartitionedPaginator(self._engage_page_func(compact), partitions, concurrency=self.pool_size,
+                                    logger=Mixpanel.logger, pool=self.worker_pool)
+
+    @staticmethod
+    def _project_engage_params(params, output_properties):
+        if output_properties is None or 'output_properties' in params:
+            return params
+        params = dict(params)
+        params['output_properties'] = list(output_properties)
+        return params
 
-    def export_events(self, output_file, params, format='json', compress=False):
+    def _engage_page_func(self, compact):
+        page_func = self._get_compact_engage_page if compact else self._get_engage_page
+        if self.priorities is None:
+            return page_func
+        # Pages are fetched on the paginator's threads, so carry over the priority of the thread that asked for them
+        priority = self.current_priority
+
+        def prioritized_page_func(params):
+            with self.priority(priority):
+                return page_func(params)
+        return prioritized_page_func
+
+    def export_events(self, output_file, params, format='json', compress=False, compress_level=None,
+                      compress_threads=1):
         # Increase timeout to 15 minutes if it's still set to default
         if self.timeout == 120:
             self.timeout = 900
+        if format == 'sqlite':
+            # Stream straight into the database instead of holding the whole export in memory
+            with SQLiteStore(output_file) as store:
+                self._write_to_store(store.insert_events, self.iter_export(params), store.batch_size)
+            self.profiler.finish_run()
+            return
         events = self.query_export(params)
-        Mixpanel._export_data(events, output_file, format=format, compress=compress)
+        with self.profiler.stage('write'):
+            Mixpanel._export_data(events, output_file, format=format, compress=compress,
+                                  compress_level=compress_level, compress_threads=compress_threads)
+        self.profiler.finish_run()
+
+    def _write_to_store(self, insert, items, batch_size):
+        # Only the inserts are timed as 'write', so fetching the items is left to the 'network' stage
+        items = iter(items)
+        while True:
+            batch = list(islice(items, batch_size))
+            if not batch:
+                return
+            with self.profiler.stage('write'):
+                insert(batch)
+
+    def export_people(self, output_file, params={}, format='json', compress=False, compress_level=None,
+                      compress_threads=1, partitions=None):
+        if format == 'sqlite':
+            with SQLiteStore(output_file) as store:
+                self._write_to_store(store.insert_profiles, self.iter_engage(params, partitions=partitions),
+                                     store.batch_size)
+            self.profiler.finish_run()
+            return
+        profiles = self.query_engage(params, partitions=partitions)
+        with self.profiler.stage('write'):
+            Mixpanel._export_data(profiles, output_file, format=format, compress=compress,
+                                  compress_level=compress_level, compress_threads=compress_threads)
+        if isinstance(profiles, SpillList):
+            profiles.close()
+        self.profiler.finish_run()
+
+    def update_people_snapshot(self, snapshot, params={}, watermark='$last_seen', overlap=3600, full_refresh=False,
+                               partitions=None):
+        """
+        Bring a local snapshot of People profiles up to date, fetching only the profiles whose `watermark` property
+        changed since the last successful update
+
+        :param snapshot: sqlite_store.SQLiteStore, or the filename of one, keyed by $distinct_id
+        :param params: dictionary containing the /engage parameters. Its where is and-ed with the watermark
+        selector, so it should be the same on every run.
+        :param watermark: profile property holding an ISO-8601 time that is updated when the profile changes
+        :param overlap: seconds before the start of the last update to fetch from, so profiles updated while it ran
+        or stamped with a skewed clock aren't missed
+        :param full_refresh: True to fetch every profile and replace the snapshot's profiles with them, e.g.
+        periodically to drop deleted profiles, which an incremental update can't see. The first run is always a full
+        refresh.
+        :param partitions: as for query_engage
+        :return: list (or spill.SpillList) of the profiles fetched, which have been merged into the snapshot
+        """
+        if not isinstance(snapshot, SQLiteStore):
+            with SQLiteStore(snapshot) as store:
+                return self.update_people_snapshot(store, params, watermark, overlap, full_refresh, partitions)
+        key = 'people_watermark:' + watermark
+        since = None if full_refresh else snapshot.get_metadata(key)
+        if since is not None:
+            selector = 'properties[%s] >= %s' % (json.dumps(watermark), json.dumps(since))
+            params = dict(params, where='(%s) and (%s)' % (params['where'], selector) if params.get('where')
+                          else selector)
+        started = datetime.datetime.utcnow()
+        changed = self.query_engage(params, partitions=partitions)
+        with self.profiler.stage('write'):
+            if since is None:
+                # Every profile was fetched, so those missing from the snapshot's result have been deleted
+                snapshot.replace_profiles(changed)
+            else:
+                snapshot.insert_profiles(changed)
+        # Only advance the watermark once every changed profile is stored, so a failed run is fetched again
+        snapshot.set_metadata(key, (started - datetime.timedelta(seconds=overlap)).strftime('%Y-%m-%dT%H:%M:%S'))
+        return changed
+
+    def export_people_incremental(self, output_file, snapshot, params={}, format='json', compress=False,
+                                  compress_level=None, compress_threads=1, delta=False, watermark='$last_seen',
+                                  overlap=3600, full_refresh=False, partitions=None):
+        """
+        Export People profiles from a local snapshot updated with update_people_snapshot, so each run only fetches
+        the profiles that changed since the last one
 
-    def export_people(self, output_file, params={}, format='json', compress=False):
-        profiles = self.query_engage(params)
-        Mixpanel._export_data(profiles, output_file, format=format, compress=compress)
+        :param delta: True to write only the profiles fetched by this run instead of every profile in the snapshot
+        """
+        if not isinstance(snapshot, SQLiteStore):
+            with SQLiteStore(snapshot) as store:
+                return self.export_people_incremental(output_file, store, params, format, compress, compress_level,
+                                                      compress_threads, delta, watermark, overlap, full_refresh,
+                                                      partitions)
+        changed = self.update_people_snapshot(snapshot, params, watermark, overlap, full_refresh, partitions)
+        profiles = changed
+        if not delta:
+            profiles = SpillList(self.memory_budget) if self.memory_budget is not None else []
+            profiles.extend(snapshot.iter_profiles())
+        with self.profiler.stage('write'):
+            if format == 'sqlite':
+                with SQLiteStore(output_file) as store:
+                    store.insert_profiles(profiles)
+            else:
+                Mixpanel._export_data(profiles, output_file, format=format, compress=compress,
+                                      compress_level=compress_level, compress_threads=compress_threads)
+        for spilled in (changed, profiles):
+            if isinstance(spilled, SpillList):
+                spilled.close()
+        self.profiler.finish_run()
+
+    def import_events(self, data, timezone_offset=0, parse_processes=None):
+        """
+        :param timezone_offset: hours from UTC of the times in `data`, or a timezone name like 'America/New_York' to
+        follow its DST changes. Times can be epoch seconds or milliseconds or ISO-8601 strings.
+        """
+        return self._import_data(data, 'import', timezone_offset=timezone_offset, parse_processes=parse_processes)
 
-    def import_events(self, data, timezone_offset=0):
-        self._import_data(data, 'import', timezone_offset=timezone_offset)
+    def import_people(self, data, ignore_alias=False, parse_processes=None):
+        return self._import_data(data, 'engage', ignore_alias=ignore_alias, parse_processes=parse_processes)
 
-    def import_people(self, data, ignore_alias=False):
-        self._import_data(data, 'engage', ignore_alias=ignore_alias)
+    def import_events_async(self, data, timezone_offset=0, parse_processes=None):
+        """
+        Start import_events on a background thread and return a jobs.ImportJob for tracking its progress
+        """
+        return ImportJob.start(self._import_data, data, 'import', timezone_offset=timezone_offset,
+                               parse_processes=parse_processes)
 
-    def _import_data(self, data, endpoint, timezone_offset=0, ignore_alias=False):
+    def import_people_async(self, data, ignore_alias=False, parse_processes=None):
+        """
+        Start import_people on a background thread and return a jobs.ImportJob for tracking its progress
+        """
+        return ImportJob.start(self._import_data, data, 'engage', ignore_alias=ignore_alias,
+                               parse_processes=parse_processes)
+
+    def people_operation_async(self, operation, value, **kwargs):
+        """
+        Start people_operation on a background thread and return a jobs.ImportJob for tracking its progress
+        """
+        return ImportJob.start(self.people_operation, operation, value, **kwargs)
+
+    @staticmethod
+    def iter_from_argument(arg, parse_processes=None):
+        """
+        Like list_from_argument, but when `parse_processes` is set a filename is parsed in chunks on that many
+        processes and items are yielded as chunks are parsed. Use 0 for one process per CPU. Iterables other than
+        lists are returned as they are.
+        """
+        if parse_processes is not None and isinstance(arg, basestring):
+            return iter_items_from_file(arg, processes=parse_processes)
+        if not isinstance(arg, (basestring, list)) and hasattr(arg, '__iter__'):
+            # Any other iterable, like a generator or a pipeline.Pipeline, is consumed lazily
+            return arg
+        return Mixpanel.list_from_argument(arg)
+
+    def _import_data(self, data, endpoint, timezone_offset=0, ignore_alias=False, parse_processes=None, job=None):
         assert self.token, "Project token required for import!"
-        item_list = Mixpanel.list_from_argument(data)
+        with self.profiler.stage('parse'):
+            item_list = Mixpanel.iter_from_argument(data, parse_processes)
+        if not isinstance(item_list, list):
+            item_list = self.profiler.iter_stage('parse', item_list)
         args = [{}, self.token]
         if endpoint == 'import':
-            args.append(timezone_offset)
+            # Convert times to UTC a chunk at a time, so prep only has to copy them
+            item_list = self.profiler.iter_stage('normalize', normalize_event_times(item_list, timezone_offset))
+            args.extend([0, self.invalid_events_sink])
         elif endpoint == 'engage':
             args.extend(['$set', lambda profile: profile['$properties'], ignore_alias, True])
 
-        self._dispatch_batches(endpoint, item_list, args)
+        return self._dispatch_batches(endpoint, item_list, args, job=job)
+
+    def replay_dead_letters(self, sink, timezone_offset=0):
+        """
+        Send the items collected by a dead-letter sink again, e.g. after fixing invalid events or once the API has
+        recovered from the errors that failed a batch
+
+        Raw events (like those in invalid_events_sink) go through import_events with `timezone_offset`. Items from
+        failed batches were already prepared, so they are sent again as they are. While replaying, the sink's file is
+        renamed to a <filename>.replaying-<time> file, so items that fail again are collected in a fresh file, and
+        it is removed once every item has been dispatched. Replay files left behind by a replay that was interrupted
+        are replayed first.
+
+        :param sink: a writers.DeadLetterSink, such as self.invalid_events_sink or self.failed_batches_sink
+        :type sink: DeadLetterSink
+        """
+        assert self.token, "Project token required for import!"
+        # Keep the compression extension last, so the replay files are read with the right codec
+        extension = COMPRESSION_EXTENSIONS[sink.codec] if sink.codec is not None else ''
+        base = sink.filename[:len(sink.filename) - len(extension)]
+        replay_files = sorted(glob.glob(base + '.replaying-*' + extension))
+        if os.path.exists(sink.filename):
+            sink.close()
+            stamp = int(time.time() * 1000)
+            while os.path.exists('%s.replaying-%d%s' % (base, stamp, extension)):
+                stamp += 1
+            replay_file = '%s.replaying-%d%s' % (base, stamp, extension)
+            os.rename(sink.filename, replay_file)
+            replay_files.append(replay_file)
+
+        for replay_file in replay_files:
+            items = DeadLetterSink(replay_file, sink.format, sink.codec).read()
+            raw_events = [item for item in items if 'event' in item and 'token' not in item['properties']]
+            prepared_events = [item for item in items if 'event' in item and 'token' in item['properties']]
+            prepared_updates = [item for item in items if 'event' not in item]
+            if raw_events:
+                self.import_events(raw_events, timezone_offset=timezone_offset)
+            if prepared_events:
+                self._dispatch_batches('import', prepared_events, None)
+            if prepared_updates:
+                self._dispatch_batches('engage', prepared_updates, None)
+            os.remove(replay_file)
+
+
+if __name__ == '__main__':
+    import sys
+    from cli import main
+    sys.exit(main())
@@ -25,8 +25,13 @@ Author: Sean Coonce - https://github.com/cooncesean
 Github repo: https://github.com/cooncesean/mixpanel-query-py
 """
 
+import json
 import math
 import itertools
+import sys
+import Queue
+import threading
+from collections import deque
 from multiprocessing.pool import ThreadPool
 
 
@@ -39,10 +44,13 @@ class ConcurrentPaginator(object):
     pagination.
     """
 
-    def __init__(self, get_func, concurrency=20):
+    def __init__(self, get_func, concurrency=20, pool=None):
         """
         Initialize with a function that fetches a page of results.
         `concurrency` controls the number of threads used to fetch pages.
+        With a `pool` (an object with ThreadPool's apply_async method, such
+        as a projects.ProjectQueue) every page is fetched on the pool instead,
+        with at most `concurrency` pages queued or in flight at once.
 
         Example:
             client = MixpanelQueryClient(...)
@@ -50,6 +58,7 @@ class ConcurrentPaginator(object):
         """
         self.get_func = get_func
         self.concurrency = concurrency
+        self.pool = pool
 
     def fetch_all(self, params=None):
         """
@@ -60,14 +69,48 @@ class ConcurrentPaginator(object):
         """
         params = params and params.copy() or {}
 
-        first_page = self.get_func(params)
+        first_page = self._first_page(params)
         results = first_page['results']
         params['session_id'] = first_page['session_id']
 
         start, end = self._remaining_page_range(first_page)
         fetcher = self._results_fetcher(params)
+        if self.pool is not None:
+            return results + list(itertools.chain(*_imap(self.pool, fetcher, range(start, end), self.concurrency)))
         return results + self._concurrent_flatmap(fetcher, list(range(start, end)))
 
+    def iter_all(self, params=None):
+        """
+        Fetch all results from all pages, yielding each result as soon as its
+        page arrives instead of collecting every page into one list.
+
+        Pages are still fetched concurrently, at most `concurrency` pages
+        ahead of the consumer, and are yielded in page order.
+        """
+        params = params and params.copy() or {}
+
+        first_page = self._first_page(params)
+        for result in first_page['results']:
+            yield result
+        params['session_id'] = first_page['session_id']
+
+        start, end = self._remaining_page_range(first_page)
+        fetcher = self._results_fetcher(params)
+        # At most `concurrency` pages are fetched ahead of the consumer, so memory stays bounded
+        pool = self.pool if self.pool is not None else ThreadPool(processes=self.concurrency)
+        try:
+            for results in _imap(pool, fetcher, range(start, end), self.concurrency):
+                for result in results:
+                    yield result
+        finally:
+            if self.pool is None:
+                pool.terminate()
+
+    def _first_page(self, params):
+        if self.pool is not None:
+            return _PoolTask(self.pool, self.get_func, (params,)).get()
+        return self.get_func(params)
+
     def _results_fetcher(self, params):
         def _fetcher_func(page):
             req_params = dict(list(params.iteritems()) + [('page', page)])
@@ -82,3 +125,155 @@ class ConcurrentPaginator(object):
         num_pages = math.ceil(response['total'] / float(response['page_size']))
         return response['page'] + 1, int(num_pages)
 
+
+class PartitionedPaginator(object):
+    """
+    Fetches a paginated collection as independent partitions, each one its
+    own paginated session.
+
+    `partitions` is a list of disjoint selectors (e.g. from range_selectors)
+    that together cover the collection. Each is and-ed with the `where`
+    param, if any, and fetched with a ConcurrentPaginator, several
+    partitions at a time. A partition that fails (e.g. because its session
+    expired) is restarted from its first page up to `max_restarts` times,
+    without refetching the partitions that succeeded.
+
+    With a `pool` every page is fetched on it (see ConcurrentPaginator), and
+    the partitions' own threads only wait for their pages.
+    """
+
+    def __init__(self, get_func, partitions, concurrency=20, partition_concurrency=4, max_restarts=3, logger=None,
+                 pool=None):
+        self.get_func = get_func
+        self.pool = pool
+        self.partitions = list(partitions)
+        self.concurrency = concurrency
+        self.partition_concurrency = partition_concurrency
+        self.max_restarts = max_restarts
+        self.logger = logger
+
+    def fetch_all(self, params=None):
+        """
+        Fetch all results from all partitions, and return as a list.
+        """
+        return list(self.iter_all(params))
+
+    def iter_all(self, params=None):
+        """
+        Fetch all results from all partitions, yielding each partition's
+        results once the whole partition has been fetched, so no result is
+        yielded twice if a partition is restarted. Partitions are yielded in
+        the order they finish, and no more than partition_concurrency of them
+        are fetched ahead of the consumer.
+        """
+        concurrency = min(self.partition_concurrency, len(self.partitions)) or 1
+        pool = ThreadPool(processes=concurrency)
+        try:
+            for results in _imap_unordered(pool, self._partition_fetcher(params), self.partitions, concurrency):
+                for result in results:
+                    yield result
+        finally:
+            pool.terminate()
+
+    def _partition_fetcher(self, params):
+        params = params and params.copy() or {}
+        where = params.get('where')
+        page_concurrency = max(1, self.concurrency // max(1, min(self.partition_concurrency, len(self.partitions))))
+
+        def _fetcher_func(selector):
+            req_params = dict(params, where=selector if not where else '(%s) and (%s)' % (where, selector))
+            restarts = 0
+            while True:
+                try:
+                    return ConcurrentPaginator(self.get_func, page_concurrency, self.pool).fetch_all(req_params)
+                except Exception as e:
+                    if restarts >= self.max_restarts:
+                        raise
+                    restarts += 1
+                    if self.logger is not None:
+                        self.logger.warning('Restarting partition %s after %r (restart %d of %d)' %
+                                            (selector, e, restarts, self.max_restarts))
+        return _fetcher_func
+
+
+class _PoolTask(object):
+    # A call run with apply_async on a worker pool. A projects.ProjectQueue only logs the exceptions of its tasks, so
+    # they are caught here and raised again by get.
+
+    def __init__(self, pool, func, args, finished=None):
+        self._done = threading.Event()
+        self._result = self._error = None
+        self._finished = finished
+        pool.apply_async(self._run, (func, args))
+
+    def _run(self, func, args):
+        try:
+            self._result = func(*args)
+        except Exception:
+            self._error = sys.exc_info()
+        finally:
+            self._done.set()
+            if self._finished is not None:
+                self._finished.put(self)
+
+    def get(self):
+        while not self._done.wait(1):
+            pass
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+
+def _imap(pool, func, items, window):
+    # Like ThreadPool.imap on a shared worker pool, with at most `window` calls queued or running at once
+    pending = deque()
+    for item in items:
+        pending.append(_PoolTask(pool, func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _imap_unordered(pool, func, items, window):
+    # Like ThreadPool.imap_unordered, but only `window` calls are queued, running or finished and not yet consumed
+    finished = Queue.Queue()
+    items = iter(items)
+    pending = 0
+    for item in itertools.islice(items, window):
+        _PoolTask(pool, func, (item,), finished)
+        pending += 1
+    while pending:
+        while True:
+            try:
+                task = finished.get(timeout=1)
+                break
+            except Queue.Empty:
+                pass
+        pending -= 1
+        for item in itertools.islice(items, 1):
+            _PoolTask(pool, func, (item,), finished)
+            pending += 1
+        yield task.get()
+
+
+def range_selectors(prop, boundaries):
+    """
+    Disjoint selectors that split a collection on ranges of property `prop`:
+    one below the first boundary, one between each pair of boundaries, one
+    from the last boundary up and one for items without the property.
+
+    Boundaries are compared as the property's values are, so for
+    `$last_seen` pass ISO-8601 strings like '2016-07-01T00:00:00' (dates and
+    datetimes are converted to them).
+    """
+    boundaries = [b.strftime('%Y-%m-%dT%H:%M:%S') if hasattr(b, 'strftime') else b for b in boundaries]
+    name = 'properties[%s]' % json.dumps(prop)
+    bounds = [json.dumps(b) for b in sorted(boundaries)]
+    selectors = ['%s < %s' % (name, bounds[0])] if bounds else ['defined (%s)' % name]
+    for low, high in zip(bounds, bounds[1:]):
+        selectors.append('%s >= %s and %s < %s' % (name, low, name, high))
+    if bounds:
+        selectors.append('%s >= %s' % (name, bounds[-1]))
+    selectors.append('not defined (%s)' % name)
+    return selectors
@@ -0,0 +1,149 @@
+import csv
+import json
+import mmap
+import os
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+from writers import open_input
+
+
+def iter_items_from_file(filename, processes=None, chunk_size=1 << 23):
+    """
+    Parse an NDJSON or CSV items file on a process pool, yielding items in file order.
+
+    The file is memory-mapped and split into byte ranges of roughly `chunk_size`
+    that end on a newline. Each worker maps the file itself and parses only its
+    range, so no file data is copied between processes. The CSV header is sent
+    to every worker along with its range, which means CSV records must not
+    contain quoted newlines. At most two parsed chunks per process are held in
+    memory at once.
+
+    Files that can't be split (compressed files or a single JSON array) are
+    parsed in this process with Mixpanel.list_from_items_filename.
+    """
+    from mixpanelapi import Mixpanel
+
+    if filename.endswith(('.gz', '.bz2', '.xz')) or os.path.getsize(filename) == 0:
+        for item in Mixpanel.list_from_items_filename(filename):
+            yield item
+        return
+
+    with open(filename, 'rb') as item_file:
+        mm = mmap.mmap(item_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        start = _skip_whitespace(mm, 0)
+        first_char = mm[start:start + 1]
+        header = None
+        if first_char not in ('[', '{'):
+            with open_input(filename) as item_file:
+                header = csv.reader(item_file).next()
+            start = _line_end(mm, start)
+        ranges = _chunk_ranges(mm, start, chunk_size)
+    finally:
+        mm.close()
+
+    if first_char == '[':
+        for item in Mixpanel.list_from_items_filename(filename):
+            yield item
+        return
+
+    processes = processes or cpu_count()
+    pool = Pool(processes=processes)
+    pending = deque()
+    try:
+        for begin, end in ranges:
+            pending.append(pool.apply_async(_parse_chunk, (filename, begin, end, header)))
+            if len(pending) >= processes * 2:
+                for item in pending.popleft().get():
+                    yield item
+        while pending:
+            for item in pending.popleft().get():
+                yield item
+    finally:
+        pool.terminate()
+
+
+def stream_items_from_file(filename):
+    """
+    Parse an NDJSON or CSV items file, optionally compressed, a line at a time in this process, yielding items as
+    they are read so memory doesn't grow with the file.
+
+    A single JSON array (or JSON object spread over several lines) can't be read a line at a time, so it is parsed
+    whole with Mixpanel.list_from_items_filename.
+    """
+    from mixpanelapi import Mixpanel
+
+    with open_input(filename) as item_file:
+        first_line = ''
+        for first_line in item_file:
+            if first_line.strip():
+                break
+        first_char = first_line.lstrip()[:1]
+        if first_char == '{':
+            try:
+                first_item = json.loads(first_line)
+            except ValueError:
+                first_item = None
+            if first_item is not None:
+                yield first_item
+                for line in item_file:
+                    if line.strip():
+                        yield json.loads(line)
+                return
+        elif first_char not in ('', '['):
+            header = csv.reader([first_line]).next()
+            for item in _csv_items(csv.reader(item_file), header):
+                yield item
+            return
+
+    for item in Mixpanel.list_from_items_filename(filename):
+        yield item
+
+
+def _skip_whitespace(mm, pos):
+    while pos < len(mm) and mm[pos:pos + 1].isspace():
+        pos += 1
+    return pos
+
+
+def _line_end(mm, pos):
+    end = mm.find('\n', pos)
+    return len(mm) if end == -1 else end + 1
+
+
+def _chunk_ranges(mm, start, chunk_size):
+    ranges = []
+    while start < len(mm):
+        end = _line_end(mm, min(start + chunk_size, len(mm)) - 1)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def _parse_chunk(filename, begin, end, header):
+    with open(filename, 'rb') as item_file:
+        mm = mmap.mmap(item_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        lines = mm[begin:end].splitlines()
+    finally:
+        mm.close()
+
+    if header is None:
+        return [json.loads(line) for line in lines if line.strip()]
+    return list(_csv_items(csv.reader(line for line in lines if line), header))
+
+
+def _csv_items(reader, header):
+    from mixpanelapi import Mixpanel
+
+    if 'event' in header:
+        event_index = header.index("event")
+        distinct_id_index = header.index("distinct_id")
+        time_index = header.index("time")
+        for row in reader:
+            yield Mixpanel.event_object_from_csv_row(row, header, event_index, distinct_id_index, time_index)
+    elif '$distinct_id' in header:
+        distinct_id_index = header.index("$distinct_id")
+        for row in reader:
+            yield Mixpanel.people_object_from_csv_row(row, header, distinct_id_index)
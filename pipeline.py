@@ -0,0 +1,209 @@
+import json
+import threading
+import Queue
+from contextlib import closing
+
+from parallel_reader import iter_items_from_file, stream_items_from_file
+from records import CompactMapping, to_builtin
+from timestamps import normalize_times
+from writers import COMPRESSION_EXTENSIONS, compression_codec, open_output
+
+_END = object()
+
+
+class Pipeline(object):
+    """
+    Lazily streams events or profiles from a source, through transform stages, to a sink.
+
+    Sources are read in chunks of `chunk_size` items on a background thread
+    holding at most `prefetch` chunks, while the sink sends (or writes) items
+    on its own workers, so fetching, transforming and sending overlap and
+    memory stays bounded whatever the size of the data.
+
+    Every transform returns a new Pipeline, so stages can be chained:
+
+        Pipeline.from_export(source_client, {'from_date': '2016-07-01', 'to_date': '2016-07-31'}) \\
+            .filter(lambda event: event['event'] != 'Test') \\
+            .rename_events({'Sign up': 'Signup'}) \\
+            .shift_time(-8) \\
+            .to_import(target_client)
+
+    A Pipeline is also an iterable of its transformed items, so it can be
+    passed anywhere a list of items is accepted.
+    """
+
+    def __init__(self, source, stages=(), chunk_size=1000, prefetch=4):
+        self.source = source
+        self.stages = list(stages)
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+
+    @classmethod
+    def from_export(cls, client, params, **kwargs):
+        """
+        Stream events from a project's raw data export (see Mixpanel.iter_export)
+        """
+        return cls(lambda: client.iter_export(params), **kwargs)
+
+    @classmethod
+    def from_engage(cls, client, params=None, output_properties=None, **kwargs):
+        """
+        Stream profiles from a project's People API, page by page (see Mixpanel.iter_engage)
+        """
+        return cls(lambda: client.iter_engage(params or {}, output_properties=output_properties), **kwargs)
+
+    @classmethod
+    def from_file(cls, filename, parse_processes=None, **kwargs):
+        """
+        Stream items from a JSON, NDJSON or CSV items file, read a line at a time or parsed on `parse_processes`
+        processes (see parallel_reader)
+        """
+        if parse_processes is None:
+            return cls(lambda: stream_items_from_file(filename), **kwargs)
+        return cls(lambda: iter_items_from_file(filename, processes=parse_processes), **kwargs)
+
+    def _then(self, stage):
+        return Pipeline(self.source, self.stages + [stage], self.chunk_size, self.prefetch)
+
+    def map(self, func):
+        """
+        Replace each item with func(item). Items for which func returns None are dropped.
+        """
+        return self._then(func)
+
+    def filter(self, predicate):
+        """
+        Keep only the items for which predicate(item) is true
+        """
+        return self._then(lambda item: item if predicate(item) else None)
+
+    def rename_events(self, names):
+        """
+        Rename events using a dict of old name to new name
+        """
+        def rename(event):
+            event = _mutable(event)
+            event['event'] = names.get(event['event'], event['event'])
+            return event
+        return self._then(rename)
+
+    def rename_properties(self, names):
+        """
+        Rename event or profile properties using a dict of old name to new name
+        """
+        def rename(item):
+            item = _mutable(item)
+            properties = item[_properties_key(item)]
+            for old_name, new_name in names.iteritems():
+                if old_name in properties:
+                    properties[new_name] = properties.pop(old_name)
+            return item
+        return self._then(rename)
+
+    def shift_time(self, timezone_offset):
+        """
+        Rebase event times from a timezone `timezone_offset` hours from UTC (or a timezone name) to UTC epoch
+        seconds with timestamps.normalize_times, like import_events(timezone_offset=...). Use it to move events
+        between projects in different timezones.
+        """
+        def shift(event):
+            event = _mutable(event)
+            event['properties']['time'] = normalize_times([event['properties'].get('time')], timezone_offset)[0]
+            return event
+        return self._then(shift)
+
+    def __iter__(self):
+        for chunk in self._chunks():
+            for item in chunk:
+                for stage in self.stages:
+                    item = stage(item)
+                    if item is None:
+                        break
+                else:
+                    yield item
+
+    def to_import(self, client, timezone_offset=0):
+        """
+        Import the events into the project of `client`, returning the jobs.ImportJob with the results
+        """
+        return client.import_events(self, timezone_offset)
+
+    def to_people(self, client, ignore_alias=False):
+        """
+        $set the profiles' properties in the project of `client`, returning the jobs.ImportJob with the results
+        """
+        return client.import_people(self, ignore_alias)
+
+    def to_file(self, filename, compress=False, compress_level=None):
+        """
+        Write the items to an NDJSON file, compressed as in Mixpanel.export_events. Returns the number of items.
+        """
+        codec = compression_codec(compress)
+        if codec is not None:
+            filename += COMPRESSION_EXTENSIONS[codec]
+        count = 0
+        with closing(open_output(filename, codec, compress_level)) as output:
+            for item in self:
+                output.write(json.dumps(item, default=to_builtin) + '\n')
+                count += 1
+        return count
+
+    def _chunks(self):
+        chunks = Queue.Queue(maxsize=self.prefetch)
+        stopped = threading.Event()
+
+        def produce():
+            try:
+                chunk = []
+                for item in self.source():
+                    chunk.append(item)
+                    if len(chunk) == self.chunk_size:
+                        if not _put(chunks, chunk, stopped):
+                            return
+                        chunk = []
+                if chunk:
+                    _put(chunks, chunk, stopped)
+            except Exception as e:
+                _put(chunks, e, stopped)
+            finally:
+                _put(chunks, _END, stopped)
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is _END:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            stopped.set()
+
+
+def _put(chunks, chunk, stopped):
+    # Block while the consumer is behind, but give up once it has stopped reading
+    while not stopped.is_set():
+        try:
+            chunks.put(chunk, timeout=1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def _mutable(item):
+    # A copy the stages can change, so the source's items are left as they were
+    if isinstance(item, CompactMapping):
+        return item.to_dict()
+    item = dict(item)
+    key = _properties_key(item)
+    if key in item:
+        item[key] = dict(item[key])
+    return item
+
+
+def _properties_key(item):
+    return '$properties' if '$distinct_id' in item else 'properties'
@@ -0,0 +1,277 @@
+import cProfile
+import ctypes
+import ctypes.util
+import math
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class NullProfiler(object):
+    """
+    Stand-in used when profiling is off, so instrumented code costs one method call per stage.
+    """
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def iter_stage(self, name, iterable):
+        return iterable
+
+    def record(self, name, wall, cpu=0.0):
+        pass
+
+    def finish_run(self):
+        pass
+
+
+class StageStats(object):
+    """
+    Wall and CPU totals for one pipeline stage, with a histogram of wall times in power of two buckets of
+    microseconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.min = None
+        self.max = 0.0
+        self.histogram = defaultdict(int)
+
+    def add(self, wall, cpu):
+        self.count += 1
+        self.wall += wall
+        self.cpu += cpu
+        self.min = wall if self.min is None else min(self.min, wall)
+        self.max = max(self.max, wall)
+        microseconds = max(1, int(wall * 1000000))
+        self.histogram[1 << int(math.log(microseconds, 2))] += 1
+
+
+class StageProfiler(object):
+    """
+    Opt-in instrumentation for the import and export pipelines.
+
+    Pass an instance to Mixpanel(profiler=...) to time the stages of every
+    run: 'parse' (reading items files), 'normalize' (converting event times
+    to UTC a chunk at a time), 'prep' (_prep_event_for_import and
+    _prep_params_for_profile), 'encode' (JSON, base64 and urlencoding of
+    requests), 'queue' (time a batch waits for a worker), 'network' (sending
+    the request and reading the response), 'decode' (parsing responses) and
+    'write' (writing exports).
+
+    Stages don't overlap: time spent in a stage entered while another is
+    running on the same thread (like 'parse' pulling items for 'normalize')
+    only counts toward the inner stage, so the stages add up to the time
+    spent.
+
+    CPU times are those of the thread running the stage, so they stay
+    meaningful while other threads encode and send batches at the same time.
+    Where there is no per-thread CPU clock (CLOCK_THREAD_CPUTIME_ID) they are
+    reported as 0.
+
+    Stages named in `profile_stages` are run under cProfile (one profiler per
+    thread, merged by `write_pstats`). Stages named in `sample_stages` are
+    sampled every `sample_interval` seconds by a background thread, and the
+    samples are written as folded stacks, the input format of flamegraph.pl
+    and speedscope, by `write_folded`.
+
+    If `output_prefix` is set, the report, folded stacks and cProfile stats
+    are written to <output_prefix>.txt, .folded and .pstats at the end of
+    every run.
+    """
+
+    def __init__(self, profile_stages=(), sample_stages=(), sample_interval=0.005, output_prefix=None):
+        self.profile_stages = set(profile_stages)
+        self.sample_stages = set(sample_stages)
+        self.sample_interval = sample_interval
+        self.output_prefix = output_prefix
+        self.stats = defaultdict(StageStats)
+        self.samples = defaultdict(int)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = []
+        self._sampled_threads = {}
+        self._sampler = None
+
+    @contextmanager
+    def stage(self, name):
+        profile = None
+        if name in self.profile_stages:
+            profile = self._thread_profile()
+            profile.enable()
+        if name in self.sample_stages:
+            self._start_sampling(name)
+        # Wall and CPU time spent in stages entered inside this one, which only count toward those stages
+        nested = [0.0, 0.0]
+        stack = self._stage_stack()
+        stack.append(nested)
+        wall_start = time.time()
+        cpu_start = _cpu_time()
+        try:
+            yield
+        finally:
+            wall = time.time() - wall_start
+            cpu = _cpu_time() - cpu_start
+            stack.pop()
+            if stack:
+                stack[-1][0] += wall
+                stack[-1][1] += cpu
+            if profile is not None:
+                profile.disable()
+            if name in self.sample_stages:
+                with self._lock:
+                    self._sampled_threads.pop(threading.current_thread().ident, None)
+            self.record(name, wall - nested[0], cpu - nested[1])
+
+    def iter_stage(self, name, iterable):
+        """
+        Wrap a lazy iterable so the time spent producing each item is recorded under `name`.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record(self, name, wall, cpu=0.0):
+        with self._lock:
+            self.stats[name].add(wall, cpu)
+
+    def report(self):
+        lines = ['%-8s %10s %12s %12s %12s %12s' % ('stage', 'count', 'wall (s)', 'cpu (s)', 'min (ms)', 'max (ms)')]
+        with self._lock:
+            for name, stats in sorted(self.stats.items()):
+                lines.append('%-8s %10d %12.3f %12.3f %12.3f %12.3f' % (name, stats.count, stats.wall, stats.cpu,
+                                                                        (stats.min or 0) * 1000, stats.max * 1000))
+                for bucket, count in sorted(stats.histogram.items()):
+                    lines.append('    < %10d us %10d' % (bucket * 2, count))
+        return '\n'.join(lines)
+
+    def write_folded(self, filename):
+        """
+        Write sampled stacks in folded format. Without samples, each stage's total wall time (in microseconds) is
+        written as a one frame stack, which still renders as a stage level flame graph.
+        """
+        with self._lock, open(filename, 'w') as output:
+            if self.samples:
+                for stack, count in sorted(self.samples.items()):
+                    output.write(stack + ' ' + str(count) + '\n')
+            else:
+                for name, stats in sorted(self.stats.items()):
+                    output.write(name + ' ' + str(int(stats.wall * 1000000)) + '\n')
+
+    def write_pstats(self, filename):
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(filename)
+
+    def finish_run(self):
+        if self.output_prefix is None:
+            return
+        with open(self.output_prefix + '.txt', 'w') as output:
+            output.write(self.report() + '\n')
+        self.write_folded(self.output_prefix + '.folded')
+        self.write_pstats(self.output_prefix + '.pstats')
+
+    def _stage_stack(self):
+        stack = getattr(self._local, 'stages', None)
+        if stack is None:
+            stack = self._local.stages = []
+        return stack
+
+    def _thread_profile(self):
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+        return profile
+
+    def _start_sampling(self, name):
+        with self._lock:
+            self._sampled_threads[threading.current_thread().ident] = name
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample)
+                self._sampler.daemon = True
+                self._sampler.start()
+
+    def _sample(self):
+        # Runs while any thread is in a sampled stage, and is restarted by the next one to enter
+        while True:
+            time.sleep(self.sample_interval)
+            with self._lock:
+                if not self._sampled_threads:
+                    self._sampler = None
+                    return
+                sampled_threads = self._sampled_threads.items()
+            frames = sys._current_frames()
+            for ident, name in sampled_threads:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(code.co_name + ' (' + os.path.basename(code.co_filename) + ')')
+                    frame = frame.f_back
+                stack.append(name)
+                folded = ';'.join(reversed(stack))
+                with self._lock:
+                    self.samples[folded] += 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _thread_cpu_clock():
+    # CPU time of the calling thread from clock_gettime(CLOCK_THREAD_CPUTIME_ID), or None where there is no such
+    # clock. Python 2 has no binding for it, so on Linux it is called through ctypes.
+    if hasattr(time, 'CLOCK_THREAD_CPUTIME_ID'):
+        return lambda: time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6').clock_gettime
+    except (AttributeError, OSError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    clock_thread_cputime_id = 3
+
+    def thread_cpu_time():
+        timespec = _Timespec()
+        clock_gettime(clock_thread_cputime_id, ctypes.byref(timespec))
+        return timespec.tv_sec + timespec.tv_nsec / 1e9
+    return thread_cpu_time
+
+
+_thread_cpu_time = _thread_cpu_clock()
+
+
+def _cpu_time():
+    return _thread_cpu_time() if _thread_cpu_time is not None else 0.0
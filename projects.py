@@ -0,0 +1,194 @@
+import threading
+import time
+from collections import deque
+from multiprocessing import cpu_count
+
+from mixpanelapi import Mixpanel
+
+
+class RateLimiter(object):
+    """
+    Token bucket allowing `rate` requests per second with bursts of up to `burst` requests.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+
+    def delay(self):
+        """
+        Return the number of seconds until a request may be sent, 0 if one may be sent now.
+        """
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def consume(self):
+        self._tokens -= 1
+
+
+class ProjectQueue(object):
+    """
+    A project's share of a FairScheduler.
+
+    Implements the apply_async/close/join subset of ThreadPool used by
+    Mixpanel._dispatch_batches, so a Mixpanel client can be pointed at it with
+    the `worker_pool` argument. `close` is a no-op because the queue is shared
+    by every dispatch for the project, and `join` waits until all of the
+    project's queued tasks have finished.
+    """
+
+    def __init__(self, scheduler, name, max_concurrency=None, rate_limit=None):
+        self.scheduler = scheduler
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.tasks = deque()
+        self.active = 0
+
+    def apply_async(self, func, args=(), kwds={}, callback=None):
+        with self.scheduler.condition:
+            self.tasks.append((func, args, kwds, callback))
+            self.scheduler.condition.notify_all()
+
+    def close(self):
+        pass
+
+    def join(self):
+        with self.scheduler.condition:
+            while self.tasks or self.active:
+                self.scheduler.condition.wait(1)
+
+    def _ready_delay(self):
+        # None if the queue can't run anything now, 0 if it can, otherwise seconds until its rate limit allows it
+        if not self.tasks or (self.max_concurrency is not None and self.active >= self.max_concurrency):
+            return None
+        if self.limiter is not None:
+            return self.limiter.delay()
+        return 0
+
+
+class FairScheduler(object):
+    """
+    Runs tasks from many ProjectQueues on one shared set of worker threads.
+
+    Workers take tasks from the project queues in round-robin order, skipping
+    projects that are at their concurrency cap or over their rate limit, so a
+    project with a huge backlog only gets its turn like every other project
+    with pending work.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or cpu_count() * 2
+        self.condition = threading.Condition()
+        self._rotation = deque()
+        self._closed = False
+        self._threads = []
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def project(self, name, max_concurrency=None, rate_limit=None):
+        queue = ProjectQueue(self, name, max_concurrency, rate_limit)
+        with self.condition:
+            self._rotation.append(queue)
+        return queue
+
+    def close(self):
+        """
+        Finish every queued task, then stop the worker threads.
+        """
+        with self.condition:
+            self._closed = True
+            self.condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _next_task(self):
+        with self.condition:
+            while True:
+                if self._closed and not any(queue.tasks for queue in self._rotation):
+                    return None
+                wait = None
+                for _ in range(len(self._rotation)):
+                    queue = self._rotation[0]
+                    self._rotation.rotate(-1)
+                    delay = queue._ready_delay()
+                    if delay == 0:
+                        if queue.limiter is not None:
+                            queue.limiter.consume()
+                        queue.active += 1
+                        return queue, queue.tasks.popleft()
+                    if delay is not None:
+                        wait = delay if wait is None else min(wait, delay)
+                self.condition.wait(wait if wait is not None else 1)
+
+    def _work(self):
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            queue, (func, args, kwds, callback) = task
+            try:
+                result = func(*args, **kwds)
+                if callback is not None:
+                    callback(result)
+            except Exception as e:
+                Mixpanel.logger.warning("Task for project " + str(queue.name) + " failed: " + repr(e))
+            finally:
+                with self.condition:
+                    queue.active -= 1
+                    self.condition.notify_all()
+
+
+class MixpanelProjects(object):
+    """
+    Holds Mixpanel clients for many projects that share one FairScheduler.
+
+    Every client's imports and People updates run on the same worker threads,
+    so the total number of in-flight requests (and open sockets) is bounded
+    by `workers` however many projects are busy at once.
+
+    Example:
+        projects = MixpanelProjects(workers=16, max_concurrency=4)
+        projects.add_project('web', WEB_API_SECRET, WEB_TOKEN)
+        projects.add_project('backfill', BACKFILL_API_SECRET, BACKFILL_TOKEN, max_concurrency=2, rate_limit=10)
+        projects['web'].import_events('events.json')
+    """
+
+    def __init__(self, workers=None, max_concurrency=None, rate_limit=None, **client_kwargs):
+        """
+        :param workers: number of shared worker threads
+        :param max_concurrency: default cap on a project's in-flight requests
+        :param rate_limit: default cap on a project's requests per second
+        :param client_kwargs: passed on to every Mixpanel client (timeout, max_retries, debug)
+        """
+        self.scheduler = FairScheduler(workers)
+        self.max_concurrency = max_concurrency
+        self.rate_limit = rate_limit
+        self.client_kwargs = client_kwargs
+        self.clients = {}
+
+    def add_project(self, name, api_secret, token=None, max_concurrency=None, rate_limit=None):
+        queue = self.scheduler.project(name,
+                                       max_concurrency if max_concurrency is not None else self.max_concurrency,
+                                       rate_limit if rate_limit is not None else self.rate_limit)
+        client = Mixpanel(api_secret, token, pool_size=self.scheduler.workers, worker_pool=queue, **self.client_kwargs)
+        self.clients[name] = client
+        return client
+
+    def __getitem__(self, name):
+        return self.clients[name]
+
+    def __contains__(self, name):
+        return name in self.clients
+
+    def close(self):
+        self.scheduler.close()
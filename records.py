@@ -0,0 +1,174 @@
+"""
+Compact, read-only representations of exported events and People profiles.
+
+Events from `/export` and profiles from `/engage` share a handful of property
+name sets, so instead of a dict per record each record stores a tuple of
+values and a reference to a shared `Schema` holding the property names. Names
+and short string values are interned, so repeated strings like "$os" or
+"iPhone OS" are stored once per process rather than once per record.
+
+Records expose the read side of the dict API, so code written against the
+plain dicts returned by `query_export` and `query_engage` keeps working.
+"""
+
+_schemas = {}
+_interned_values = {}
+
+# Only short strings are worth interning and the table is capped so that high
+# cardinality values (ids, emails) cannot grow it without bound.
+MAX_INTERNED_LENGTH = 64
+MAX_INTERNED_VALUES = 100000
+
+
+def intern_value(value):
+    if isinstance(value, basestring) and len(value) <= MAX_INTERNED_LENGTH:
+        interned = _interned_values.get(value)
+        if interned is not None:
+            return interned
+        if len(_interned_values) < MAX_INTERNED_VALUES:
+            _interned_values[value] = value
+    return value
+
+
+def schema_for(keys):
+    """
+    Return the shared `Schema` for a collection of property names.
+    """
+    keys = tuple(sorted(keys))
+    schema = _schemas.get(keys)
+    if schema is None:
+        schema = _schemas.setdefault(keys, Schema(tuple(intern_value(key) for key in keys)))
+    return schema
+
+
+def to_builtin(obj):
+    """
+    `default` hook for json.dump/json.dumps that serializes compact records as plain dicts.
+    """
+    if isinstance(obj, CompactMapping):
+        return obj.to_dict()
+    raise TypeError(repr(obj) + " is not JSON serializable")
+
+
+class Schema(object):
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = dict((key, i) for i, key in enumerate(keys))
+
+
+class CompactMapping(object):
+    """
+    Read-only dict-like base class. Subclasses implement `keys` and `__getitem__`.
+    """
+    __slots__ = ()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return len(self.keys())
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def to_dict(self):
+        """
+        Return a mutable copy of the record made of plain dicts.
+        """
+        return dict((key, value.to_dict() if isinstance(value, CompactMapping) else value)
+                    for key, value in self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (CompactMapping, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class CompactProperties(CompactMapping):
+    __slots__ = ('_schema', '_values')
+
+    def __init__(self, properties):
+        self._schema = schema_for(properties.keys())
+        self._values = tuple(intern_value(properties[key]) for key in self._schema.keys)
+
+    def keys(self):
+        return list(self._schema.keys)
+
+    def __getitem__(self, key):
+        return self._values[self._schema.index[key]]
+
+    def __len__(self):
+        return len(self._values)
+
+
+class Event(CompactMapping):
+    __slots__ = ('event', 'properties')
+
+    def __init__(self, event):
+        self.event = intern_value(event['event'])
+        self.properties = CompactProperties(event['properties'])
+
+    def keys(self):
+        return ['event', 'properties']
+
+    def __getitem__(self, key):
+        if key == 'event':
+            return self.event
+        if key == 'properties':
+            return self.properties
+        raise KeyError(key)
+
+
+class Profile(CompactMapping):
+    __slots__ = ('distinct_id', 'properties')
+
+    def __init__(self, profile):
+        self.distinct_id = profile['$distinct_id']
+        self.properties = CompactProperties(profile['$properties'])
+
+    def keys(self):
+        return ['$distinct_id', '$properties']
+
+    def __getitem__(self, key):
+        if key == '$distinct_id':
+            return self.distinct_id
+        if key == '$properties':
+            return self.properties
+        raise KeyError(key)
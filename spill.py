@@ -0,0 +1,116 @@
+import json
+import os
+import shutil
+import tempfile
+from itertools import islice
+
+from records import to_builtin
+from writers import open_input, open_output
+
+_SAMPLE_INTERVAL = 64
+
+
+class SpillList(object):
+    """
+    Append-only sequence that keeps at most about `memory_budget` bytes of items in memory.
+
+    Items are buffered in memory until their estimated JSON size passes the
+    budget, then the buffer is written to a gzip compressed NDJSON segment in
+    a temporary directory and emptied. Iterating reads the segments back one
+    line at a time and then the buffer, so a SpillList supports len,
+    indexing and any number of iterations at bounded memory, and can be
+    passed wherever a list of items is read.
+
+    Items read back from segments are plain dicts, turned back into the
+    original type by `wrap` (e.g. records.Profile) if it is set. The segments
+    (and the temporary directory, unless `directory` was given) are removed
+    by `close`, or when the SpillList is garbage collected.
+    """
+
+    def __init__(self, memory_budget, wrap=None, directory=None):
+        self.memory_budget = memory_budget
+        self.wrap = wrap
+        self.directory = directory
+        self._temporary = directory is None
+        self.segments = []
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._item_bytes = None
+        self._spilled = 0
+
+    def append(self, item):
+        self._buffer.append(item)
+        if self._item_bytes is None or len(self._buffer) % _SAMPLE_INTERVAL == 0:
+            # Estimate item sizes from a sample, so most items are only serialized if they are spilled
+            size = len(json.dumps(item, default=to_builtin))
+            self._item_bytes = size if self._item_bytes is None else (self._item_bytes + size) / 2
+        self._buffered_bytes += self._item_bytes
+        if self._buffered_bytes > self.memory_budget:
+            self._spill()
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return self._spilled + len(self._buffer)
+
+    def __iter__(self):
+        for filename, count in list(self.segments):
+            with open_input(filename) as segment:
+                for line in segment:
+                    item = json.loads(line)
+                    yield self.wrap(item) if self.wrap is not None else item
+        for item in list(self._buffer):
+            yield item
+
+    def __getitem__(self, index):
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError('SpillList index out of range')
+        if index >= self._spilled:
+            return self._buffer[index - self._spilled]
+        for filename, count in self.segments:
+            if index < count:
+                with open_input(filename) as segment:
+                    item = json.loads(next(islice(segment, index, None)))
+                return self.wrap(item) if self.wrap is not None else item
+            index -= count
+
+    def close(self):
+        if self._temporary and self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+        else:
+            for filename, count in self.segments:
+                if os.path.exists(filename):
+                    os.remove(filename)
+        self.segments = []
+        self._buffer = []
+        self._spilled = 0
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _spill(self):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='mixpanel_spill_')
+        elif not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        descriptor, filename = tempfile.mkstemp(suffix='.json.gz', prefix='segment_', dir=self.directory)
+        os.close(descriptor)
+        with open_output(filename, 'gzip', 1) as segment:
+            for item in self._buffer:
+                segment.write(json.dumps(item, default=to_builtin) + '\n')
+        self.segments.append((filename, len(self._buffer)))
+        self._spilled += len(self._buffer)
+        self._buffer = []
+        self._buffered_bytes = 0
@@ -0,0 +1,176 @@
+import json
+import sqlite3
+from itertools import islice
+
+from records import to_builtin
+
+
+class SQLiteStore(object):
+    """
+    Local SQLite database of exported events and People profiles.
+
+    Items are bulk inserted with executemany in batches of `batch_size`, one
+    transaction per batch, into a database in WAL mode. Events are indexed on
+    event, time and distinct_id, profiles are keyed by $distinct_id, and
+    properties are stored as a JSON column so any property can be queried
+    (and indexed with index_profile_property) through SQLite's json_extract.
+
+    Example:
+        with SQLiteStore('project.db') as store:
+            store.insert_events(client.iter_export(params))
+            store.insert_profiles(client.iter_engage())
+            store.index_profile_property('$email')
+            store.events_for('abc123')
+    """
+
+    def __init__(self, filename, batch_size=5000):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, event TEXT, '
+                                    'distinct_id TEXT, time INTEGER, properties TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS events_event ON events (event)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS events_time ON events (time)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS events_distinct_id ON events (distinct_id, time)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS profiles (distinct_id TEXT PRIMARY KEY, '
+                                    'properties TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+
+    def insert_events(self, events):
+        """
+        Insert an iterable of events, returning the number inserted
+        """
+        rows = ((event['event'], event['properties'].get('distinct_id'), event['properties'].get('time'),
+                 json.dumps(event['properties'], default=to_builtin)) for event in events)
+        return self._insert_rows('INSERT INTO events (event, distinct_id, time, properties) VALUES (?, ?, ?, ?)',
+                                 rows)
+
+    def insert_profiles(self, profiles):
+        """
+        Insert an iterable of profiles, replacing stored profiles with the same $distinct_id. Returns the number
+        inserted.
+        """
+        rows = ((profile['$distinct_id'], json.dumps(profile['$properties'], default=to_builtin))
+                for profile in profiles)
+        return self._insert_rows('INSERT OR REPLACE INTO profiles (distinct_id, properties) VALUES (?, ?)', rows)
+
+    def replace_profiles(self, profiles):
+        """
+        Replace every stored profile with those of an iterable, so profiles it doesn't include are deleted. The
+        profiles are staged in a temporary table first, so if reading them fails the stored profiles are left as they
+        were. Returns the number inserted.
+        """
+        with self.connection:
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS staged_profiles (distinct_id TEXT PRIMARY KEY, '
+                                    'properties TEXT)')
+            self.connection.execute('DELETE FROM staged_profiles')
+        rows = ((profile['$distinct_id'], json.dumps(profile['$properties'], default=to_builtin))
+                for profile in profiles)
+        count = self._insert_rows('INSERT OR REPLACE INTO staged_profiles (distinct_id, properties) VALUES (?, ?)',
+                                  rows)
+        with self.connection:
+            self.connection.execute('DELETE FROM profiles')
+            self.connection.execute('INSERT INTO profiles (distinct_id, properties) '
+                                    'SELECT distinct_id, properties FROM staged_profiles')
+            self.connection.execute('DELETE FROM staged_profiles')
+        return count
+
+    def index_profile_property(self, name):
+        """
+        Index profiles on a property so that profiles_by and duplicate_profiles on it are indexed lookups
+        """
+        index_name = 'profiles_' + ''.join(c if c.isalnum() else '_' for c in name)
+        with self.connection:
+            self.connection.execute('CREATE INDEX IF NOT EXISTS "' + index_name + '" ON profiles (' +
+                                    _json_property(name) + ')')
+
+    def get_properties(self, distinct_id):
+        """
+        Return the properties of the profile with this $distinct_id, or None if it isn't stored
+        """
+        row = self.connection.execute('SELECT properties FROM profiles WHERE distinct_id = ?',
+                                      [distinct_id]).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_metadata(self, name, default=None):
+        """
+        Return a value saved with set_metadata, such as the watermark of the last incremental People export
+        """
+        row = self.connection.execute('SELECT value FROM metadata WHERE name = ?', [name]).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def set_metadata(self, name, value):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)',
+                                    [name, json.dumps(value, default=to_builtin)])
+
+    def events_for(self, distinct_id, event=None, from_time=None, to_time=None):
+        """
+        Return the events of one user in time order, optionally only those named `event` or within a time range
+        """
+        query = 'SELECT event, properties FROM events WHERE distinct_id = ?'
+        params = [distinct_id]
+        if event is not None:
+            query += ' AND event = ?'
+            params.append(event)
+        if from_time is not None:
+            query += ' AND time >= ?'
+            params.append(from_time)
+        if to_time is not None:
+            query += ' AND time <= ?'
+            params.append(to_time)
+        return list(self.iter_events(query + ' ORDER BY time', params))
+
+    def iter_events(self, query='SELECT event, properties FROM events', params=()):
+        for event, properties in self.connection.execute(query, params):
+            yield {'event': event, 'properties': json.loads(properties)}
+
+    def profiles_by(self, name, value):
+        """
+        Return the profiles whose property `name` equals `value`
+        """
+        return list(self.iter_profiles('SELECT distinct_id, properties FROM profiles WHERE ' + _json_property(name) +
+                                       ' = ?', [value]))
+
+    def duplicate_profiles(self, name, case_sensitive=False):
+        """
+        Return only the profiles that share a value of property `name` with another profile, ready to be passed to
+        Mixpanel.deduplicate_people
+        """
+        prop = _json_property(name)
+        if not case_sensitive:
+            prop = 'lower(' + prop + ')'
+        query = ('SELECT distinct_id, properties FROM profiles WHERE ' + prop + ' IN (SELECT ' + prop +
+                 ' FROM profiles WHERE ' + prop + ' IS NOT NULL GROUP BY 1 HAVING count(*) > 1)')
+        return list(self.iter_profiles(query))
+
+    def iter_profiles(self, query='SELECT distinct_id, properties FROM profiles', params=()):
+        for distinct_id, properties in self.connection.execute(query, params):
+            yield {'$distinct_id': distinct_id, '$properties': json.loads(properties)}
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _insert_rows(self, statement, rows):
+        count = 0
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                return count
+            with self.connection:
+                self.connection.executemany(statement, batch)
+            count += len(batch)
+
+
+def _json_property(name):
+    # json_extract path with the property name quoted, so names like "$email" or "Campaign Name" work
+    return "json_extract(properties, '$.\"" + name.replace("'", "''").replace('"', '\\"') + "\"')"
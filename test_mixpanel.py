@@ -1,5 +1,24 @@
-from unittest import TestCase
+from unittest import TestCase, skipIf
 from mixpanelapi import Mixpanel
+import mixpanelapi
+from parallel_reader import iter_items_from_file, stream_items_from_file
+from analytics import Funnel, GroupedCounts, HyperLogLog, Uniques, aggregate, aggregate_export, hash64, hash64_array
+import analytics
+from batches import EncodedBatch
+from cli import main
+from concurrency import AIMDController, BULK, INTERACTIVE, PriorityLimiter
+from dedupe import BloomFilter
+from paginator import range_selectors
+from pipeline import Pipeline
+from profiling import StageProfiler
+import profiling
+from projects import FairScheduler
+from records import Event, Profile
+from spill import SpillList
+from timestamps import normalize_times, parse_iso, parse_iso_batch
+import timestamps
+from sqlite_store import SQLiteStore
+from writers import BackupWriter, DeadLetterSink
 import os
 import csv
 import json
@@ -10,6 +29,14 @@ import string
 from datetime import date, timedelta
 from copy import deepcopy
 import uuid
+import threading
+import cStringIO
+import urllib2
+import urlparse
+import httplib
+import socket
+import glob
+import struct
 
 
 class TestMixpanel(TestCase):
@@ -106,6 +133,31 @@ class TestMixpanel(TestCase):
             finally:
                 os.remove('people_items.csv')
 
+    def test_compact_records(self):
+        with open('events_items_gold.json', 'rbU') as events_file, open('people_items_gold.json', 'rbU') as people_file:
+            events = json.load(events_file)
+            profiles = json.load(people_file)
+        compact_events = [Event(event) for event in events]
+        compact_profiles = [Profile(profile) for profile in profiles]
+        self.assertEqual(events, compact_events)
+        self.assertEqual(profiles, compact_profiles)
+        self.assertIs(compact_events[0]['properties'].keys()[0], compact_events[1]['properties'].keys()[0])
+        self.assertEqual(events[0]['properties']['$os'], compact_events[0]['properties'].get('$os'))
+        self.assertRaises(KeyError, lambda: compact_profiles[0]['$properties']['not a property'])
+
+        with open('people_items.csv', 'a+') as f:
+            try:
+                self.mixpanel.write_items_to_csv(compact_profiles, f)
+                f.seek(0)
+                compact_output = f.read()
+                f.seek(0)
+                f.truncate()
+                self.mixpanel.write_items_to_csv(profiles, f)
+                f.seek(0)
+                self.assertEqual(f.read(), compact_output)
+            finally:
+                os.remove('people_items.csv')
+
     def test_properties_from_csv_row_events(self):
         with open('events_items_gold.csv', 'rbU') as f:
             reader = csv.reader(f)
@@ -307,6 +359,32 @@ class TestMixpanel(TestCase):
         test_list = self.mixpanel.list_from_items_filename('people_items_gold.json')
         self.assertEqual(expected_list, test_list)
 
+    def test_iter_items_from_file(self):
+        for filename in ['events_items_gold.csv', 'people_items_gold.csv', 'events_items_gold.json']:
+            expected_list = self.mixpanel.list_from_items_filename(filename)
+            test_list = list(iter_items_from_file(filename, processes=2, chunk_size=64))
+            self.assertEqual(expected_list, test_list)
+
+        with open('people_items_gold.json', 'rbU') as gold_json_file, open('people_items.ndjson', 'w') as f:
+            gold_json_data = json.load(gold_json_file)
+            for profile in gold_json_data:
+                f.write(json.dumps(profile) + '\n')
+        try:
+            test_list = list(iter_items_from_file('people_items.ndjson', processes=2, chunk_size=64))
+            self.assertEqual(gold_json_data, test_list)
+            self.mixpanel.gzip_file('people_items.ndjson')
+            for filename in ['people_items.ndjson', 'people_items.ndjson.gz', 'events_items_gold.csv',
+                             'people_items_gold.csv', 'events_items_gold.json']:
+                self.assertEqual(self.mixpanel.list_from_items_filename(filename),
+                                 list(stream_items_from_file(filename)))
+            # NDJSON is parsed as it is read
+            items = stream_items_from_file('people_items.ndjson')
+            self.assertEqual(gold_json_data[0], next(items))
+            self.assertEqual(gold_json_data[1:], list(items))
+        finally:
+            os.remove('people_items.ndjson')
+            os.remove('people_items.ndjson.gz')
+
     def test__export_data_with_events(self):
         with open('events_items_gold.json', 'rbU') as gold_json_file:
             gold_json_data = json.load(gold_json_file)
@@ -343,6 +421,912 @@ class TestMixpanel(TestCase):
                     os.remove('people_data.json')
                     os.remove('people_data.csv')
 
+    def test__export_data_compressed(self):
+        with open('events_items_gold.json', 'rbU') as gold_json_file:
+            gold_json_data = json.load(gold_json_file)
+        for compress, threads, filename in [(True, 1, 'events_data.json.gz'), ('bz2', 1, 'events_data.json.bz2'),
+                                            ('gzip', 4, 'events_data.json.gz')]:
+            self.mixpanel._export_data(gold_json_data, 'events_data.json', compress=compress, compress_level=1,
+                                       compress_threads=threads)
+            try:
+                self.assertFalse(os.path.exists('events_data.json'))
+                test_json_data = self.mixpanel.list_from_items_filename(filename)
+                self.assertEqual(gold_json_data, test_json_data)
+            finally:
+                os.remove(filename)
+
+        # Both gzip writers default to level 9, which zlib marks with XFL = 2 in the member header
+        for threads in [1, 4]:
+            self.mixpanel._export_data(gold_json_data, 'events_data.json', compress=True, compress_threads=threads)
+            try:
+                with open('events_data.json.gz', 'rb') as f:
+                    self.assertEqual('\x02', f.read(10)[8])
+            finally:
+                os.remove('events_data.json.gz')
+
+    def test_aimd_controller(self):
+        controller = AIMDController(initial=4, max_limit=6)
+        for x in range(100):
+            controller.release(controller.acquire())
+        self.assertEqual(6, controller.limit)
+        # A latency spike halves the limit
+        controller.release(controller.acquire() - 10)
+        self.assertEqual(3, controller.limit)
+        # A window of 503s only halves it once
+        started = [controller.acquire() for x in range(3)]
+        for s in started:
+            controller.release(s, overloaded=True)
+        self.assertEqual(1, controller.limit)
+        self.assertEqual(0, controller.in_flight)
+
+        # Each endpoint has its own baseline, and streamed responses aren't latencies
+        controller = AIMDController(initial=4, max_limit=6)
+        for x in range(100):
+            controller.release(controller.acquire(), endpoint='import')
+            controller.release(controller.acquire() - 30, endpoint='engage')
+        controller.release(controller.acquire() - 600, endpoint='export', measure_latency=False)
+        self.assertEqual(6, controller.limit)
+        controller.release(controller.acquire() - 30, endpoint='import')
+        self.assertEqual(3, controller.limit)
+        self.assertNotIn('export', controller.latencies)
+
+    def test_fair_scheduler(self):
+        scheduler = FairScheduler(workers=4)
+        big = scheduler.project('big', max_concurrency=2)
+        small = scheduler.project('small')
+        running = {'big': 0, 'max_big': 0}
+        finished = []
+
+        def task(name):
+            if name == 'big':
+                running['big'] += 1
+                running['max_big'] = max(running['max_big'], running['big'])
+            time.sleep(0.01)
+            if name == 'big':
+                running['big'] -= 1
+            return name
+
+        for x in range(20):
+            big.apply_async(task, args=('big',), callback=finished.append)
+        for x in range(5):
+            small.apply_async(task, args=('small',), callback=finished.append)
+        small.join()
+        self.assertEqual(5, finished.count('small'))
+        self.assertLess(finished.count('big'), 20)
+        big.join()
+        scheduler.close()
+        self.assertEqual(20, finished.count('big'))
+        self.assertLessEqual(running['max_big'], 2)
+
+    def test_dead_letter_sink(self):
+        items = [{'event': 'page view', 'properties': {'prop1': 'val1'}},
+                 {'event': 'login', 'properties': {'distinct_id': 'abc123'}}]
+        for format, compress, filename in [('ndjson', False, 'dead_letters.txt'),
+                                           ('batches', True, 'dead_letters.txt.gz')]:
+            sink = DeadLetterSink('dead_letters.txt', format=format, compress=compress)
+            try:
+                self.assertEqual(filename, sink.filename)
+                sink.write(items)
+                sink.write(items[:1])
+                self.assertEqual(items + items[:1], sink.read())
+                sink.write(items[1:])
+                self.assertEqual(items + items, sink.read())
+                self.assertEqual(4, sink.count)
+            finally:
+                os.remove(filename)
+
+        # Reopening a bz2 sink adds a stream after the earlier ones instead of rewriting them
+        sink = DeadLetterSink('dead_letters.txt', compress='bz2')
+        try:
+            sink.write(items)
+            sink.close()
+            with open(sink.filename, 'rb') as f:
+                written = f.read()
+            sink.write(items[1:])
+            sink.flush()
+            sink.close()
+            with open(sink.filename, 'rb') as f:
+                self.assertEqual(written, f.read(len(written)))
+            self.assertEqual(items + items[1:], sink.read())
+        finally:
+            os.remove('dead_letters.txt.bz2')
+
+        sink = DeadLetterSink('dead_letters.txt')
+        try:
+            self.mixpanel._prep_event_for_import(items[0], '123', 0, sink)
+            self.assertEqual(items[:1], sink.read())
+
+            # An unparseable time is a dead letter too, and the rest of the import carries on
+            bad_time = {'event': 'login', 'properties': {'distinct_id': 'abc123', 'time': 'yesterday'}}
+            events = [{'event': 'login', 'properties': {'distinct_id': 'abc123', 'time': 1471503600}}] * 10
+            client = Mixpanel('123', '123', pool_size=1, invalid_events_sink=sink)
+            client.request = lambda *args, **kwargs: '{"status": 1}'
+            self.assertEqual(10, client.import_events(events[:5] + [bad_time] + events[5:]).acknowledged)
+            self.assertEqual(items[:1] + [bad_time], sink.read())
+        finally:
+            os.remove('dead_letters.txt')
+
+    def test_replay_dead_letters(self):
+        events = [{'event': 'page view', 'properties': {'distinct_id': str(i), 'time': 1471503600, 'token': '123'}}
+                  for i in range(4)]
+        for compress in ['gzip', 'bz2']:
+            sink = DeadLetterSink('failed.txt', 'batches', compress=compress)
+            client = Mixpanel('123', '123', pool_size=1, failed_batches_sink=sink)
+            sent = []
+
+            def request(base_url, path_components, params, method='GET'):
+                sent.extend(json.loads(base64.b64decode(urlparse.parse_qs(params)['data'][0])))
+                return '{"status": 1}'
+            client.request = request
+            try:
+                sink.write(events[:2])
+                sink.close()
+                sink.write(events[2:3])
+                self.assertEqual(events[:3], sink.read())
+
+                def interrupted(*args):
+                    raise KeyboardInterrupt()
+                client._dispatch_batches = interrupted
+                self.assertRaises(KeyboardInterrupt, client.replay_dead_letters, sink)
+                self.assertFalse(os.path.exists(sink.filename))
+                del client._dispatch_batches
+                sink.write(events[3:])
+                client.replay_dead_letters(sink)
+                self.assertEqual(events, sent)
+                self.assertEqual([], glob.glob('failed.txt*'))
+            finally:
+                for filename in glob.glob('failed.txt*'):
+                    os.remove(filename)
+
+    def test_import_events_async(self):
+        client = Mixpanel('123', '123', pool_size=1, invalid_events_sink=DeadLetterSink('invalid_events.txt'))
+        responses = ['{"status": 1}', '{"status": 0, "error": "bad batch"}', '{"status": 1}']
+        client.request = lambda *args, **kwargs: responses.pop(0)
+        events = [{'event': 'page view', 'properties': {'distinct_id': 'abc123', 'time': 1471503600}}] * 120
+        job = client.import_events_async(events + [{'event': 'invalid', 'properties': {}}])
+        self.assertTrue(job.wait(10))
+        summary = job.summary()
+        self.assertEqual(120, summary['prepared'])
+        self.assertEqual(120, summary['sent'])
+        self.assertEqual(70, summary['acknowledged'])
+        self.assertEqual(50, summary['failed'])
+        self.assertEqual(1, len(summary['errors']))
+        self.assertIsNone(summary['error'])
+        os.remove('invalid_events.txt')
+
+    def test_dedupe_filter(self):
+        events = [{'event': 'page view', 'properties': {'distinct_id': str(i), 'time': 1471503600}} for i in range(60)]
+        try:
+            client = Mixpanel('123', '123', pool_size=1, dedupe_filter=BloomFilter('imported.bloom', capacity=10000))
+            client.request = lambda *args, **kwargs: '{"status": 1}'
+            self.assertEqual(40, client._import_data(events[:40], 'import').acknowledged)
+
+            client = Mixpanel('123', '123', pool_size=1, dedupe_filter=BloomFilter('imported.bloom'))
+            client.request = lambda *args, **kwargs: '{"status": 1}'
+            job = client._import_data(events + events[50:], 'import')
+            self.assertEqual(50, job.duplicates)
+            self.assertEqual(20, job.acknowledged)
+            self.assertEqual(60, client.dedupe_filter.count)
+
+            def crashing_events():
+                for i in range(60, 1160):
+                    yield {'event': 'page view', 'properties': {'distinct_id': str(i), 'time': 1471503600}}
+                raise IOError('disk error')
+            client = Mixpanel('123', '123', pool_size=1, batch_size=10, dedupe_filter=BloomFilter('imported.bloom'))
+            client.request = lambda *args, **kwargs: '{"status": 1}'
+            self.assertRaises(IOError, client._import_data, crashing_events(), 'import')
+            self.assertEqual(1060, BloomFilter('imported.bloom').count)
+        finally:
+            os.remove('imported.bloom')
+
+    def test_bloom_filter_capacity(self):
+        # Past its capacity the filter grows instead of matching everything
+        bloom = BloomFilter('grown.bloom', capacity=1000)
+        added = [str(i) for i in range(20000)]
+        bloom.update(added)
+        self.assertEqual(20000, bloom.count)
+        self.assertGreater(len(bloom.layers), 1)
+        others = [str(i) for i in range(20000, 40000)]
+        try:
+            bloom.save()
+            for loaded in [bloom, BloomFilter('grown.bloom')]:
+                self.assertEqual(20000, loaded.count)
+                self.assertTrue(all(fingerprint in loaded for fingerprint in added))
+                self.assertLess(sum(1 for fingerprint in others if fingerprint in loaded), 40)
+
+            # Filters saved before they could grow are loaded as their first layer
+            layer = bloom.layers[0]
+            with open('grown.bloom', 'wb') as output:
+                output.write(struct.pack('<8sQII', 'MPBLOOM1', layer.num_bits, layer.num_hashes, layer.count))
+                output.write(layer.bits)
+            loaded = BloomFilter('grown.bloom')
+            self.assertEqual(1000, loaded.count)
+            self.assertTrue(all(fingerprint in loaded for fingerprint in added[:1000]))
+            loaded.update(others)
+            self.assertEqual(21000, loaded.count)
+        finally:
+            os.remove('grown.bloom')
+
+    def test_encoded_batch(self):
+        events = self.mixpanel.list_from_items_filename('events_items_gold.json')
+        batch = EncodedBatch(events)
+        data = urlparse.parse_qs(batch.body)['data'][0]
+        self.assertEqual(events, json.loads(base64.b64decode(data)))
+        parts = batch.split(len(batch.json) - 1)
+        self.assertEqual(events, [event for part in parts for event in part])
+        self.assertEqual([1, 2], [len(part) for part in parts])
+        self.assertIs(batch.encoded_items[1], parts[1].encoded_items[0])
+
+        client = Mixpanel('123', '123', max_retries=1, failed_batches_sink=DeadLetterSink('failed.txt', 'batches'))
+        bodies = []
+
+        def overloaded(request):
+            bodies.append(request.get_data())
+            raise urllib2.HTTPError(request.get_full_url(), 503, 'Service Unavailable', {}, None)
+        client._urlopen = overloaded
+        delays = []
+        original_sleep = time.sleep
+        time.sleep = delays.append
+        try:
+            self.assertIsNone(client._send_batch('import', batch))
+            self.assertEqual(2, len(bodies))
+            self.assertIs(batch.body, bodies[0])
+            self.assertIs(batch.body, bodies[1])
+            self.assertEqual(events, client.failed_batches_sink.read())
+            self.assertEqual(1, len(delays))
+            self.assertTrue(0 <= delays[0] <= Mixpanel.RETRY_BACKOFF)
+        finally:
+            time.sleep = original_sleep
+            os.remove('failed.txt')
+
+        # The delay doubles with each retry up to RETRY_BACKOFF_MAX, and Retry-After overrides it
+        err = urllib2.HTTPError('https://api.mixpanel.com/import/', 429, 'Too Many Requests', {}, None)
+        self.assertTrue(all(client._retry_delay(err, 20) <= Mixpanel.RETRY_BACKOFF_MAX for x in range(100)))
+        self.assertTrue(any(client._retry_delay(err, 3) > Mixpanel.RETRY_BACKOFF * 4 for x in range(100)))
+        err = urllib2.HTTPError('https://api.mixpanel.com/import/', 429, 'Too Many Requests',
+                                {'Retry-After': '7'}, None)
+        self.assertEqual(7, client._retry_delay(err, 0))
+
+    def test_cli(self):
+        gold_events = self.mixpanel.list_from_items_filename('events_items_gold.json')
+        gold_profiles = self.mixpanel.list_from_items_filename('people_items_gold.json')
+        bodies = []
+
+        def request(client, base_url, path_components, params, method='GET'):
+            bodies.append(params)
+            return '{"status": 1}'
+        original_request, original_iter_export = Mixpanel.request, Mixpanel.iter_export
+        Mixpanel.request = request
+        Mixpanel.iter_export = lambda client, params: iter(gold_events)
+        try:
+            stdout = cStringIO.StringIO()
+            self.assertEqual(0, main(['--api-secret', '123', 'export-events', '--from-date', '2016-07-01',
+                                      '--to-date', '2016-07-31'], stdout=stdout))
+            exported = stdout.getvalue()
+            self.assertEqual(gold_events, [json.loads(line) for line in exported.splitlines()])
+
+            stderr = cStringIO.StringIO()
+            self.assertEqual(0, main(['--api-secret', '123', '--token', '123', '--batch-size', '2', 'import-events'],
+                                     stdin=cStringIO.StringIO(exported), stderr=stderr))
+            self.assertEqual(len(gold_events), json.loads(stderr.getvalue())['acknowledged'])
+            self.assertEqual(2, len(bodies))
+
+            # Fractional offsets and timezone names are accepted, unknown names rejected
+            for timezone, shift in [('5.5', 5.5 * 3600)] + [('Asia/Kolkata', 5.5 * 3600)] * bool(timestamps.pytz):
+                del bodies[:]
+                self.assertEqual(0, main(['--api-secret', '123', '--token', '123', 'import-events',
+                                          '--timezone-offset', timezone],
+                                         stdin=cStringIO.StringIO(exported), stderr=cStringIO.StringIO()))
+                sent = json.loads(base64.b64decode(urlparse.parse_qs(bodies[0])['data'][0]))
+                self.assertEqual(gold_events[0]['properties']['time'] - shift, sent[0]['properties']['time'])
+            self.assertRaises(SystemExit, main, ['--api-secret', '123', 'import-events', '--timezone-offset',
+                                                 'Nowhere/Special'], stderr=cStringIO.StringIO())
+
+            del bodies[:]
+            profiles = ''.join(json.dumps(profile) + '\n' for profile in gold_profiles)
+            self.assertEqual(0, main(['--api-secret', '123', '--token', '123', 'people-unset', 'Current Level',
+                                      '--backup-file', 'cli_backup.json.gz'],
+                                     stdin=cStringIO.StringIO(profiles), stderr=cStringIO.StringIO()))
+            updates = json.loads(base64.b64decode(urlparse.parse_qs(bodies[0])['data'][0]))
+            self.assertEqual([profile['$distinct_id'] for profile in gold_profiles],
+                             [update['$distinct_id'] for update in updates])
+            self.assertEqual(['Current Level'], updates[0]['$unset'])
+            self.assertEqual(gold_profiles, self.mixpanel.list_from_items_filename('cli_backup.json.gz'))
+            os.remove('cli_backup.json.gz')
+
+            self.assertEqual(0, main(['--api-secret', '123', '--token', '123', 'people-delete', '--no-backup',
+                                      '--backup-file', 'cli_backup.json.gz'],
+                                     stdin=cStringIO.StringIO(profiles), stderr=cStringIO.StringIO()))
+            self.assertFalse(os.path.exists('cli_backup.json.gz'))
+        finally:
+            Mixpanel.request, Mixpanel.iter_export = original_request, original_iter_export
+            if os.path.exists('cli_backup.json.gz'):
+                os.remove('cli_backup.json.gz')
+
+    def test_analytics(self):
+        day = 1469059200  # 2016-07-21 00:00:00 UTC
+        events = []
+        for i in range(3000):
+            distinct_id = str(i % 1000)
+            events.append({'event': 'Signup', 'properties': {'distinct_id': distinct_id, 'time': day + i,
+                                                             'Plan': 'pro' if i % 3 else 'free'}})
+            if i % 2:
+                events.append({'event': 'Purchase',
+                               'properties': {'distinct_id': distinct_id, 'time': day + 86400 + i}})
+
+        counts, uniques, approximate, funnel = aggregate(events, [GroupedCounts(by=['event', 'Plan']),
+                                                                  Uniques(), Uniques(exact=False),
+                                                                  Funnel(['Signup', 'Purchase'])], chunk_size=700)
+        self.assertEqual({('2016-07-21', 'Signup', 'pro'): 2000, ('2016-07-21', 'Signup', 'free'): 1000,
+                          ('2016-07-22', 'Purchase', None): 1500}, counts.result())
+        self.assertEqual({('Signup',): 1000, ('Purchase',): 500}, uniques.result())
+        for key, count in approximate.result().items():
+            self.assertAlmostEqual(uniques.result()[key], count, delta=uniques.result()[key] * 0.05)
+        self.assertEqual([1000, 500], funnel.result())
+        self.assertEqual([1000, 0], aggregate(events, [Funnel(['Signup', 'Purchase'], window=3600)])[0].result())
+        self.assertEqual({('2016-07-18',): 4500}, aggregate(events, [GroupedCounts(by=(), bucket='week')])[0].result())
+
+        sketch = HyperLogLog()
+        for i in range(500):
+            sketch.add(i)
+        self.assertAlmostEqual(1000, sketch.merge(HyperLogLog().merge(sketch)).count() * 2, delta=50)
+
+        client = Mixpanel('123', '123')
+        client.iter_export = lambda params: iter([event for event in events if time.strftime(
+            '%Y-%m-%d', time.gmtime(event['properties']['time'])) == params['from_date']])
+        sharded = aggregate_export(client, {'from_date': '2016-07-21', 'to_date': '2016-07-22'},
+                                   [GroupedCounts(by=['event', 'Plan']), Funnel(['Signup', 'Purchase'])])
+        self.assertEqual(counts.result(), sharded[0].result())
+        self.assertEqual([1000, 500], sharded[1].result())
+
+        # Funnels of time ordered shards merge into the result of one pass
+        rng = random.Random(7)
+        steps = ['View', 'Cart', 'Buy']
+        times = rng.sample(xrange(10 * 86400), 5000)
+        events = sorted(({'event': rng.choice(steps), 'properties': {'distinct_id': str(rng.randrange(300)),
+                                                                     'time': t}} for t in times),
+                        key=lambda event: event['properties']['time'])
+
+        def depth(user_events):
+            best = 0
+            for i, start in enumerate(user_events):
+                if start['event'] == steps[0]:
+                    reached = 1
+                    for event in user_events[i + 1:]:
+                        if event['properties']['time'] - start['properties']['time'] > 7 * 86400:
+                            break
+                        if reached < len(steps) and event['event'] == steps[reached]:
+                            reached += 1
+                    best = max(best, reached)
+            return best
+        expected = [0] * len(steps)
+        for distinct_id in set(event['properties']['distinct_id'] for event in events):
+            for k in range(depth([event for event in events if event['properties']['distinct_id'] == distinct_id])):
+                expected[k] += 1
+        funnel = aggregate(events, [Funnel(steps, window=7 * 86400)], chunk_size=300)[0]
+        self.assertEqual(expected, funnel.result())
+        shards = [aggregate(events[i:i + 1200], [Funnel(steps, window=7 * 86400)])[0] for i in range(0, 5000, 1200)]
+        merged = shards[0]
+        for shard in shards[1:]:
+            merged.merge(shard)
+        self.assertEqual(expected, merged.result())
+
+    @skipIf(analytics.numpy is None, 'NumPy is not installed')
+    def test_analytics_numpy(self):
+        numpy = analytics.numpy
+        values = [0, 1, 2 ** 32 - 1, 2 ** 32, 2 ** 52 + 1, 2 ** 63, 2 ** 64 - 1]
+        self.assertEqual([value.bit_length() for value in values],
+                         analytics._bit_lengths(numpy.asarray(values, dtype=numpy.uint64)).tolist())
+        ids = [str(i % 700) for i in range(3000)]
+        self.assertEqual([hash64(distinct_id) for distinct_id in ids], hash64_array(ids).tolist())
+
+        day = 1469059200
+        events = [{'event': ['Signup', 'Purchase', 'Login'][i % 3],
+                   'properties': {'distinct_id': ids[i], 'time': day + i * 97, 'Plan': [None, 'pro', 'free'][i % 5 % 3]}}
+                  for i in range(3000)]
+
+        def run():
+            return aggregate(events, [GroupedCounts(by=['event', 'Plan'], bucket='hour'), Uniques(by=['Plan']),
+                                      Uniques(bucket='day', exact=False, precision=8)], chunk_size=500)
+        vectorized = run()
+        try:
+            analytics.numpy = None
+            plain = run()
+        finally:
+            analytics.numpy = numpy
+        for with_numpy, without_numpy in zip(vectorized, plain):
+            self.assertEqual(without_numpy.result(), with_numpy.result())
+        for key, sketch in vectorized[2].sketches.items():
+            self.assertEqual(list(plain[2].sketches[key].registers), sketch.registers.tolist())
+
+    def test_sync_people(self):
+        current = self.mixpanel.list_from_items_filename('people_items_gold.json')
+        desired = deepcopy(current)
+        desired[1]['$properties']['Current Level'] = 2
+        desired[1]['$properties']['Plan'] = 'pro'
+        del desired[1]['$properties']['Campaign Name']
+        del desired[1]['$properties']['$model']
+        client = Mixpanel('123', '123')
+        bodies = []
+
+        def request(base_url, path_components, params, method='GET'):
+            bodies.append(params)
+            return '{"status": 1}'
+        client.request = request
+
+        job = client.sync_people(desired, snapshot=current)
+        self.assertEqual(2, job.unchanged)
+        self.assertEqual(2, job.acknowledged)
+        updates = json.loads(base64.b64decode(urlparse.parse_qs(bodies[0])['data'][0]))
+        self.assertEqual({'Current Level': 2, 'Plan': 'pro'}, updates[0]['$set'])
+        self.assertEqual(['Campaign Name'], updates[1]['$unset'])
+
+        try:
+            with SQLiteStore('snapshot.db') as store:
+                store.insert_profiles(current)
+                self.assertEqual(2, client.sync_people(desired, snapshot=store).acknowledged)
+                self.assertEqual(3, client.sync_people(desired, snapshot=store).unchanged)
+                self.assertNotIn('Campaign Name', store.get_properties(desired[1]['$distinct_id']))
+        finally:
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists('snapshot.db' + suffix):
+                    os.remove('snapshot.db' + suffix)
+
+    def test_query_engage_memory_budget(self):
+        gold_profiles = self.mixpanel.list_from_items_filename('people_items_gold.json')
+        profiles = [dict(profile, **{'$distinct_id': str(i)}) for i in range(100) for profile in gold_profiles]
+        with SpillList(5000, wrap=Profile) as spilled:
+            spilled.extend(Profile(profile) for profile in profiles)
+            self.assertEqual(len(profiles), len(spilled))
+            self.assertGreater(len(spilled.segments), 10)
+            self.assertEqual(profiles, [profile.to_dict() for profile in spilled])
+            self.assertEqual(profiles, [profile.to_dict() for profile in spilled])
+            self.assertEqual(profiles[1], spilled[1].to_dict())
+            self.assertEqual(profiles[-1], spilled[-1].to_dict())
+            directory = spilled.directory
+        self.assertFalse(os.path.exists(directory))
+
+        client = Mixpanel('123', '123', memory_budget=5000)
+        pages = [profiles[i:i + 100] for i in range(0, len(profiles), 100)]
+        client._get_engage_page = lambda params: {'results': pages[params.get('page', 0)], 'session_id': '1',
+                                                  'page': params.get('page', 0), 'page_size': 100,
+                                                  'total': len(profiles)}
+        result = client.query_engage()
+        self.assertIsInstance(result, SpillList)
+        self.assertEqual(profiles, list(result))
+        try:
+            client.export_people('people_spilled.json')
+            self.assertEqual(profiles, self.mixpanel.list_from_items_filename('people_spilled.json'))
+            client.export_people('people_spilled.csv', format='csv')
+            self.assertEqual(len(profiles), len(self.mixpanel.list_from_items_filename('people_spilled.csv')))
+        finally:
+            os.remove('people_spilled.json')
+            os.remove('people_spilled.csv')
+
+    def test_iter_engage_bounded(self):
+        # Pages are only fetched a few ahead of the consumer
+        fetched = []
+
+        def get_page(params):
+            page = params.get('page', 0)
+            fetched.append(page)
+            return {'results': [{'$distinct_id': '%d-%d' % (page, i)} for i in range(10)], 'session_id': '1',
+                    'page': page, 'page_size': 10, 'total': 2000}
+        client = Mixpanel('123', '123', pool_size=4)
+        client._get_engage_page = get_page
+        profiles = client.iter_engage()
+        for _ in range(11):
+            next(profiles)
+        time.sleep(0.1)
+        self.assertLessEqual(len(fetched), 2 + 4)
+        self.assertEqual(1989, sum(1 for _ in profiles))
+        self.assertEqual(range(200), sorted(fetched))
+
+        selectors = ['p%d' % p for p in range(20)]
+        client._get_engage_page = lambda params: dict(get_page(params), total=20)
+        del fetched[:]
+        profiles = client.iter_engage(partitions=selectors)
+        next(profiles)
+        time.sleep(0.1)
+        self.assertLessEqual(len(fetched), 2 * (4 + 1))
+        self.assertEqual(399, sum(1 for _ in profiles))
+
+    def test_query_engage_partitions(self):
+        selectors = range_selectors('$last_seen', ['2016-07-01T00:00:00', date(2016, 8, 1)])
+        self.assertEqual(['properties["$last_seen"] < "2016-07-01T00:00:00"',
+                          'properties["$last_seen"] >= "2016-07-01T00:00:00" and '
+                          'properties["$last_seen"] < "2016-08-01T00:00:00"',
+                          'properties["$last_seen"] >= "2016-08-01T00:00:00"',
+                          'not defined (properties["$last_seen"])'], selectors)
+
+        partitions = dict((selector, [{'$distinct_id': '%d-%d' % (p, i)} for i in range(25)])
+                          for p, selector in enumerate(selectors))
+        requests = []
+        failures = [selectors[1]]
+
+        def get_page(params):
+            selector = params['where'][len('(x) and ('):-1]
+            page = params.get('page', 0)
+            requests.append((selector, page))
+            if page == 2 and selector in failures:
+                failures.remove(selector)
+                raise urllib2.URLError('session expired')
+            return {'results': partitions[selector][page * 10:page * 10 + 10], 'session_id': selector, 'page': page,
+                    'page_size': 10, 'total': 25}
+        client = Mixpanel('123', '123', pool_size=4)
+        client._get_engage_page = get_page
+        profiles = client.query_engage({'where': 'x'}, partitions=selectors)
+        self.assertItemsEqual(sum(partitions.values(), []), profiles)
+        # Only the partition that failed was fetched again
+        for selector in selectors:
+            self.assertEqual(6 if selector == selectors[1] else 3, sum(1 for s, page in requests if s == selector))
+        self.assertItemsEqual(sum(partitions.values(), []), list(client.iter_engage({'where': 'x'},
+                                                                                    partitions=selectors)))
+
+        # With a worker pool every page is fetched on it, within its concurrency cap
+        scheduler = FairScheduler(workers=4)
+        running = {'now': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def scheduled_get_page(params):
+            self.assertIn(threading.current_thread(), scheduler._threads)
+            with lock:
+                running['now'] += 1
+                running['max'] = max(running['max'], running['now'])
+            time.sleep(0.005)
+            try:
+                return get_page(params)
+            finally:
+                with lock:
+                    running['now'] -= 1
+        try:
+            client = Mixpanel('123', '123', pool_size=4, worker_pool=scheduler.project('engage', max_concurrency=2))
+            client._get_engage_page = scheduled_get_page
+            failures.append(selectors[2])
+            self.assertItemsEqual(sum(partitions.values(), []), client.query_engage({'where': 'x'},
+                                                                                    partitions=selectors))
+            self.assertEqual([], failures)
+            client._get_engage_page = lambda params: scheduled_get_page(dict(params, where='(x) and (%s)' %
+                                                                             selectors[0]))
+            self.assertEqual(partitions[selectors[0]], list(client.iter_engage()))
+        finally:
+            scheduler.close()
+        self.assertEqual(2, running['max'])
+
+    def test_deduplicate_people_spilled(self):
+        profiles = [{'$distinct_id': str(i), '$properties': {'$email': 'user%d@example.com' % (i % 100),
+                                                             '$last_seen': '2016-07-%02dT00:00:00' % (i // 100 + 1),
+                                                             'Source %d' % (i // 100): i}} for i in range(300)]
+        client = Mixpanel('123', '123', pool_size=1, memory_budget=2000)
+        client._get_engage_page = lambda params: {'results': profiles, 'session_id': '1', 'page': 0,
+                                                  'page_size': 300, 'total': 300}
+        updates = []
+
+        def request(base_url, path_components, params, method='GET'):
+            updates.extend(json.loads(base64.b64decode(urlparse.parse_qs(params)['data'][0])))
+            return '{"status": 1}'
+        client.request = request
+        client.deduplicate_people(merge_props=True)
+        merges = dict((update['$distinct_id'], update['$set_once']) for update in updates if '$set_once' in update)
+        deletes = set(update['$distinct_id'] for update in updates if '$delete' in update)
+        self.assertEqual(set(str(i) for i in range(200, 300)), set(merges))
+        self.assertEqual({'$email': 'user1@example.com', 'Source 0': 1, 'Source 1': 101}, merges['201'])
+        self.assertEqual(set(str(i) for i in range(200)), deletes)
+
+    def test_priority_limiter(self):
+        limiter = PriorityLimiter(3, reserved=1)
+        limiter.acquire(BULK)
+        limiter.acquire(BULK)
+        blocked = threading.Thread(target=limiter.acquire, args=(BULK,))
+        blocked.daemon = True
+        blocked.start()
+        blocked.join(0.1)
+        self.assertTrue(blocked.is_alive())
+        limiter.acquire(INTERACTIVE)
+        limiter.release(BULK)
+        blocked.join(2)
+        self.assertFalse(blocked.is_alive())
+        self.assertEqual({BULK: 2, INTERACTIVE: 1}, limiter.in_flight)
+
+        client = Mixpanel('123', '123', pool_size=4, max_in_flight=2, reserved_interactive=1)
+        lock = threading.Lock()
+        in_flight = {BULK: 0, INTERACTIVE: 0}
+        peak = {BULK: 0, INTERACTIVE: 0}
+
+        def urlopen(request):
+            priority = client.current_priority
+            with lock:
+                in_flight[priority] += 1
+                peak[priority] = max(peak[priority], in_flight[priority])
+            time.sleep(0.01)
+            with lock:
+                in_flight[priority] -= 1
+            if request.get_method() == 'GET':
+                return json.dumps({'results': [], 'session_id': '1', 'page': 0, 'page_size': 1000, 'total': 0})
+            return '{"status": 1}'
+        client._urlopen = urlopen
+        events = [{'event': 'page view', 'properties': {'distinct_id': 'abc123', 'time': 1471503600}}] * 1000
+        job = client.import_events_async(events)
+        time.sleep(0.05)
+        started = time.time()
+        self.assertEqual([], client.query_engage())
+        self.assertLess(time.time() - started, 0.5)
+        self.assertTrue(job.wait(10))
+        self.assertEqual(1000, job.acknowledged)
+        self.assertEqual({BULK: 1, INTERACTIVE: 1}, peak)
+
+    @skipIf(timestamps.pytz is None, 'pytz is not installed')
+    def test_normalize_times(self):
+        summer, winter = 1467388800, 1451667600  # 2016-07-01 16:00 and 2016-01-01 17:00 UTC
+        self.assertEqual([summer, winter, summer - 4 * 3600, summer, summer, summer, None, None],
+                         normalize_times(['2016-07-01T12:00:00', '2016-01-01T12:00:00', '2016-07-01T12:00:00Z',
+                                          '2016-07-01T12:00:00-04:00', 1467374400000, '1467374400', None, 'bad'],
+                                         'America/New_York'))
+        self.assertEqual([summer + 7 * 3600], normalize_times([summer], -7))
+
+        # Offsets come from pytz's transitions, in both hemispheres and for zones without DST
+        times = ['2024-01-15T12:00:00', '2024-07-01T12:00:00', '2007-01-15T12:00:00']
+        self.assertEqual([1705338000, 1719849600, 1168880400], normalize_times(times, 'America/New_York'))
+        self.assertEqual([1705280400, 1719799200], normalize_times(times[:2], 'Australia/Sydney'))
+        self.assertEqual([1705300200], normalize_times(times[:1], 'Asia/Kolkata'))
+        self.assertEqual([1705320000, 1705338000], [normalize_times(times[:1], 'UTC')[0],
+                                                    normalize_times(times[:1], 'EST')[0]])
+        self.assertRaises(ValueError, normalize_times, times, 'Nowhere/Special')
+
+        # ISO-8601 strings are parsed as a batch, with the same results as one at a time
+        values = ['2016-07-01T12:00:00', u'2016-07-01 12:00:00Z', '2016-07-01', '2016-07-01T12:00:00.250',
+                  '2016-07-01T12:00:00+05:30', '2016-07-01T12:00:00-0400', '1467374400', 'bad', '2016-13-01']
+        self.assertEqual([parse_iso(value) for value in values], parse_iso_batch(values))
+        self.assertEqual([parse_iso(value) for value in values[:4]], parse_iso_batch(values[:4]))
+
+        client = Mixpanel('123', '123', pool_size=1)
+        batches = []
+
+        def request(base_url, path_components, params, method='GET'):
+            batches.append(params)
+            return '{"status": 1}'
+        client.request = request
+        original_normalize_times = mixpanelapi.normalize_times
+        # Times are normalized in batches before prep, which shouldn't parse them again one at a time
+        mixpanelapi.normalize_times = None
+        try:
+            client.import_events([{'event': 'a', 'properties': {'distinct_id': '1', 'time': '2016-07-01T12:00:00'}},
+                                  {'event': 'b', 'properties': {'distinct_id': '1', 'time': 1451649600000}}],
+                                 timezone_offset='America/New_York')
+        finally:
+            mixpanelapi.normalize_times = original_normalize_times
+        events = json.loads(base64.b64decode(urlparse.parse_qs(batches[0])['data'][0]))
+        self.assertEqual([summer, winter], [event['properties']['time'] for event in events])
+
+        profiles = [{'$distinct_id': '1', '$properties': {'$email': 'a@b.com', '$last_seen': '2016-08-02T00:00:00'}},
+                    {'$distinct_id': '2', '$properties': {'$email': 'a@b.com'}},
+                    {'$distinct_id': '3', '$properties': {'$email': 'A@b.com', '$last_seen': '2016-08-01T00:00:00'}}]
+        del batches[:]
+        client.deduplicate_people(profiles)
+        deletes = json.loads(base64.b64decode(urlparse.parse_qs(batches[0])['data'][0]))
+        self.assertEqual(['2', '3'], [delete['$distinct_id'] for delete in deletes])
+
+    def test_pipeline(self):
+        gold_events = self.mixpanel.list_from_items_filename('events_items_gold.json')
+        pipeline = Pipeline.from_file('events_items_gold.json', chunk_size=2) \
+            .filter(lambda event: event['event'] == 'App Install') \
+            .rename_events({'App Install': 'Install'}) \
+            .rename_properties({'$os': 'Operating System'}) \
+            .shift_time(-7)
+        try:
+            count = pipeline.to_file('pipeline_events.json', compress=True)
+            test_events = self.mixpanel.list_from_items_filename('pipeline_events.json.gz')
+        finally:
+            os.remove('pipeline_events.json.gz')
+
+        expected_events = [event for event in gold_events if event['event'] == 'App Install']
+        self.assertEqual(len(expected_events), count)
+        for expected, test in zip(expected_events, test_events):
+            self.assertEqual('Install', test['event'])
+            self.assertEqual(expected['properties']['time'] + 7 * 3600, test['properties']['time'])
+            self.assertEqual(expected['properties'].get('$os'), test['properties'].get('Operating System'))
+            self.assertNotIn('$os', test['properties'])
+
+        client = Mixpanel('123', '123')
+        client.request = lambda *args, **kwargs: '{"status": 1}'
+        job = Pipeline(lambda: iter(expected_events)).to_import(client)
+        self.assertEqual(count, job.acknowledged)
+
+        # Stages work on copies, so a list source can be read again unchanged
+        source = deepcopy(expected_events)
+        shifted = Pipeline(lambda: iter(source)).rename_properties({'$os': 'Operating System'}).shift_time(-7)
+        self.assertEqual(list(shifted), list(shifted))
+        self.assertEqual(expected_events, source)
+
+    def test_iter_export_request_slot(self):
+        gold_events = self.mixpanel.list_from_items_filename('events_items_gold.json')
+        profiler = StageProfiler()
+        client = Mixpanel('123', '123', profiler=profiler, max_in_flight=2, adaptive_concurrency=True)
+        client._urlopen = lambda request, timeout=None, stream=False: cStringIO.StringIO(
+            ''.join(json.dumps(event) + '\n' for event in gold_events))
+        events = client.iter_export({'from_date': '2016-07-01', 'to_date': '2016-07-01'})
+        self.assertEqual(gold_events[0], next(events))
+        # The stream holds its slot until it is read to the end
+        self.assertEqual(1, client.priorities.in_flight[INTERACTIVE])
+        self.assertEqual(gold_events[1:], list(events))
+        self.assertEqual(0, client.priorities.in_flight[INTERACTIVE])
+        self.assertEqual(len(gold_events) + 1, profiler.stats['network'].count)
+
+    def test_request_slot_failures(self):
+        client = Mixpanel('123', '123', adaptive_concurrency=True, pool_size=8)
+        request = client._build_request(Mixpanel.API_URL, ['engage'], {})
+        failures = [urllib2.HTTPError(request.get_full_url(), 502, 'Bad Gateway', {}, None),
+                    urllib2.HTTPError(request.get_full_url(), 500, 'Internal Server Error', {}, None),
+                    urllib2.URLError('Connection refused'), socket.error(104, 'Connection reset by peer'),
+                    socket.timeout('timed out'), httplib.BadStatusLine('')]
+        for err in failures:
+            client.concurrency._limit = 8
+
+            def fail(request, timeout=None, stream=False):
+                raise err
+            client._urlopen = fail
+            # Start after the last decrease, so every failure cuts the limit
+            client.concurrency._last_decrease = 0
+            with self.assertRaises(type(err)):
+                client.request(Mixpanel.API_URL, ['engage'], {})
+            self.assertEqual(4, client.concurrency.limit)
+            self.assertEqual(0, client.concurrency.in_flight)
+
+        # A client error means the API is healthy
+        client.concurrency._limit = 4
+
+        def bad_request(request, timeout=None, stream=False):
+            raise urllib2.HTTPError(request.get_full_url(), 400, 'Bad Request', {}, None)
+        client._urlopen = bad_request
+        with self.assertRaises(urllib2.HTTPError):
+            client.request(Mixpanel.API_URL, ['engage'], {})
+        self.assertGreater(client.concurrency._limit, 4)
+
+    def test_export_people_incremental(self):
+        profiles = [{'$distinct_id': str(i), '$properties': {'$last_seen': '2016-07-%02dT00:00:00' % (i + 1),
+                                                             'Plan': 'free'}} for i in range(20)]
+        wheres = []
+
+        def get_page(params):
+            wheres.append(params.get('where'))
+            results = profiles
+            if params.get('where'):
+                since = json.loads(params['where'].split(' >= ')[1])
+                results = [p for p in profiles if p['$properties']['$last_seen'] >= since]
+            return {'results': deepcopy(results), 'session_id': '1', 'page': 0, 'page_size': 100,
+                    'total': len(results)}
+        client = Mixpanel('123', '123')
+        client._get_engage_page = get_page
+        try:
+            client.export_people_incremental('people_full.json', 'snapshot.db')
+            self.assertEqual([None], wheres)
+            self.assertItemsEqual(profiles, self.mixpanel.list_from_items_filename('people_full.json'))
+
+            profiles[3]['$properties'].update({'$last_seen': '2099-01-01T00:00:00', 'Plan': 'paid'})
+            profiles.append({'$distinct_id': 'new', '$properties': {'$last_seen': '2099-01-02T00:00:00'}})
+            client.export_people_incremental('people_delta.json', 'snapshot.db', delta=True)
+            self.assertIn('properties["$last_seen"] >= "', wheres[-1])
+            self.assertItemsEqual([profiles[3], profiles[-1]],
+                                  self.mixpanel.list_from_items_filename('people_delta.json'))
+
+            client.export_people_incremental('people_full.json', 'snapshot.db')
+            self.assertItemsEqual(profiles, self.mixpanel.list_from_items_filename('people_full.json'))
+            with SQLiteStore('snapshot.db') as store:
+                self.assertEqual('paid', store.get_properties('3')['Plan'])
+                self.assertIsNotNone(store.get_metadata('people_watermark:$last_seen'))
+            # Profiles deleted from the project are only dropped by a full refresh
+            deleted = profiles.pop(5)
+            client.export_people_incremental('people_full.json', 'snapshot.db')
+            self.assertIn(deleted, self.mixpanel.list_from_items_filename('people_full.json'))
+            client.export_people_incremental('people_full.json', 'snapshot.db', full_refresh=True)
+            self.assertIsNone(wheres[-1])
+            self.assertItemsEqual(profiles, self.mixpanel.list_from_items_filename('people_full.json'))
+            with SQLiteStore('snapshot.db') as store:
+                self.assertIsNone(store.get_properties(deleted['$distinct_id']))
+                self.assertEqual(len(profiles), len(list(store.iter_profiles())))
+        finally:
+            for filename in ['people_full.json', 'people_delta.json', 'snapshot.db', 'snapshot.db-wal',
+                             'snapshot.db-shm']:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    def test_export_sqlite(self):
+        gold_events = self.mixpanel.list_from_items_filename('events_items_gold.json')
+        gold_profiles = self.mixpanel.list_from_items_filename('people_items_gold.json')
+        duplicate = deepcopy(gold_profiles[0])
+        duplicate['$distinct_id'] = 'duplicate'
+        duplicate['$properties']['$email'] = duplicate['$properties']['$email'].upper()
+        client = Mixpanel('123', '123')
+        client.iter_export = lambda params: iter(gold_events)
+        client.iter_engage = lambda params, **kwargs: iter(gold_profiles + [duplicate])
+        try:
+            client.export_events('export.db', {}, format='sqlite')
+            client.export_people('export.db', format='sqlite')
+            with SQLiteStore('export.db', batch_size=2) as store:
+                self.assertEqual(gold_events, list(store.iter_events()))
+                distinct_id = gold_events[0]['properties']['distinct_id']
+                self.assertEqual([event for event in gold_events if event['properties']['distinct_id'] == distinct_id],
+                                 store.events_for(distinct_id))
+                store.index_profile_property('$email')
+                email = gold_profiles[0]['$properties']['$email']
+                self.assertEqual([gold_profiles[0]], store.profiles_by('$email', email))
+                self.assertItemsEqual([gold_profiles[0], duplicate], store.duplicate_profiles('$email'))
+                self.assertEqual([], store.duplicate_profiles('$email', case_sensitive=True))
+        finally:
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists('export.db' + suffix):
+                    os.remove('export.db' + suffix)
+
+    def test_stage_profiler(self):
+        profiler = StageProfiler(profile_stages=['prep'], output_prefix='import_profile')
+        client = Mixpanel('123', '123', pool_size=2, profiler=profiler)
+        client._urlopen = lambda request: '{"status": 1}'
+        client.import_events('events_items_gold.csv')
+        try:
+            for stage in ['parse', 'prep', 'encode', 'queue']:
+                self.assertIn(stage, profiler.stats)
+            self.assertEqual(len(self.mixpanel.list_from_items_filename('events_items_gold.csv')),
+                             profiler.stats['prep'].count)
+            with open('import_profile.folded') as f:
+                folded = dict(line.rsplit(' ', 1) for line in f.read().splitlines())
+            self.assertItemsEqual(profiler.stats.keys(), folded.keys())
+            self.assertIn('prep', open('import_profile.txt').read())
+            self.assertTrue(os.path.exists('import_profile.pstats'))
+        finally:
+            for extension in ['.txt', '.folded', '.pstats']:
+                os.remove('import_profile' + extension)
+
+        # A stage entered inside another only counts toward the inner one
+        profiler = StageProfiler()
+
+        def slow_items():
+            for i in range(5):
+                time.sleep(0.02)
+                yield i
+        with profiler.stage('write'):
+            self.assertEqual(range(5), list(profiler.iter_stage('normalize',
+                                                                profiler.iter_stage('parse', slow_items()))))
+        self.assertGreaterEqual(profiler.stats['parse'].wall, 0.1)
+        self.assertLess(profiler.stats['normalize'].wall, 0.05)
+        self.assertLess(profiler.stats['write'].wall, 0.05)
+
+        # CPU time is the stage's own thread's, not that of threads busy at the same time
+        if profiling._thread_cpu_time is not None:
+            def spin():
+                started = time.time()
+                while time.time() - started < 0.2:
+                    pass
+            with profiler.stage('prep'):
+                busy = threading.Thread(target=spin)
+                busy.start()
+                busy.join()
+            self.assertLess(profiler.stats['prep'].cpu, 0.1)
+            with profiler.stage('encode'):
+                spin()
+            self.assertGreater(profiler.stats['encode'].cpu, 0.1)
+
+    def test_backup_writer(self):
+        with open('people_items_gold.json', 'rbU') as gold_json_file:
+            gold_json_data = json.load(gold_json_file)
+        # The codec follows the extension, so every backup can be read back
+        for filename, magic in [('people_backup.json.gz', '\x1f\x8b'), ('people_backup.json', '{"')]:
+            writer = BackupWriter(filename)
+            try:
+                for profile in gold_json_data:
+                    writer.write(profile)
+                writer.wait()
+                self.assertEqual(len(gold_json_data), writer.flushed)
+                writer.close()
+                with open(filename, 'rb') as backup:
+                    self.assertEqual(magic, backup.read(len(magic)))
+                test_data = self.mixpanel.list_from_items_filename(filename)
+                self.assertEqual(gold_json_data, test_data)
+            finally:
+                os.remove(filename)
+        # bz2 can't be flushed before it is closed, so updates couldn't wait for their backup records
+        self.assertRaises(ValueError, BackupWriter, 'people_backup.json.bz2')
+        self.assertFalse(os.path.exists('people_backup.json.bz2'))
+
     def test__prep_event_for_import(self):
         valid_event = {'event': 'page view',
                        'properties': {'distinct_id': 12345, 'prop1': 'val1', 'prop2': 'val2', 'time': 1471503600}}
@@ -460,6 +1444,29 @@ class TestMixpanel(TestCase):
         for item in gold_data:
             self.assertIn(item, test_data)
 
+    def test_query_engage_output_properties(self):
+        client = Mixpanel('123', '123')
+        requests = []
+
+        def request(base_url, path_components, params, method='GET'):
+            # Batches are POSTed with a pre-encoded body
+            requests.append(dict(params) if isinstance(params, dict) else params)
+            return json.dumps({'results': [{'$distinct_id': 'abc123', '$properties': {'$email': 'a@b.com'}}],
+                               'session_id': '1', 'page': 0, 'page_size': 1000, 'total': 1})
+
+        client.request = request
+        client.query_engage({'where': 'true'}, output_properties=['$email'])
+        client.query_engage({'where': 'true', 'output_properties': ['$name']}, output_properties=['$email'])
+        client.people_delete(query_params={}, backup=False)
+        client.people_delete(query_params={}, backup_file='del_bak.json.gz')
+        client.people_change_property_name('$email', 'email', backup=False, unset=False)
+        os.remove('del_bak.json.gz')
+        self.assertEqual(['$email'], requests[0]['output_properties'])
+        self.assertEqual(['$name'], requests[1]['output_properties'])
+        self.assertEqual(Mixpanel.MINIMAL_OUTPUT_PROPERTIES, requests[2]['output_properties'])
+        self.assertNotIn('output_properties', requests[4])
+        self.assertEqual(['$email'], requests[6]['output_properties'])
+
     def test_export_events_to_json(self):
         params = {'from_date': '2016-07-20', 'to_date': '2016-07-21', 'event': ['App Install', 'Registration Complete']}
         self.mixpanel.export_events('events_export.json', params)
@@ -532,18 +1539,18 @@ class TestMixpanel(TestCase):
         test_profiles = self.mixpanel.query_engage({'selector': '(properties["test"] == true)'})
         self.assertItemsEqual(amsterdam_profiles, test_profiles)
         self.mixpanel.people_operation('$set', lambda p: {'test': p['$properties']['$city']}, profiles=list,
-                                       backup=True, backup_file='del_bak.json')
+                                       backup=True, backup_file='del_bak.json.gz')
         time.sleep(10)
         amsterdam_profiles = self.mixpanel.query_engage(query_params)
         test_profiles = self.mixpanel.query_engage({'selector': '((properties["test"] == "Amsterdam"))'})
         self.assertItemsEqual(amsterdam_profiles, test_profiles)
-        with open('del_bak_gold.json', 'rbU') as gold, open('del_bak.json', 'rbU') as test:
+        with open('del_bak_gold.json', 'rbU') as gold:
             gold_data = json.load(gold)
-            test_data = json.load(test)
+            test_data = self.mixpanel.list_from_items_filename('del_bak.json.gz')
             self.assertItemsEqual(gold_data, test_data)
         # Unset test prop so that export tests are not affected
         self.mixpanel.people_operation('$unset', ['test'], query_params={'selector': '(defined (properties["test"]))'})
-        os.remove('del_bak.json')
+        os.remove('del_bak.json.gz')
 
     # THE TESTS BELOW REQUIRE MANUALLY RESETTING THE import_mixpanelapi PROJECT - RESET NOW
     # https://mixpanel.com/report/1039391/
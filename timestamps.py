@@ -0,0 +1,245 @@
+import calendar
+import datetime
+import re
+from bisect import bisect_right
+
+from records import CompactMapping
+
+try:
+    import ciso8601
+except ImportError:
+    ciso8601 = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
+# Epoch times above this are in milliseconds (in seconds it would be the year 5138)
+MILLISECONDS_THRESHOLD = 10 ** 11
+
+_ISO_8601 = re.compile(r'(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:[.,]\d+)?)?)?'
+                       r'\s*(Z|[+-]\d\d(?::?\d\d)?)?$')
+_timezones = {}
+
+
+def parse_iso(value):
+    """
+    Parse an ISO-8601 date or date and time. Returns (epoch seconds, offset known) where offset known is False
+    for local times without Z or a UTC offset, which are returned as if they were UTC. Returns None if `value`
+    isn't ISO-8601.
+    """
+    if ciso8601 is not None:
+        try:
+            moment = ciso8601.parse_datetime(value.strip())
+        except ValueError:
+            return None
+        if moment is None:
+            return None
+        seconds = calendar.timegm(moment.replace(tzinfo=None).timetuple())
+        offset = moment.utcoffset()
+        if offset is None:
+            return seconds, False
+        return seconds - int(offset.total_seconds()), True
+    match = _ISO_8601.match(value.strip())
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, offset = match.groups()
+    try:
+        seconds = calendar.timegm((int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+                                   int(second or 0), 0, 0, 0))
+    except ValueError:
+        return None
+    if offset is None:
+        return seconds, False
+    if offset != 'Z':
+        sign = -1 if offset[0] == '-' else 1
+        digits = offset[1:].replace(':', '')
+        seconds -= sign * (int(digits[:2]) * 3600 + int(digits[2:] or 0) * 60)
+    return seconds, True
+
+
+def parse_iso_batch(values):
+    """
+    parse_iso of each of a list of strings. With NumPy, dates and times without a UTC offset (or with Z) are parsed
+    by a single datetime64 conversion, and only other values one at a time.
+    """
+    if numpy is None or not values:
+        return [parse_iso(value) for value in values]
+    results = [None] * len(values)
+    parsed = []
+    try:
+        strings = numpy.char.strip(numpy.asarray(values, dtype=numpy.unicode_))
+        utc = numpy.char.endswith(strings, u'Z')
+        strings = numpy.where(utc, numpy.char.rstrip(strings, u'Z'), strings)
+        # A date, optionally followed by a time, without an offset after the date
+        simple = ((numpy.char.find(strings, u'-') == 4) & (numpy.char.str_len(strings) >= 10) &
+                  (numpy.char.find(strings, u'+', 10) < 0) & (numpy.char.find(strings, u'-', 10) < 0))
+        indexes = numpy.flatnonzero(simple)
+        seconds = strings[indexes].astype('datetime64[s]').astype(numpy.int64)
+        parsed = indexes.tolist()
+        for i, value, offset_known in zip(parsed, seconds.tolist(), utc[indexes].tolist()):
+            results[i] = (value, offset_known)
+    except (UnicodeDecodeError, ValueError):
+        # A value NumPy can't read, so parse the whole batch one value at a time
+        parsed = []
+    if len(parsed) < len(values):
+        parsed = set(parsed)
+        for i, value in enumerate(values):
+            if i not in parsed:
+                results[i] = parse_iso(value)
+    return results
+
+
+class TimeZone(object):
+    """
+    UTC offsets of a named timezone (e.g. 'America/Los_Angeles') over time, from pytz's table of transitions, so a
+    batch of times is converted with a binary search per time (one searchsorted call with NumPy) instead of a
+    datetime per time. Like pytz, times after its last transition (in 2037) keep the last offset.
+    """
+
+    def __init__(self, name):
+        if pytz is None:
+            raise ValueError('Named timezones require pytz: ' + name)
+        try:
+            zone = pytz.timezone(name)
+        except pytz.UnknownTimeZoneError:
+            raise ValueError('Unknown timezone: ' + name)
+        self.name = name
+        # pytz only exposes a DST zone's transitions as private attributes, the first of them at datetime.min
+        transition_times = getattr(zone, '_utc_transition_times', None)
+        if transition_times:
+            self.transitions = [calendar.timegm(moment.timetuple()) for moment in transition_times[1:]]
+            offsets = [int(info[0].total_seconds()) for info in zone._transition_info]
+        else:
+            self.transitions = []
+            offsets = [int(zone.utcoffset(datetime.datetime(1970, 1, 1)).total_seconds())]
+        self.initial_offset, self.offsets = offsets[0], offsets[1:]
+        if numpy is not None:
+            self._transitions = numpy.asarray(self.transitions, dtype=numpy.int64)
+            self._offsets = numpy.asarray(offsets, dtype=numpy.int64)
+
+    def utc_offsets(self, utc_times):
+        """
+        UTC offsets in seconds in effect at each of a list of UTC epoch times
+        """
+        if numpy is not None:
+            times = numpy.asarray(utc_times, dtype=numpy.int64)
+            return self._offsets[numpy.searchsorted(self._transitions, times, 'right')].tolist()
+        table = [self.initial_offset] + self.offsets
+        return [table[bisect_right(self.transitions, t)] for t in utc_times]
+
+    def to_utc(self, local_times):
+        """
+        Convert local epoch times (wall clock times written as if they were UTC) to UTC, following DST. Times in a
+        DST gap or overlap resolve to one of the two candidate offsets.
+        """
+        guesses = [t - offset for t, offset in zip(local_times, self.utc_offsets(local_times))]
+        return [t - offset for t, offset in zip(local_times, self.utc_offsets(guesses))]
+
+
+def parse_timezone(value):
+    """
+    Parse a timezone argument as normalize_times accepts it: a number of hours from UTC (like '-7' or '5.5') or a
+    timezone name, which must be known. Raises ValueError otherwise.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        get_timezone(value)
+        return value
+
+
+def get_timezone(name):
+    timezone = _timezones.get(name)
+    if timezone is None:
+        timezone = _timezones[name] = TimeZone(name)
+    return timezone
+
+
+def normalize_times(values, timezone=0):
+    """
+    Convert a batch of timestamps to UTC epoch seconds.
+
+    Values can be epoch seconds or milliseconds (numbers or numeric strings) or ISO-8601 strings. Epoch times and
+    ISO-8601 times without an offset are taken to be local times in `timezone`, which is either a fixed number of
+    hours from UTC (like import_events' timezone_offset) or a timezone name, for which DST is followed. Values that
+    can't be parsed, including None, are returned as None.
+    """
+    strings = [value for value in values if isinstance(value, basestring)]
+    parsed_strings = iter(parse_iso_batch(strings))
+    local = []
+    absolute = {}
+    for i, value in enumerate(values):
+        if isinstance(value, basestring):
+            parsed = next(parsed_strings)
+            if parsed is not None:
+                seconds, offset_known = parsed
+                if offset_known:
+                    absolute[i] = seconds
+                local.append(seconds)
+                continue
+            try:
+                value = float(value)
+            except ValueError:
+                value = None
+        if value is None or isinstance(value, bool):
+            absolute[i] = None
+            local.append(0)
+        else:
+            local.append(value)
+
+    local = _epoch_seconds(local)
+    if isinstance(timezone, basestring):
+        utc = get_timezone(timezone).to_utc(local)
+    else:
+        offset = int(timezone * 3600)
+        utc = [t - offset for t in local]
+    for i, seconds in absolute.iteritems():
+        utc[i] = seconds
+    return utc
+
+
+def normalize_event_times(events, timezone=0, chunk_size=1000):
+    """
+    Yield copies of events with their time converted to UTC epoch seconds by normalize_times, a chunk at a time.
+    Events without a time, or with one that can't be parsed, are yielded unchanged.
+    """
+    chunk = []
+    for event in events:
+        chunk.append(event)
+        if len(chunk) == chunk_size:
+            for normalized in _normalize_chunk(chunk, timezone):
+                yield normalized
+            chunk = []
+    for normalized in _normalize_chunk(chunk, timezone):
+        yield normalized
+
+
+def _normalize_chunk(events, timezone):
+    indexes = [i for i, event in enumerate(events) if event['properties'].get('time') is not None]
+    times = normalize_times([events[i]['properties']['time'] for i in indexes], timezone)
+    for i, time in zip(indexes, times):
+        if time is None:
+            continue
+        event = events[i]
+        if isinstance(event, CompactMapping):
+            event = event.to_dict()
+        else:
+            event = dict(event, properties=dict(event['properties']))
+        event['properties']['time'] = time
+        events[i] = event
+    return events
+
+
+def _epoch_seconds(values):
+    if numpy is not None and values:
+        times = numpy.asarray(values, dtype=numpy.float64)
+        times = numpy.where(times > MILLISECONDS_THRESHOLD, times / 1000, times)
+        return times.astype(numpy.int64).tolist()
+    return [int(t / 1000 if t > MILLISECONDS_THRESHOLD else t) for t in values]
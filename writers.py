@@ -0,0 +1,402 @@
+import bz2
+import gzip
+import io
+import json
+import threading
+import zlib
+import Queue
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from records import to_builtin
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+_STOP = object()
+
+COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'bz2': '.bz2', 'lzma': '.xz'}
+
+
+def compression_codec(compress):
+    """
+    Normalize a `compress` argument (False, True or a codec name) to a codec name or None.
+    """
+    if not compress:
+        return None
+    if compress is True:
+        return 'gzip'
+    if compress not in COMPRESSION_EXTENSIONS:
+        raise ValueError("Invalid compression - must be 'gzip', 'bz2' or 'lzma': compress = " + str(compress))
+    if compress == 'lzma' and lzma is None:
+        raise ValueError("lzma compression requires the lzma module (backports.lzma on Python 2)")
+    return compress
+
+
+def extension_codec(filename):
+    """
+    Codec named by the extension of `filename` (see COMPRESSION_EXTENSIONS), or None for a plain file.
+    """
+    for codec, extension in COMPRESSION_EXTENSIONS.iteritems():
+        if filename.endswith(extension):
+            return codec
+    return None
+
+
+def open_output(filename, compress=False, level=None, threads=1, append=False):
+    """
+    Open `filename` for writing, compressing data as it is written.
+
+    :param compress: False for a plain file, True for gzip or one of 'gzip', 'bz2' or 'lzma'
+    :param level: compression level for the codec (gzip and bz2: 1-9, lzma: preset 0-9), None for the codec default.
+    gzip defaults to 9 however many threads compress it.
+    :param threads: with gzip, values above 1 compress independent blocks on that many threads
+    :param append: True to add to the end of an existing file. A bz2 file gets a new bz2 stream added after its
+    existing ones, which open_input reads as one file.
+    :return: a writable file-like object
+    """
+    codec = compression_codec(compress)
+    if codec is None:
+        return open(filename, 'a' if append else 'w+')
+    mode = 'ab' if append else 'wb'
+    if codec == 'gzip':
+        if threads > 1:
+            return ParallelGzipWriter(filename, level=level, threads=threads, append=append)
+        return gzip.open(filename, mode, 9 if level is None else level)
+    if codec == 'bz2':
+        return BZ2StreamWriter(filename, 9 if level is None else level, append)
+    return lzma.LZMAFile(filename, mode, preset=level)
+
+
+def open_input(filename):
+    """
+    Open `filename` for reading, decompressing it if its extension names one of the supported codecs.
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.bz2'):
+        return io.BufferedReader(_BZ2Streams(filename), 1 << 16)
+    if filename.endswith('.xz') and lzma is not None:
+        return lzma.LZMAFile(filename, 'rb')
+    return open(filename, 'rbU')
+
+
+class BZ2StreamWriter(object):
+    """
+    Writes one bz2 stream, to a new file or after the streams already in an existing one.
+
+    Python 2's BZ2File can neither append nor read past the first stream of
+    a file, so appending with it would mean rewriting the whole file.
+    Appended streams are left as they are, and a crash while writing one
+    loses only that stream. open_input reads every stream of a file.
+    """
+
+    def __init__(self, filename, level=9, append=False):
+        self._output = open(filename, 'ab' if append else 'wb')
+        self._compressor = bz2.BZ2Compressor(level)
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._output.write(self._compressor.compress(data))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        # Only what the compressor has emitted so far; the stream is complete once closed
+        self._output.flush()
+
+    def close(self):
+        if self._output.closed:
+            return
+        try:
+            self._output.write(self._compressor.flush())
+        finally:
+            self._output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _BZ2Streams(io.RawIOBase):
+    # Raw reader of every bz2 stream in a file, one after another
+
+    def __init__(self, filename):
+        self._input = open(filename, 'rb')
+        self._decompressor = bz2.BZ2Decompressor()
+        self._data = ''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._data:
+            chunk = self._input.read(1 << 16)
+            if not chunk:
+                return 0
+            self._data = self._decompress(chunk)
+        n = min(len(b), len(self._data))
+        b[:n] = self._data[:n]
+        self._data = self._data[n:]
+        return n
+
+    def _decompress(self, chunk):
+        data = []
+        while chunk:
+            try:
+                data.append(self._decompressor.decompress(chunk))
+            except EOFError:
+                # The previous stream ended exactly at the end of the last chunk
+                self._decompressor = bz2.BZ2Decompressor()
+                continue
+            chunk = self._decompressor.unused_data
+            if chunk:
+                self._decompressor = bz2.BZ2Decompressor()
+        return ''.join(data)
+
+    def close(self):
+        self._input.close()
+        super(_BZ2Streams, self).close()
+
+
+def _gzip_member(data, level):
+    # wbits of 31 makes zlib emit a complete gzip member (header, deflate stream and trailer)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter(object):
+    """
+    Writes a gzip file by compressing fixed size blocks on a thread pool.
+
+    Each block is written as its own gzip member, and a concatenation of
+    members is a valid gzip file that any gzip reader decompresses as one
+    stream. zlib releases the GIL while compressing, so blocks are
+    compressed in parallel. At most two blocks per thread are held in memory.
+    """
+
+    def __init__(self, filename, level=None, threads=4, block_size=1 << 20, append=False):
+        self.level = 9 if level is None else level
+        self.block_size = block_size
+        self.max_pending = threads * 2
+        self._output = open(filename, 'ab' if append else 'wb')
+        self._pool = ThreadPool(processes=threads)
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._submit_block()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self._submit_block()
+        while self._pending:
+            self._output.write(self._pending.popleft().get())
+        self._output.flush()
+
+    def close(self):
+        if self._output.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self._output.close()
+
+    def _submit_block(self):
+        if not self._buffered:
+            return
+        block = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._pending.append(self._pool.apply_async(_gzip_member, (block, self.level)))
+        while len(self._pending) > self.max_pending or (self._pending and self._pending[0].ready()):
+            self._output.write(self._pending.popleft().get())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DeadLetterSink(object):
+    """
+    Thread-safe, append-only file for items that could not be imported.
+
+    The file is opened on the first write and kept open with a buffered
+    handle, and a lock serializes writes from all threads so lines never
+    interleave. With format 'ndjson' every item is written on its own line,
+    with format 'batches' each call to `write` is written as one JSON array
+    per line. Items of a batches.EncodedBatch are written from their cached
+    JSON.
+
+    `flush` makes an uncompressed file readable by other processes, but a
+    compressed file is only complete once `close` is called. Mixpanel closes
+    its sinks at the end of every import and People operation, and the next
+    `write` reopens the file and appends to it.
+    """
+
+    def __init__(self, filename, format='ndjson', compress=False, level=None):
+        if format not in ('ndjson', 'batches'):
+            raise ValueError("Invalid format - must be 'ndjson' or 'batches': format = " + str(format))
+        self.codec = compression_codec(compress)
+        self.filename = filename
+        if self.codec is not None and not filename.endswith(COMPRESSION_EXTENSIONS[self.codec]):
+            self.filename += COMPRESSION_EXTENSIONS[self.codec]
+        self.format = format
+        self.level = level
+        self.count = 0
+        self._lock = threading.Lock()
+        self._output = None
+
+    def write(self, items):
+        """
+        Append a list of items to the sink.
+        """
+        encoded_items = getattr(items, 'encoded_items', None)
+        if encoded_items is None:
+            encoded_items = [json.dumps(item, default=to_builtin) for item in items]
+        if self.format == 'batches':
+            data = '[' + ', '.join(encoded_items) + ']\n'
+        else:
+            data = ''.join(encoded_item + '\n' for encoded_item in encoded_items)
+        with self._lock:
+            if self._output is None:
+                self._output = open_output(self.filename, self.codec, self.level, append=True)
+            self._output.write(data)
+            self.count += len(items)
+
+    def flush(self):
+        """
+        Flush buffered items to the file. Compressed files still need `close` to be readable.
+        """
+        with self._lock:
+            if self._output is not None:
+                self._output.flush()
+
+    def close(self):
+        with self._lock:
+            if self._output is not None:
+                self._output.close()
+                self._output = None
+
+    def read(self):
+        """
+        Return every item written to the sink so far, in either format.
+
+        The sink is closed first so compressed files are complete, and is
+        reopened by the next `write`.
+        """
+        self.close()
+        items = []
+        with open_input(self.filename) as item_file:
+            for line in item_file:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if isinstance(item, list):
+                    items.extend(item)
+                else:
+                    items.append(item)
+        return items
+
+
+class BackupWriter(object):
+    """
+    Writes items to an NDJSON file from a background thread, gzip compressed
+    if the name ends in .gz and plain otherwise.
+
+    Items are queued with `write` as they are fetched and the writer thread
+    drains the queue, flushing after each drained run of items. `wait` blocks
+    until a given number of items are flushed, so destructive updates can be
+    held back until the matching backup records are safely written. bz2 and
+    xz files can't be flushed before they are closed, so they are rejected.
+    """
+
+    def __init__(self, filename):
+        codec = extension_codec(filename)
+        if codec not in (None, 'gzip'):
+            raise ValueError("Backups must be plain or gzip compressed (.gz) files: filename = " + filename)
+        self.filename = filename
+        self.written = 0
+        self.flushed = 0
+        self._queue = Queue.Queue()
+        self._condition = threading.Condition()
+        self._error = None
+        self._output = open_output(filename, codec)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, item):
+        """
+        Queue an item for the backup file and return its position in the file.
+        """
+        self._queue.put(item)
+        self.written += 1
+        return self.written
+
+    def wait(self, count=None):
+        """
+        Block until the first `count` items (all queued items by default) have
+        been flushed to the backup file.
+        """
+        if count is None:
+            count = self.written
+        with self._condition:
+            while self.flushed < count and self._error is None:
+                self._condition.wait(1)
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        try:
+            stopped = False
+            while not stopped:
+                items = [self._queue.get()]
+                try:
+                    while True:
+                        items.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    pass
+                if items[-1] is _STOP:
+                    stopped = True
+                    items.pop()
+                for item in items:
+                    self._output.write(json.dumps(item, default=to_builtin) + '\n')
+                self._output.flush()
+                with self._condition:
+                    self.flushed += len(items)
+                    self._condition.notify_all()
+        except Exception as e:
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+        finally:
+            self._output.close()